@@ -1,11 +1,28 @@
 import json
 import time
 import os
+import threading
+import asyncio
 from asyncio.exceptions import TimeoutError
 
-from web3 import Web3, Account
+from web3 import Web3, AsyncWeb3, Account
 from dotenv import load_dotenv
 
+from state_store import StateStore, apply_changes
+from backfill import fetch_in_order
+from multicall import Multicall, MULTICALL3_ADDRESS
+from price_index import LiquidationPriceIndex
+from submitter import LiquidationSubmitter
+from rpc_pool import RpcPool, RpcPoolProvider, AsyncRpcPoolProvider, hedged
+from log_decoder import LogDecoder
+from log_archive import LogArchive
+from shards import ShardPool, get_shard
+import margin_engine
+from margin_engine import MarginBook
+from compact_state import intern_accounts, evict_inactive
+from wad import WAD, wad_mul, wad_div, mul_div
+import metrics
+
 
 load_dotenv('.env')
 
@@ -13,10 +30,62 @@ CURVE_TRADING_FEE_DECIMALS = 10
 VQUOTE_INDEX = 0
 VBASE_INDEX = 1
 
+# Number of journaled blocks after which state.json is rewritten in full
+STATE_COMPACTION_INTERVAL = 1000
+
+# Blocks are only written to disk once this many blocks deep, health checks still run against the latest head
+CONFIRMATION_DEPTH = 10
+# Synced ranges, usually a block each, that are kept in memory with their block hash so a reorg can be rolled back
+REORG_HISTORY = 128
+
+# Syncs further behind than this many blocks are fetched in parallel chunks instead of one range
+BACKFILL_THRESHOLD = 10000
+BACKFILL_WORKERS = 8
+BACKFILL_INITIAL_CHUNK = 2000
+
+# Seconds to wait before restarting after an exception, doubled for every restart in a row up to the maximum. A run
+# lasting longer than the maximum starts over from the first.
+RESTART_BACKOFF = 1
+MAX_RESTART_BACKOFF = 30
+
+# Optional directory to keep the fetched logs in, so a cold start replays the history from disk instead of the node
+LOG_ARCHIVE = os.getenv('LOG_ARCHIVE')
+
+# eth_call every liquidation before sending it, so ones that would revert don't cost gas
+SIMULATE_LIQUIDATIONS = os.getenv('SIMULATE_LIQUIDATIONS', 'false').lower() == 'true'
+
+# Every this many blocks all positions are checked, not only those marked dirty by the sync
+FULL_SWEEP_INTERVAL = 100
 
-# This RPC should ideally be localhost
-rpc_url = os.getenv('RPC')
-web3 = Web3(Web3.WebsocketProvider(rpc_url))
+# Lowest free collateral still considered healthy
+MIN_FREE_COLLATERAL = -5 * 10**16
+
+# Seconds the health check of a block may take. Accounts it doesn't get to are checked next block right after the
+# watchlist, in the order they were left in.
+HEALTH_CHECK_BUDGET = float(os.getenv('HEALTH_CHECK_BUDGET', '0.5'))
+# Healthy accounts with less free collateral above MIN_FREE_COLLATERAL than this fraction of their margin
+# requirement are checked every block, whatever changed
+WATCHLIST_SLACK = 0.1
+# How much being further below the margin requirement raises a liquidation's priority over its expected reward
+URGENCY_WEIGHT = 1
+
+# Worker processes the health checks are split over, each checking the accounts of one hash partition. 0 checks
+# every account in this process.
+HEALTH_CHECK_SHARDS = int(os.getenv('HEALTH_CHECK_SHARDS', '0'))
+
+# Indexed liquidation prices are moved this fraction of the price towards the current price, to absorb rounding
+LIQUIDATION_PRICE_BUFFER = 10**-6
+
+
+# Comma separated websocket URLs, the first should ideally be localhost. Requests go to the fastest healthy one.
+# Nothing is connected until the first request, importing this module makes no network calls.
+rpc_urls = [url.strip() for url in os.getenv('RPC', '').split(',') if url.strip()]
+rpc_pool = RpcPool(rpc_urls)
+web3 = Web3(RpcPoolProvider(rpc_pool))
+# Backfill requests are not latency critical, they are never hedged. Only used for logs, which are decoded
+# by the LogDecoder straight from the node's result without web3 wrapping every one in an AttributeDict first
+backfill_web3 = Web3(RpcPoolProvider(rpc_pool, hedged_methods=[]))
+backfill_web3.middleware_onion.remove('attrdict')
 
 contract_details_folder = f'''deployments/{os.getenv('NETWORK')}'''
 
@@ -37,16 +106,152 @@ vault_contract = web3.eth.contract(address=vault['address'], abi=vault['abi'])
 account = Account.from_key(os.getenv("PRIVATE_KEY"))
 print(f'Using account {account.address}')
 
+# Batches read calls into a single eth_call, the address can be overridden for other deployments
+multicall = Multicall(web3, os.getenv('MULTICALL', MULTICALL3_ADDRESS))
+
 with open(f'{contract_details_folder}/Perpetual.json', 'r') as perp_json:
     perp_abi = json.load(perp_json)['abi']
 
 with open(f'{contract_details_folder}/Market.json', 'r') as market_json:
     market_abi = json.load(market_json)['abi']
 
+# Events the bot follows on each contract, all fetched with a single get_logs request per range
+CLEARINGHOUSE_EVENTS = [
+    'ClearingHouseParametersChanged',
+    'MarketAdded',
+    'MarketRemoved',
+    'ChangePosition',
+    'LiquidityProvided',
+    'LiquidityRemoved',
+    'LiquidationCall'
+]
+VAULT_EVENTS = ['CollateralAdded', 'CollateralWeightChanged', 'Deposit', 'Withdraw']
+PERP_EVENTS = ['FundingPaid', 'PerpetualParametersChanged']
+
+log_decoder = LogDecoder([
+    (clearinghouse['abi'], CLEARINGHOUSE_EVENTS),
+    (vault['abi'], VAULT_EVENTS),
+    (perp_abi, PERP_EVENTS)
+])
+perp_topics = log_decoder.get_topics(PERP_EVENTS)
+
 with open(f'{contract_details_folder}/DeploymentBlock.txt', 'r') as deployment_block_txt:
     deployment_block = int(deployment_block_txt.read())
 
-if not os.path.isfile('state.json'):
+# Values that never change for a deployment, kept on disk so a restart doesn't ask the node for them again:
+# the chain id, the UA address and the market address and out fee of every perpetual, see load_chain_cache
+CHAIN_CACHE = os.getenv('CHAIN_CACHE', 'chain_cache.json')
+chain_cache = None
+# bootstrap() can fill it from the event loop and the thread loading the state at the same time
+chain_cache_lock = threading.Lock()
+
+state = {}
+# Interns the accounts of the loaded state and indexes each account's open positions
+account_registry = None
+store = StateStore('state.json', 'state.journal', STATE_COMPACTION_INTERVAL, CONFIRMATION_DEPTH, REORG_HISTORY)
+archive = LogArchive(LOG_ARCHIVE, CONFIRMATION_DEPTH) if LOG_ARCHIVE else None
+perp_contracts = {}
+market_contracts = {}
+# market idx -> values derived from the market's parameters, see refresh_market_constants
+market_constants = {}
+addresses_to_idx = {}
+
+# Accounts and markets changed since the last health check. Every account with a position in a dirty market gets checked,
+# only the LPs for markets in dirty_lp_markets, only the accounts crossing their liquidation price for price_moved_markets
+# and only the accounts without a liquidation price in the market yet for unindexed_markets
+dirty_accounts = set()
+dirty_markets = set()
+dirty_lp_markets = set()
+price_moved_markets = set()
+unindexed_markets = set()
+
+# Accounts close to being liquidatable -> their slack, see WATCHLIST_SLACK
+watchlist = {}
+
+# Accounts the last health check ran out of HEALTH_CHECK_BUDGET before getting to, in the order it would have
+# checked them
+deferred_accounts = []
+
+# (idx, trader) pairs whose position has no cumulative_funding_rate yet, filled in by the sync in one multicall
+traders_missing_funding_rate = set()
+
+# Set while health checks run in this thread, the evaluator must only ever read the in-memory state
+hot_path = threading.local()
+
+# Liquidations are sent over async_web3 by the submitter main() starts, so they never hold up syncing or health checks
+submitter = None
+
+# market idx -> LiquidationPriceIndex, and account -> markets it is indexed in
+liquidation_price_indices = {}
+indexed_markets = {}
+
+# With HEALTH_CHECK_SHARDS, the workers doing the health checks. Each has its own watchlist, liquidation price
+# indices and deferred accounts, for its shard only, and follows the state through the changes sent by check_shards.
+shard_pool = None
+
+def forbid_network_in_hot_path(make_request, w3):
+    def middleware(method, params):
+        if getattr(hot_path, 'active', False):
+            raise RuntimeError(f'Health checks must not make RPC calls, attempted {method}')
+        return make_request(method, params)
+    return middleware
+
+web3.middleware_onion.add(forbid_network_in_hot_path, 'forbid_network_in_hot_path')
+web3.middleware_onion.add(metrics.rpc_middleware, 'metrics')
+backfill_web3.middleware_onion.add(metrics.rpc_middleware, 'metrics')
+
+# Liquidations are sent and their blocks fetched over this, the sync uses web3 from its own thread
+async_web3 = AsyncWeb3(AsyncRpcPoolProvider(rpc_pool))
+async_web3.middleware_onion.add(metrics.async_rpc_middleware, 'metrics')
+async_multicall = Multicall(async_web3, os.getenv('MULTICALL', MULTICALL3_ADDRESS))
+async_clearinghouse_viewer_contract = async_web3.eth.contract(address=clearinghouse_viewer['address'], abi=clearinghouse_viewer['abi'])
+
+# Nonces are added per transaction by the submitter, the chain id and fee by bootstrap()
+transaction_dict = {
+    'from': account.address,
+    'gas': 10*(10**6),
+    'maxPriorityFeePerGas': 0
+}
+
+
+### START UP FUNCTIONS ###
+# Left by another deployment, or missing, the cache starts out empty
+def load_chain_cache():
+    global chain_cache
+
+    if chain_cache is None:
+        chain_cache = {'clearinghouse': clearinghouse['address'], 'markets': {}}
+        if os.path.isfile(CHAIN_CACHE):
+            with open(CHAIN_CACHE, 'r') as f:
+                cached = json.load(f)
+            if cached.get('clearinghouse') == clearinghouse['address']:
+                chain_cache = cached
+    return chain_cache
+
+def save_chain_cache(values):
+    with chain_cache_lock:
+        chain_cache.update(values)
+        with open(CHAIN_CACHE + '.tmp', 'w') as f:
+            json.dump(chain_cache, f)
+        os.replace(CHAIN_CACHE + '.tmp', CHAIN_CACHE)
+
+def get_ua_address():
+    cache = load_chain_cache()
+    if 'ua_address' not in cache:
+        save_chain_cache({'ua_address': vault_contract.functions.UA().call()})
+    return cache['ua_address']
+
+# perp address -> (market address, out fee), read in two multicalls for the perps not in the cache yet
+def get_market_details(perp_addresses):
+    cache = load_chain_cache()
+    missing = [perp_address for perp_address in dict.fromkeys(perp_addresses) if perp_address not in cache['markets']]
+    if len(missing) > 0:
+        market_addresses = [Web3.to_checksum_address(market_address) for market_address in multicall.call([web3.eth.contract(address=perp_address, abi=perp_abi).functions.market() for perp_address in missing])]
+        out_fees = multicall.call([web3.eth.contract(address=market_address, abi=market_abi).functions.out_fee() for market_address in market_addresses])
+        save_chain_cache({'markets': {**cache['markets'], **{perp_address: [market_address, out_fee] for perp_address, market_address, out_fee in zip(missing, market_addresses, out_fees)}}})
+    return {perp_address: tuple(cache['markets'][perp_address]) for perp_address in perp_addresses}
+
+def create_state_file():
     with open('state.json', 'x') as f:
         start_state = {
             'synced_block': deployment_block,
@@ -56,104 +261,337 @@ if not os.path.isfile('state.json'):
             'global_positions': {},
             'reserves': {},
             'reserve_weights': {},
-            'ua_address': vault_contract.functions.UA().call(),
+            'ua_address': get_ua_address(),
             'liquidation_rewards': 0
         }
         f.write(json.dumps(start_state))
 
-state = {}
-perp_contracts = {}
-addresses_to_idx = {}
-
-transaction_dict = {
-    'chainId': web3.eth.chain_id,
-    'nonce': web3.eth.get_transaction_count(account.address),
-    'from': account.address,
-    'gas': 10*(10**6),
-    'maxPriorityFeePerGas': 0,
-    'maxFeePerGas': 2*web3.eth.gas_price
-}
+async def get_chain_id():
+    cache = load_chain_cache()
+    if 'chain_id' not in cache:
+        save_chain_cache({'chain_id': await async_web3.eth.chain_id})
+    return cache['chain_id']
+
+# Everything main() needs before its first health check, the requests sent together while the state loads.
+# Returns the latest block number.
+async def bootstrap():
+    load_chain_cache()
+    chain_id, gas_price, head, _, _ = await asyncio.gather(
+        get_chain_id(),
+        async_web3.eth.gas_price,
+        async_web3.eth.block_number,
+        submitter.start(),
+        asyncio.to_thread(load_state)
+    )
+    transaction_dict['chainId'] = chain_id
+    transaction_dict['maxFeePerGas'] = 2 * gas_price
+    return head
 
 
 ### SYNC FUNCTIONS ###
-def sync(to_block):
-    global state
-
+def load_state():
+    global state, account_registry
+
+    if not state:
+        if not os.path.isfile('state.json'):
+            create_state_file()
+        state = intern_accounts(store.load())
+        account_registry = state['reserves'].registry
+        refresh_market_constants(state['perps'])
+        # main() fetches the first block's data before anything is synced
+        load_market_contracts()
+
+        # State files from before positions were completed during sync
+        for idx in state['trader_positions']:
+            for trader, position in state['trader_positions'][idx].items():
+                if 'cumulative_funding_rate' not in position:
+                    traders_missing_funding_rate.add((idx, trader))
+
+class ChainReorganized(Exception):
+    pass
+
+# block_data is the (raw logs, logs, perp snapshot, headers) of the range if it was already fetched by fetch_block_data
+def sync(to_block, block_data=None):
+    load_state()
+    if archive is not None:
+        fill_archive()
+
+    # A long catch up is synced in two steps, so that all but the unconfirmed blocks can be written straight away
+    if block_data is None and CONFIRMATION_DEPTH > 0 and to_block - CONFIRMATION_DEPTH > state['synced_block']:
+        sync_range(to_block - CONFIRMATION_DEPTH)
+    if to_block > state['synced_block']:
+        sync_range(to_block, block_data)
+
+# Rewrites state.json once enough has been journaled, run after the health check so it never holds one up
+def compact_state():
+    if store.compaction_due:
+        with metrics.STAGE_SECONDS.time(stage='compaction'):
+            store.compact(state)
+
+def sync_range(to_block, block_data=None):
     success = False
     while not success:
         try:
-            # reload the state each try to avoid events being processed twice if later events timeout
-            with open('state.json', 'r') as f:
-                state = json.loads(f.read())
-
-            sync_markets_added(to_block)
-            sync_perps()
-            sync_all_events(to_block)
-
+            from_block = state['synced_block'] + 1
+            raw_logs = None
+            if to_block - state['synced_block'] > BACKFILL_THRESHOLD or (archive is not None and archive.get_replay_end(from_block, to_block) >= from_block):
+                headers = get_headers(from_block, to_block)
+                check_chain(headers, [])
+                lp_update_list = backfill(to_block)
+            else:
+                if block_data is None:
+                    headers = get_headers(from_block, to_block)
+                    raw_logs, logs = get_all_logs(from_block, to_block)
+                    snapshot = {}
+                else:
+                    raw_logs, logs, snapshot, headers = block_data
+                    block_data = None
+                check_chain(headers, logs)
+                sync_markets_added(logs)
+                sync_perps(to_block, snapshot)
+                lp_update_list = sync_all_events(logs)
+            refresh_positions(lp_update_list, to_block)
+            evict_inactive_accounts()
+
+            store.touch(state, 'synced_block')
             state['synced_block'] = to_block
-            with open('state.json', 'w') as f:
-                f.write(json.dumps(state))
+            with metrics.STAGE_SECONDS.time(stage='persist'):
+                store.commit(state, headers[-1]['hash'])
+            # kept until the commit, a rollback undoes the funding rates read for them
+            traders_missing_funding_rate.clear()
+            if archive is not None and raw_logs is not None:
+                archive.add(from_block, to_block, raw_logs)
+            metrics.SYNCED_BLOCK.set(to_block)
+            update_state_metrics()
             success = True
 
+        except ChainReorganized as e:
+            store.rollback(state)
+            reset_market_constants()
+            print(f'{e}\n')
+            handle_reorg()
         except TimeoutError:
+            # undo everything applied in this try to avoid events being processed twice on the retry
+            store.rollback(state)
+            reset_market_constants()
             print('Timeout error\n')
-
-def sync_all_events(to_block):
-    logs = []
-    logs.extend(clearinghouse_contract.events.ClearingHouseParametersChanged.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-    logs.extend(vault_contract.events.CollateralAdded.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-    logs.extend(vault_contract.events.CollateralWeightChanged.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-    logs.extend(clearinghouse_contract.events.MarketRemoved.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-    logs.extend(vault_contract.events.Deposit.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-    logs.extend(vault_contract.events.Withdraw.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-    logs.extend(clearinghouse_contract.events.ChangePosition.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-    logs.extend(clearinghouse_contract.events.LiquidityProvided.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-    logs.extend(clearinghouse_contract.events.LiquidityRemoved.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-    logs.extend(clearinghouse_contract.events.LiquidationCall.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-
-    for idx in state['perps']:
-        logs.extend(perp_contracts[idx].events.FundingPaid.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-        logs.extend(perp_contracts[idx].events.PerpetualParametersChanged.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block))
-
-    logs = sorted(logs, key = lambda x: (x['blockNumber'], x['transactionIndex']))
-
+        except Exception:
+            store.rollback(state)
+            reset_market_constants()
+            raise
+
+# Headers of the first and last block of a range, fetched before its logs so the logs can be checked against them
+def get_headers(from_block, to_block):
+    with metrics.STAGE_SECONDS.time(stage='header_fetch'), hedged():
+        first = web3.eth.get_block(from_block)
+        last = first if to_block == from_block else web3.eth.get_block(to_block)
+    return (first, last)
+
+# The range must build on the last synced block, and its logs must come from the same blocks as its headers
+def check_chain(headers, logs):
+    first, last = headers
+    parent_hash = store.get_block_hash(first['number'] - 1)
+    if parent_hash is not None and first['parentHash'] != parent_hash:
+        raise ChainReorganized(f"Block {first['number']} is not a child of synced block {first['number'] - 1}")
+
+    block_hashes = {first['number']: first['hash'], last['number']: last['hash']}
+    for log in logs:
+        if log['blockNumber'] in block_hashes and log['blockHash'] != block_hashes[log['blockNumber']]:
+            raise ChainReorganized(f"Block {log['blockNumber']} changed while it was fetched")
+
+# Finds the newest synced block still on the chain and undoes everything synced after it
+def handle_reorg():
+    block_hashes = store.get_block_hashes()
+    if len(block_hashes) == 0:
+        return
+    for block, block_hash in block_hashes:
+        if web3.eth.get_block(block)['hash'] == block_hash:
+            break
+    else:
+        raise RuntimeError(f'Chain reorganized deeper than the last {REORG_HISTORY} synced ranges, delete state.json and state.journal to resync')
+
+    reorged_block = state['synced_block']
+    if block == reorged_block:
+        return
+    store.revert(state, block)
+    if archive is not None:
+        archive.revert(block)
+    reset_market_constants()
+    metrics.REORGS.inc()
+    metrics.REORGED_BLOCKS.inc(reorged_block - block)
+    print(f'Rolled back blocks {block + 1} to {reorged_block}\n')
+
+    # Positions and prices may be back to anything, every account is checked again
+    dirty_markets.update(state['perps'])
+    price_moved_markets.update(state['perps'])
+
+# Logs are requested without web3's result formatters, so the filter is already in the node's format
+def get_log_filter(from_block, to_block, addresses, topics):
+    return {
+        'fromBlock': hex(from_block),
+        'toBlock': hex(to_block),
+        'address': addresses,
+        'topics': [topics]
+    }
+
+# The node returns logs in block order, only logs merged from several requests need sorting
+def sort_logs(logs):
+    return sorted(logs, key = lambda x: (x['blockNumber'], x['transactionIndex'], x['logIndex']))
+
+def fetch_raw_logs(w3, from_block, to_block, addresses, topics):
+    with metrics.STAGE_SECONDS.time(stage='log_fetch'):
+        return w3.manager.request_blocking('eth_getLogs', [get_log_filter(from_block, to_block, addresses, topics)])
+
+def fetch_logs(w3, from_block, to_block, addresses, topics):
+    return list(log_decoder.decode(fetch_raw_logs(w3, from_block, to_block, addresses, topics)))
+
+# Returns the raw logs of the range, for the log archive, and the decoded ones
+def get_all_logs(from_block, to_block):
+    perp_addresses = [state['perps'][idx]['address'] for idx in state['perps']]
+    raw_logs = fetch_raw_logs(web3, from_block, to_block, [clearinghouse_contract.address, vault_contract.address] + perp_addresses, log_decoder.get_topics())
+    logs = list(log_decoder.decode(raw_logs))
+
+    # Perpetuals listed within the range aren't known yet, so their events need a second request
+    new_perp_addresses = [log['args']['perpetual'] for log in logs if log['event'] == 'MarketAdded']
+    if len(new_perp_addresses) > 0:
+        new_raw_logs = fetch_raw_logs(web3, from_block, to_block, new_perp_addresses, perp_topics)
+        raw_logs = raw_logs + new_raw_logs
+        logs = sort_logs(logs + list(log_decoder.decode(new_raw_logs)))
+
+    return (raw_logs, logs)
+
+# Fetches the logs and the snapshot of the known markets concurrently over the async connection, the result is passed on to sync()
+async def fetch_block_data(async_web3, async_multicall, to_block):
+    from_block = state['synced_block'] + 1
+    markets = list(state['perps'])
+    perp_addresses = [state['perps'][idx]['address'] for idx in markets]
+
+    # Each request is timed as its own stage, the snapshot as sync_perps like when sync_perps reads it itself
+    stage_seconds = metrics.STAGE_SECONDS
+    with hedged():
+        raw_logs, snapshot_results, *headers = await asyncio.gather(
+            stage_seconds.time_awaitable(
+                async_web3.manager.coro_request('eth_getLogs', [get_log_filter(from_block, to_block, [clearinghouse_contract.address, vault_contract.address] + perp_addresses, log_decoder.get_topics())]),
+                stage='log_fetch'
+            ),
+            stage_seconds.time_awaitable(async_multicall.call_async(get_perp_snapshot_calls(markets), to_block), stage='sync_perps'),
+            stage_seconds.time_awaitable(
+                asyncio.gather(*[async_web3.eth.get_block(block) for block in sorted(set([from_block, to_block]))]),
+                stage='header_fetch'
+            )
+        )
+        headers = headers[0]
+        logs = list(log_decoder.decode(raw_logs))
+
+        new_perp_addresses = [log['args']['perpetual'] for log in logs if log['event'] == 'MarketAdded']
+        if len(new_perp_addresses) > 0:
+            with stage_seconds.time(stage='log_fetch'):
+                new_raw_logs = await async_web3.manager.coro_request('eth_getLogs', [get_log_filter(from_block, to_block, new_perp_addresses, perp_topics)])
+            raw_logs = raw_logs + new_raw_logs
+            logs = sort_logs(logs + list(log_decoder.decode(new_raw_logs)))
+
+    return (raw_logs, logs, parse_perp_snapshot(markets, snapshot_results), (headers[0], headers[-1]))
+
+# Fetches every followed log of [from_block, to_block] in parallel chunks, yielded in block order as (start, end, raw logs).
+# Perpetuals listed since market_from_block are looked up first, so that all chunks can be fetched with the full address set.
+def fetch_raw_chunks(from_block, to_block, market_from_block):
+    perp_addresses = [state['perps'][idx]['address'] for idx in state['perps']]
+    for _, _, market_logs in fetch_in_order(
+            lambda start, end: fetch_logs(backfill_web3, start, end, [clearinghouse_contract.address], log_decoder.get_topics(['MarketAdded'])),
+            market_from_block, to_block, BACKFILL_WORKERS, BACKFILL_INITIAL_CHUNK, label='Backfill markets'
+        ):
+        perp_addresses.extend(log['args']['perpetual'] for log in market_logs)
+
+    addresses = [clearinghouse_contract.address, vault_contract.address] + list(dict.fromkeys(perp_addresses))
+    topics = log_decoder.get_topics()
+    yield from fetch_in_order(
+        lambda start, end: fetch_raw_logs(backfill_web3, start, end, addresses, topics),
+        from_block, to_block, BACKFILL_WORKERS, BACKFILL_INITIAL_CHUNK, label='Backfill events'
+    )
+
+def backfill(to_block):
+    from_block = state['synced_block'] + 1
+    # LP positions are refreshed once at the end, as for a single range
     lp_update_list = []
+
+    # Blocks already in the log archive are replayed from disk, only the rest is fetched from the node
+    replay_to = archive.get_replay_end(from_block, to_block) if archive is not None else from_block - 1
+    if replay_to >= from_block:
+        print(f'Replaying blocks {from_block} to {replay_to} from the log archive')
+        apply_events(add_markets(log_decoder.decode(archive.read(from_block, replay_to))), lp_update_list)
+
+    # The workers only fetch, each chunk is decoded as it is applied so its logs never all exist decoded at once
+    if replay_to < to_block:
+        print(f'Backfilling blocks {replay_to + 1} to {to_block}')
+        for start, end, raw_logs in fetch_raw_chunks(replay_to + 1, to_block, replay_to + 1):
+            apply_events(add_markets(log_decoder.decode(raw_logs)), lp_update_list)
+            if archive is not None:
+                archive.add(start, end, raw_logs)
+        if archive is not None:
+            archive.flush()
+
+    sync_perps(to_block)
+    return lp_update_list
+
+# Brings the log archive up to the synced block, when it was turned on for an existing state or the bot stopped
+# before its last chunk was written. Markets are looked up from the deployment on, delisted ones are no longer in the state.
+def fill_archive():
+    end = archive.get_end()
+    from_block = deployment_block + 1 if end is None else end + 1
+    if from_block > state['synced_block']:
+        return
+    print(f"Adding blocks {from_block} to {state['synced_block']} to the log archive")
+    for start, end, raw_logs in fetch_raw_chunks(from_block, state['synced_block'], deployment_block + 1):
+        archive.add(start, end, raw_logs)
+    archive.flush()
+
+# Lists the market of a MarketAdded log as it streams past, before any event of the market is applied
+def add_markets(logs):
     for log in logs:
-        log_type = log['event']
-        if log_type == 'ClearingHouseParametersChanged':
-            handle_clearinghouse_parameters_changed(log)
-        elif log_type == 'PerpetualParametersChanged':
-            handle_perpetual_parameters_changed(log)
-        elif log_type == 'CollateralAdded':
-            handle_collateral_added(log)
-        elif log_type == 'CollateralWeightChanged':
-            handle_collateral_weight_changed(log)
-        elif log_type == 'MarketRemoved':
-            handle_market_removed(log)
-        elif log_type == 'Deposit':
-            handle_deposit(log)
-        elif log_type == 'Withdraw':
-            handle_withdraw(log)
-        elif log_type == 'ChangePosition':
-            handle_change_position(log)
-        elif log_type == 'LiquidityProvided':
-            handle_liquidity_added(log, lp_update_list)
-        elif log_type == 'LiquidityRemoved':
-            handle_liquidity_removed(log, lp_update_list)
-        elif log_type == 'FundingPaid':
-            handle_funding(log)
-        elif log_type == 'LiquidationCall':
-            handle_liquidation(log, lp_update_list)
-        else:
-            print('Something going very wrong, got unrecognized logs:')
-            print(log)
-            exit()
+        if log['event'] == 'MarketAdded':
+            sync_markets_added([log])
+        yield log
 
-    for lp in lp_update_list:
+# Returns the (idx, account) of the LP positions to refresh
+def sync_all_events(logs):
+    lp_update_list = []
+    apply_events(logs, lp_update_list)
+    return lp_update_list
+
+def apply_events(logs, lp_update_list):
+    handlers = {
+        **EVENT_HANDLERS,
+        'LiquidityProvided': lambda event_log: handle_liquidity_added(event_log, lp_update_list),
+        'LiquidityRemoved': lambda event_log: handle_liquidity_removed(event_log, lp_update_list),
+        'LiquidationCall': lambda event_log: handle_liquidation(event_log, lp_update_list)
+    }
+
+    with metrics.STAGE_SECONDS.time(stage='event_apply'):
+        for log in logs:
+            handler = handlers.get(log['event'])
+            if handler is None:
+                print('Something going very wrong, got unrecognized logs:')
+                print(log)
+                exit()
+            handler(log)
+
+# The LP positions changed by the events and the funding rate of new trader positions, read in one multicall
+def refresh_positions(lp_update_list, block_number):
+    missing = get_traders_missing_funding_rate()
+    calls = [perp_contracts[idx].functions.getLpPosition(account) for idx, account in lp_update_list]
+    calls += [perp_contracts[idx].functions.getTraderPosition(trader) for idx, trader in missing]
+    with metrics.STAGE_SECONDS.time(stage='position_refresh'):
+        results = multicall.call(calls, block_number)
+
+    refresh_lp_positions(lp_update_list, results[:len(lp_update_list)])
+    refresh_trader_funding_rates(missing, results[len(lp_update_list):])
+
+def refresh_lp_positions(lp_update_list, lp_positions):
+    for lp, lp_position in zip(lp_update_list, lp_positions):
         idx = lp[0]
         account = lp[1]
-        lp_position = perp_contracts[idx].functions.getLpPosition(account).call()
 
+        store.touch(state, 'lp_positions', idx, account)
         state['lp_positions'][idx][account]['open_notional'] = lp_position[0]
         state['lp_positions'][idx][account]['position_size'] = lp_position[1]
         state['lp_positions'][idx][account]['liquidity_balance'] = lp_position[2]
@@ -162,32 +600,86 @@ def sync_all_events(to_block):
         state['lp_positions'][idx][account]['total_base_fees_growth'] = lp_position[5]
         state['lp_positions'][idx][account]['total_trading_fees_growth'] = lp_position[4]
 
+# New trader positions aren't told their funding rate by ChangePosition
+def get_traders_missing_funding_rate():
+    return [
+        (idx, trader) for idx, trader in traders_missing_funding_rate
+        if idx in state['trader_positions'] and trader in state['trader_positions'][idx]
+            and 'cumulative_funding_rate' not in state['trader_positions'][idx][trader]
+    ]
+
+def refresh_trader_funding_rates(missing, trader_positions):
+    for (idx, trader), trader_position in zip(missing, trader_positions):
+        store.touch(state, 'trader_positions', idx, trader)
+        state['trader_positions'][idx][trader]['cumulative_funding_rate'] = trader_position[2]
+
+# Reserve entries and zero balances are removed by evict_inactive_accounts, so either may be missing
+def add_to_reserves(account, asset, amount):
+    store.touch(state, 'reserves', account)
+    if account not in state['reserves']:
+        state['reserves'][account] = {}
+    balances = state['reserves'][account]
+    balances[asset] = balances.get(asset, 0) + amount
+
+# Accounts whose reserves or positions were changed by the range being synced, including those of delisted markets
+def get_changed_accounts():
+    accounts = set()
+    for path, original in store.get_touched():
+        if path[0] == 'reserves' and len(path) == 2:
+            accounts.add(path[1])
+        elif path[0] in ['trader_positions', 'lp_positions']:
+            if len(path) == 3:
+                accounts.add(path[2])
+            elif len(path) == 2 and isinstance(original, dict):
+                accounts.update(original)
+    return accounts
+
+# Accounts left with nothing by the range are dropped from the state before it is committed, see evict_inactive
+def evict_inactive_accounts():
+    evicted = evict_inactive(state, get_changed_accounts(), lambda *path: store.touch(state, *path))
+    metrics.ACCOUNTS_EVICTED.inc(len(evicted))
+
+def update_state_metrics():
+    metrics.STATE_ENTRIES.set(account_registry.get_account_count(), section='accounts')
+    metrics.STATE_ENTRIES.set(len(state['reserves']), section='reserves')
+    metrics.STATE_ENTRIES.set(sum(len(positions) for positions in state['trader_positions'].values()), section='trader_positions')
+    metrics.STATE_ENTRIES.set(sum(len(positions) for positions in state['lp_positions'].values()), section='lp_positions')
+
 def handle_clearinghouse_parameters_changed(event_log):
     args = event_log['args']
+    for key in ['min_margin', 'ua_debt_seizure_threshold', 'non_ua_coll_seizure_discount', 'liquidation_reward', 'liquidation_reward_insurance_share']:
+        store.touch(state, key)
     state['min_margin'] = args['newMinMargin']
     state['ua_debt_seizure_threshold'] = args['uaDebtSeizureThreshold']
     state['non_ua_coll_seizure_discount'] = args['nonUACollSeizureDiscount']
     state['liquidation_reward'] = args['newLiquidationReward']
     state['liquidation_reward_insurance_share'] = args['newLiquidationRewardInsuranceShare']
+    dirty_markets.update(state['perps'])
 
 def handle_perpetual_parameters_changed(event_log):
     args = event_log['args']
     address = event_log['address']
     idx = addresses_to_idx[address]
+    store.touch(state, 'perps', idx)
     state['perps'][idx]['risk_weight'] = args['newRiskWeight']
     state['perps'][idx]['lp_debt_coef'] = args['newLpDebtCoef']
+    refresh_market_constants([idx])
+    dirty_markets.add(idx)
 
 def handle_collateral_added(event_log):
     args = event_log['args']
     asset = args['asset']
     weight = args['weight']
+    store.touch(state, 'reserve_weights', asset)
     state['reserve_weights'][asset] = weight
 
 def handle_collateral_weight_changed(event_log):
     args = event_log['args']
     asset = args['asset']
     weight = args['newWeight']
+    store.touch(state, 'reserve_weights', asset)
     state['reserve_weights'][asset] = weight
+    dirty_markets.update(state['perps'])
 
 def handle_deposit(event_log):
     args = event_log['args']
@@ -195,13 +687,8 @@ def handle_deposit(event_log):
     asset = args['asset']
     amount = args['amount']
 
-    if user not in state['reserves']:
-        state['reserves'][user] = {}
-
-    if asset not in state['reserves'][user]:
-        state['reserves'][user][asset] = 0
-
-    state['reserves'][user][asset] += amount
+    add_to_reserves(user, asset, amount)
+    dirty_accounts.add(user)
 
 def handle_withdraw(event_log):
     args = event_log['args']
@@ -209,12 +696,20 @@ def handle_withdraw(event_log):
     asset = args['asset']
     amount = args['amount']
 
-    state['reserves'][user][asset] -= amount
+    add_to_reserves(user, asset, -amount)
+    dirty_accounts.add(user)
 
 def handle_market_removed(event_log):
     args = event_log['args']
     idx = str(args['delistedIdx'])
+    store.touch(state, 'trader_positions', idx)
+    store.touch(state, 'lp_positions', idx)
+    store.touch(state, 'perps', idx)
+    # Losing the market's PnL and debt can change the health of everyone who had a position in it
+    dirty_accounts.update(state['trader_positions'][idx])
+    dirty_accounts.update(state['lp_positions'][idx])
     del state['trader_positions'][idx]
+    del state['lp_positions'][idx]
     del state['perps'][idx]
 
 def handle_funding(event_log):
@@ -225,17 +720,14 @@ def handle_funding(event_log):
     is_trader = args['isTrader']
     new_cumulative_funding = args['globalCumulativeFundingRate']
 
-    if account not in state['reserves']:
-        state['reserves'][account] = {}
+    add_to_reserves(account, state['ua_address'], amount)
+    dirty_accounts.add(account)
 
-    if state['ua_address'] not in state['reserves'][account]:
-        state['reserves'][account][state['ua_address']] = 0
-
-    state['reserves'][account][state['ua_address']] += amount
-    
     if is_trader and account in state['trader_positions'][idx]:
+        store.touch(state, 'trader_positions', idx, account)
         state['trader_positions'][idx][account]['cumulative_funding_rate'] = new_cumulative_funding
     elif not is_trader and account in state['lp_positions'][idx]:
+        store.touch(state, 'lp_positions', idx, account)
         state['lp_positions'][idx][account]['cumulative_funding_rate_per_lp_token'] = new_cumulative_funding
 
 def handle_change_position(event_log):
@@ -249,7 +741,9 @@ def handle_change_position(event_log):
     profit = args['profit']
     trading_fees_payed = args['tradingFeesPayed']
 
-    state['reserves'][user][state['ua_address']] += profit
+    store.touch(state, 'trader_positions', idx, user)
+    add_to_reserves(user, state['ua_address'], profit)
+    dirty_accounts.add(user)
 
     if not is_position_increased:
         added_open_notional -= profit + trading_fees_payed
@@ -259,6 +753,7 @@ def handle_change_position(event_log):
             'open_notional': 0,
             'position_size': 0
         }
+        traders_missing_funding_rate.add((idx, user))
 
     state['trader_positions'][idx][user]['open_notional'] += added_open_notional
     state['trader_positions'][idx][user]['position_size'] += added_position_size
@@ -271,7 +766,9 @@ def handle_liquidity_added(event_log, lp_update_list):
     idx = str(args['idx'])
     provider = args['liquidityProvider']
     fees_earned = args['tradingFeesEarned']
-    state['reserves'][provider][state['ua_address']] += fees_earned
+    store.touch(state, 'lp_positions', idx, provider)
+    add_to_reserves(provider, state['ua_address'], fees_earned)
+    dirty_accounts.add(provider)
 
     if provider not in state['lp_positions'][idx]:
         state['lp_positions'][idx][provider] = {}
@@ -285,9 +782,12 @@ def handle_liquidity_removed(event_log, lp_update_list):
     provider = args['liquidityProvider']
     profit = args['profit']
     is_closed = args['isPositionClosed']
-    state['reserves'][provider][state['ua_address']] += profit
+    store.touch(state, 'lp_positions', idx, provider)
+    add_to_reserves(provider, state['ua_address'], profit)
+    dirty_accounts.add(provider)
     if is_closed:
-        del state['lp_positions'][idx][provider]
+        # May already be gone, evicted as empty when it was read after the liquidity was removed
+        state['lp_positions'][idx].pop(provider, None)
         if (idx, provider) in lp_update_list:
             lp_update_list.remove((idx, provider))
     elif (idx, provider) not in lp_update_list:
@@ -303,214 +803,357 @@ def handle_liquidation(event_log, lp_update_list):
     profit = args['profit']
     is_trader = args['isTrader']
 
-    liquidation_reward_amount = int(notional / (10**18) * state['liquidation_reward'])
-    insurance_liquidation_reward = int(liquidation_reward_amount / (10**18) * state['liquidation_reward_insurance_share'])
-    liquidator_liquidation_reward = liquidation_reward_amount - insurance_liquidation_reward
-
-    if liquidator not in state['reserves']:
-        state['reserves'][liquidator] = {}
+    liquidator_liquidation_reward = get_liquidator_reward(notional)
 
-    if state['ua_address'] not in state['reserves'][liquidator]:
-        state['reserves'][liquidator][state['ua_address']] = 0
-
-    state['reserves'][liquidator][state['ua_address']] += liquidator_liquidation_reward
-    state['reserves'][liquidatee][state['ua_address']] += profit
+    add_to_reserves(liquidator, state['ua_address'], liquidator_liquidation_reward)
+    add_to_reserves(liquidatee, state['ua_address'], profit)
+    dirty_accounts.update([liquidator, liquidatee])
 
     if is_trader:
+        store.touch(state, 'trader_positions', idx, liquidatee)
         del state['trader_positions'][idx][liquidatee]
     else:
-        del state['lp_positions'][idx][liquidatee]
+        store.touch(state, 'lp_positions', idx, liquidatee)
+        state['lp_positions'][idx].pop(liquidatee, None)
         if (idx, liquidatee) in lp_update_list:
             lp_update_list.remove((idx, liquidatee))
 
     if liquidator == account.address:
+        store.touch(state, 'liquidation_rewards')
         state['liquidation_rewards'] += liquidator_liquidation_reward
         print(f'Detected liquidation with reward of {liquidator_liquidation_reward / (10**18)}')
 
+EVENT_HANDLERS = {
+    'ClearingHouseParametersChanged': handle_clearinghouse_parameters_changed,
+    'PerpetualParametersChanged': handle_perpetual_parameters_changed,
+    'CollateralAdded': handle_collateral_added,
+    'CollateralWeightChanged': handle_collateral_weight_changed,
+    'MarketAdded': lambda event_log: None, # already applied by sync_markets_added before the perps are synced
+    'MarketRemoved': handle_market_removed,
+    'Deposit': handle_deposit,
+    'Withdraw': handle_withdraw,
+    'ChangePosition': handle_change_position,
+    'FundingPaid': handle_funding
+}
 
-def sync_markets_added(to_block):
-    logs = clearinghouse_contract.events.MarketAdded.get_logs(fromBlock=state['synced_block']+1, toBlock=to_block)
-    for event_log in logs:
-        args = event_log['args']
+def sync_markets_added(logs):
+    added = [event_log['args'] for event_log in logs if event_log['event'] == 'MarketAdded']
+    market_details = get_market_details([args['perpetual'] for args in added])
+    for args in added:
         idx = str(args['listedIdx'])
         perp_address = args['perpetual']
+        market_address, market_out_fee = market_details[perp_address]
 
-        market_address = web3.eth.contract(address=perp_address, abi=perp_abi).functions.market().call()
-        market_out_fee = web3.eth.contract(address=market_address, abi=market_abi).functions.out_fee().call()
-
+        store.touch(state, 'trader_positions', idx)
+        store.touch(state, 'lp_positions', idx)
+        store.touch(state, 'perps', idx)
         state['trader_positions'][idx] = {}
         state['lp_positions'][idx] = {}
+        dirty_markets.add(idx)
         state['perps'][idx] = {
             'address': perp_address,
             'market_address': market_address,
             'market_out_fee': market_out_fee
         }
-        
+        refresh_market_constants([idx])
 
+    load_market_contracts()
+
+# Contracts are only built for markets that don't have them yet, building one takes milliseconds
+def load_market_contracts():
     for idx in state['perps']:
+        if idx in perp_contracts and perp_contracts[idx].address == state['perps'][idx]['address']:
+            continue
         addresses_to_idx[state['perps'][idx]['address']] = idx
         perp_contracts[idx] = web3.eth.contract(address=state['perps'][idx]['address'], abi=perp_abi)
+        market_contracts[idx] = web3.eth.contract(address=state['perps'][idx]['market_address'], abi=market_abi)
+
+# Only changed by MarketAdded and PerpetualParametersChanged, so they are worked out once instead of on every health check
+def refresh_market_constants(markets):
+    for idx in markets:
+        perp = state['perps'][idx]
+        market_constants[idx] = {
+            'fees_in_wad': perp['market_out_fee'] * 10**(18 - CURVE_TRADING_FEE_DECIMALS),
+            'risk_weight': perp.get('risk_weight'),
+            'lp_debt_coef': perp.get('lp_debt_coef')
+        }
+
+# After a rollback the parameters may be back to older values
+def reset_market_constants():
+    market_constants.clear()
+    refresh_market_constants(state['perps'])
+
+def get_perp_snapshot_calls(markets):
+    calls = []
+    for idx in markets:
+        calls.extend([
+            perp_contracts[idx].functions.getGlobalPosition(),
+            perp_contracts[idx].functions.indexPrice(),
+            perp_contracts[idx].functions.getTotalLiquidityProvided(),
+            market_contracts[idx].functions.balances(VQUOTE_INDEX),
+            market_contracts[idx].functions.balances(VBASE_INDEX)
+        ])
+    return calls
+
+def parse_perp_snapshot(markets, results):
+    return {idx: results[5*i:5*i+5] for i, idx in enumerate(markets)}
+
+# Reads every market in one multicall, pinned to the block the events were synced to.
+# Markets already read into `snapshot` by fetch_block_data are not read again. The sync_perps stage is that read.
+def sync_perps(block_number, snapshot=None):
+    if snapshot is None:
+        snapshot = {}
+    missing_markets = [idx for idx in state['perps'] if idx not in snapshot]
+    if len(missing_markets) > 0:
+        # Carries the index prices, so it is hedged like the log queries
+        with metrics.STAGE_SECONDS.time(stage='sync_perps'), hedged():
+            snapshot_results = multicall.call(get_perp_snapshot_calls(missing_markets), block_number)
+        snapshot = {**snapshot, **parse_perp_snapshot(missing_markets, snapshot_results)}
 
-def sync_perps():
     for idx in state['perps']:
-        contract = perp_contracts[idx]
-        global_position = contract.functions.getGlobalPosition().call()
+        global_position, index_price, total_liquidity_provided, quote_balance, base_balance = snapshot[idx]
 
+        store.touch(state, 'global_positions', idx)
+        store.touch(state, 'perps', idx)
         if idx not in state['global_positions']:
             state['global_positions'][idx] = {}
 
+        previous_price = state['perps'][idx].get('index_price')
+        previous_cumulative_funding_rate = state['global_positions'][idx].get('cumulative_funding_rate')
+        previous_lp_snapshot = (
+            state['perps'][idx].get('total_liquidity_provided'),
+            state['perps'][idx].get('base_balance'),
+            state['perps'][idx].get('quote_balance'),
+            dict(state['global_positions'][idx])
+        )
+
         state['global_positions'][idx]['cumulative_funding_rate'] = global_position[2]
         state['global_positions'][idx]['cumulative_funding_rate_per_lp_token'] = global_position[5]
         state['global_positions'][idx]['total_quote_fees_growth'] = global_position[9]
         state['global_positions'][idx]['total_base_fees_growth'] = global_position[8]
         state['global_positions'][idx]['total_trading_fees_growth'] = global_position[7]
 
-        index_price = contract.functions.indexPrice().call()
         state['perps'][idx]['index_price'] = index_price
-
-        total_liquidity_provided = contract.functions.getTotalLiquidityProvided().call()
         state['perps'][idx]['total_liquidity_provided'] = total_liquidity_provided
-
-        market_contract = web3.eth.contract(address=state['perps'][idx]['market_address'], abi=market_abi)
-        quote_balance = market_contract.functions.balances(VQUOTE_INDEX).call()
-        base_balance = market_contract.functions.balances(VBASE_INDEX).call()
         state['perps'][idx]['base_balance'] = base_balance
         state['perps'][idx]['quote_balance'] = quote_balance
 
+        # Funding moves every position in the market, pool balances and fee growth only LP positions
+        if global_position[2] != previous_cumulative_funding_rate:
+            dirty_markets.add(idx)
+        elif (total_liquidity_provided, base_balance, quote_balance, state['global_positions'][idx]) != previous_lp_snapshot:
+            dirty_lp_markets.add(idx)
+        if index_price != previous_price:
+            price_moved_markets.add(idx)
+
 
 
 ### HELPER FUNCTIONS ###
 
-def get_pnl_across_markets(trader):
+# The helpers below take the account's (idx, is_trader, record) from get_account_records and read the records'
+# fields directly, going through the state's mappings for every field would cost more than the math
+def get_pnl_across_markets(records):
     trader_pnl = 0
     lp_pnl = 0
-    for idx in state['perps']:
+    for idx, is_trader, record in records:
         oracle_price = state['perps'][idx]['index_price']
+        fees_in_wad = market_constants[idx]['fees_in_wad']
 
-        if trader in state['trader_positions'][idx]:
-            position_size = state['trader_positions'][idx][trader]['position_size']
-            open_notional = state['trader_positions'][idx][trader]['open_notional']
+        if is_trader:
+            position_size = record.position_size
+            open_notional = record.open_notional
 
-            v_quote_virtual_proceeds = int(oracle_price / (10**18) * position_size)
-            fees_in_wad = state['perps'][idx]['market_out_fee'] * 10**(18 - CURVE_TRADING_FEE_DECIMALS)
-            trading_fees = int(abs(v_quote_virtual_proceeds) / (10**18) * fees_in_wad)
+            v_quote_virtual_proceeds = wad_mul(position_size, oracle_price)
+            trading_fees = wad_mul(abs(v_quote_virtual_proceeds), fees_in_wad)
 
             trader_pnl += open_notional + v_quote_virtual_proceeds - trading_fees
+        else:
+            open_notional, position_size = get_lp_record_after_withdrawal(record, idx)
 
-        if trader in state['lp_positions'][idx]:
-            open_notional, position_size = get_lp_position_after_withdrawal(trader, idx)
-
-            v_quote_virtual_proceeds = int(oracle_price / (10**18) * position_size)
-            fees_in_wad = state['perps'][idx]['market_out_fee'] * 10**(18 - CURVE_TRADING_FEE_DECIMALS)
-            trading_fees = int(abs(v_quote_virtual_proceeds) / (10**18) * fees_in_wad)
+            v_quote_virtual_proceeds = wad_mul(position_size, oracle_price)
+            trading_fees = wad_mul(abs(v_quote_virtual_proceeds), fees_in_wad)
 
             unrealized_lp_pnl = open_notional + v_quote_virtual_proceeds - trading_fees
-            lp_pnl += unrealized_lp_pnl + get_lp_trading_fees(trader, idx)
+            lp_pnl += unrealized_lp_pnl + get_lp_trading_fees(record, idx)
             
     return trader_pnl + lp_pnl
 
 
-def get_debt_across_markets(trader):
+def get_debt_across_markets(records):
     trader_debt = 0
     lp_debt = 0
-    for idx in state['perps']:
+    for idx, is_trader, record in records:
         oracle_price = state['perps'][idx]['index_price']
-        risk_weight = state['perps'][idx]['risk_weight']
+        risk_weight = market_constants[idx]['risk_weight']
 
-        if trader in state['trader_positions'][idx]:
-            position_size = state['trader_positions'][idx][trader]['position_size']
-            open_notional = state['trader_positions'][idx][trader]['open_notional']
+        if is_trader:
+            position_size = record.position_size
+            open_notional = record.open_notional
 
             quote_debt = min(open_notional, 0)
-            base_debt = min(int(position_size / (10**18) * oracle_price), 0)
+            base_debt = min(wad_mul(position_size, oracle_price), 0)
 
             market_trader_debt = abs(quote_debt + base_debt)
-            trader_debt += int(market_trader_debt / (10**18) * risk_weight)
-
-        if trader in state['lp_positions'][idx]:
-            position_size = state['lp_positions'][idx][trader]['position_size']
-            open_notional = state['lp_positions'][idx][trader]['open_notional']
+            trader_debt += wad_mul(market_trader_debt, risk_weight)
+        else:
+            position_size = record.position_size
+            open_notional = record.open_notional
 
-            lp_debt_coef = state['perps'][idx]['lp_debt_coef']
+            lp_debt_coef = market_constants[idx]['lp_debt_coef']
 
             quote_debt = min(open_notional, 0)
-            base_debt = min(int(position_size / (10**18) * oracle_price), 0)
+            base_debt = min(wad_mul(position_size, oracle_price), 0)
 
-            market_lp_debt = int(abs(quote_debt + base_debt) / (10**18) * lp_debt_coef)
-            lp_debt += int(market_lp_debt / (10**18) * risk_weight)
+            market_lp_debt = wad_mul(abs(quote_debt + base_debt), lp_debt_coef)
+            lp_debt += wad_mul(market_lp_debt, risk_weight)
 
     return trader_debt + lp_debt
 
 # THIS NEEDS TO BE IMPLEMENTED BETTER FOR MULTI COLLATERAL. SHOULD BE oracle.getPrice() FUNCTION. WILL ONLY WORK FOR UA
 def get_oracle_price(token_address, token_balance):
     if token_address == state['ua_address']:
-        return 1 * (10**18)
+        return WAD
     else:
         return None
 
 def get_reserve_value(trader):
     reserve_value = 0
 
-    for reserve_token in state['reserves'][trader]:
-        balance = state['reserves'][trader][reserve_token]
+    for reserve_token, balance in state['reserves'].get_balances(state['reserves'].get_id(trader)):
         if balance != 0:
-            weighted_balance = int(balance / (10**18) * state['reserve_weights'][reserve_token])
+            weighted_balance = wad_mul(balance, state['reserve_weights'][reserve_token])
             usd_per_unit = get_oracle_price(reserve_token, balance)
-            reserve_value += int(weighted_balance / (10**18) * usd_per_unit)
+            reserve_value += wad_mul(weighted_balance, usd_per_unit)
 
     return reserve_value
 
-def get_total_margin_requirement(trader, ratio):
-    user_debt = get_debt_across_markets(trader)
-    return int(user_debt / (10**18) * ratio)
+def get_total_margin_requirement(records, ratio):
+    user_debt = get_debt_across_markets(records)
+    return wad_mul(user_debt, ratio)
 
-def is_position_valid(address):
+def get_margin_components(address):
     min_margin = state['min_margin']
+    records = get_account_records(address)
 
-    pnl = get_pnl_across_markets(address)
-    pending_funding_payments = get_pending_funding_payments(address)
+    pnl = get_pnl_across_markets(records)
+    pending_funding_payments = get_pending_funding_payments(address, records)
     reserve_value = get_reserve_value(address)
     # note this is different than the actual contract to factor pending funding payments
     total_collateral_value = reserve_value + pending_funding_payments
-    margin_required = get_total_margin_requirement(address, min_margin)
+    margin_required = get_total_margin_requirement(records, min_margin)
+
+    return (total_collateral_value, pnl, margin_required)
 
-    free_collateral = min(total_collateral_value, total_collateral_value + pnl) - margin_required
-    return free_collateral >= -0.05 * (10**18)
+def get_free_collateral(total_collateral_value, pnl, margin_required):
+    return min(total_collateral_value, total_collateral_value + pnl) - margin_required
 
-def get_pending_funding_payments(address):
+def is_position_valid(address):
+    free_collateral = get_free_collateral(*get_margin_components(address))
+    return free_collateral >= MIN_FREE_COLLATERAL
+
+# Rate of change of the account's PnL and margin requirement per unit of index price in one market.
+# Both are linear in the index price, since the sign of the position value can't change while the price is positive.
+def get_price_sensitivity(address, idx):
+    fees = market_constants[idx]['fees_in_wad'] / WAD
+    risk_weight = market_constants[idx]['risk_weight'] / WAD
+    min_margin = state['min_margin'] / WAD
+
+    pnl_slope = 0
+    margin_slope = 0
+
+    if address in state['trader_positions'][idx]:
+        position_size = state['trader_positions'][idx][address]['position_size']
+        pnl_slope += position_size / WAD * (1 - fees if position_size > 0 else 1 + fees)
+        if position_size < 0:
+            margin_slope += -position_size / WAD * risk_weight * min_margin
+
+    if address in state['lp_positions'][idx]:
+        _, position_size = get_lp_position_after_withdrawal(address, idx)
+        pnl_slope += position_size / WAD * (1 - fees if position_size > 0 else 1 + fees)
+
+        lp_debt_coef = market_constants[idx]['lp_debt_coef'] / WAD
+        lp_position_size = state['lp_positions'][idx][address]['position_size']
+        if lp_position_size < 0:
+            margin_slope += -lp_position_size / WAD * lp_debt_coef * risk_weight * min_margin
+
+    return (pnl_slope, margin_slope)
+
+# For each market the account has positions in, the range of index prices over which it stays healthy if
+# no other market moves. Free collateral is min(collateral - margin, collateral + pnl - margin), so it is
+# concave in the price and the healthy prices always form a single interval.
+def get_liquidation_prices(address, markets, total_collateral_value, pnl, margin_required):
+    collateral_slack = total_collateral_value - margin_required - MIN_FREE_COLLATERAL
+    pnl_slack = total_collateral_value + pnl - margin_required - MIN_FREE_COLLATERAL
+
+    liquidation_prices = {}
+    for idx in markets:
+        pnl_slope, margin_slope = get_price_sensitivity(address, idx)
+        price = state['perps'][idx]['index_price']
+
+        lower_price = float('-inf')
+        upper_price = float('inf')
+        for slack, slope in [(collateral_slack, -margin_slope), (pnl_slack, pnl_slope - margin_slope)]:
+            if slope > 0:
+                lower_price = max(lower_price, price - slack / slope)
+            elif slope < 0:
+                upper_price = min(upper_price, price + slack / -slope)
+
+        buffer = abs(price) * LIQUIDATION_PRICE_BUFFER
+        liquidation_prices[idx] = (lower_price + buffer, upper_price - buffer)
+
+    return liquidation_prices
+
+def index_liquidation_prices(address, liquidation_prices):
+    for idx in indexed_markets.get(address, set()) - set(liquidation_prices):
+        liquidation_price_indices[idx].remove(address)
+
+    shared = len(liquidation_prices) > 1
+    for idx, (lower_price, upper_price) in liquidation_prices.items():
+        if idx not in liquidation_price_indices:
+            liquidation_price_indices[idx] = LiquidationPriceIndex()
+        liquidation_price_indices[idx].update(address, lower_price, upper_price, shared)
+    indexed_markets[address] = set(liquidation_prices)
+
+def unindex_liquidation_prices(address):
+    for idx in indexed_markets.pop(address, set()):
+        liquidation_price_indices[idx].remove(address)
+
+def get_pending_funding_payments(address, records):
     trader_funding = 0
     lp_funding = 0
 
-    for idx in state['perps']:
-        if address in state['trader_positions'][idx]:
-            position_size = state['trader_positions'][idx][address]['position_size']
-            if 'cumulative_funding_rate' not in state['trader_positions'][idx][address]:
-                state['trader_positions'][idx][address]['cumulative_funding_rate'] = perp_contracts[idx].functions.getTraderPosition(address).call()[2]
-            user_cumulative_funding_rate = state['trader_positions'][idx][address]['cumulative_funding_rate']
+    for idx, is_trader, record in records:
+        if is_trader:
+            position_size = record.position_size
+            user_cumulative_funding_rate = getattr(record, 'cumulative_funding_rate', None)
+            if user_cumulative_funding_rate is None:
+                raise RuntimeError(f'Trader {address} on market {idx} has no cumulative funding rate, it should have been read during sync')
             global_cumulative_funding_rate = state['global_positions'][idx]['cumulative_funding_rate']
 
             if position_size > 0:
                 funding_rate = user_cumulative_funding_rate - global_cumulative_funding_rate
             else:
                 funding_rate = global_cumulative_funding_rate - user_cumulative_funding_rate
-            trader_funding += int(funding_rate / (10**18) * abs(position_size))
-
-        if address in state['lp_positions'][idx]:
-            liquidity_balance = state['lp_positions'][idx][address]['liquidity_balance']
-            user_cumulative_funding_rate_per_lp_token = state['lp_positions'][idx][address]['cumulative_funding_rate_per_lp_token']
+            trader_funding += wad_mul(funding_rate, abs(position_size))
+        else:
+            liquidity_balance = record.liquidity_balance
+            user_cumulative_funding_rate_per_lp_token = record.cumulative_funding_rate_per_lp_token
             global_cumulative_funding_rate_per_lp_token = state['global_positions'][idx]['cumulative_funding_rate_per_lp_token']
 
-            lp_funding += int((global_cumulative_funding_rate_per_lp_token - user_cumulative_funding_rate_per_lp_token) / (10**18) * liquidity_balance)
+            lp_funding += wad_mul(global_cumulative_funding_rate_per_lp_token - user_cumulative_funding_rate_per_lp_token, liquidity_balance)
 
     return trader_funding + lp_funding
 
 
 def get_lp_position_after_withdrawal(lp_address, idx):
-    lp_open_notional = state['lp_positions'][idx][lp_address]['open_notional']
-    lp_position_size = state['lp_positions'][idx][lp_address]['position_size']
-    lp_liquidity_balance = state['lp_positions'][idx][lp_address]['liquidity_balance']
-    lp_total_quote_fees_growth = state['lp_positions'][idx][lp_address]['total_quote_fees_growth']
-    lp_total_base_fees_growth = state['lp_positions'][idx][lp_address]['total_base_fees_growth']
+    return get_lp_record_after_withdrawal(state['lp_positions'][idx][lp_address], idx)
+
+def get_lp_record_after_withdrawal(record, idx):
+    lp_open_notional = record.open_notional
+    lp_position_size = record.position_size
+    lp_liquidity_balance = record.liquidity_balance
+    lp_total_quote_fees_growth = record.total_quote_fees_growth
+    lp_total_base_fees_growth = record.total_base_fees_growth
     
     global_total_quote_fees_growth = state['global_positions'][idx]['total_quote_fees_growth']
     global_total_base_fees_growth = state['global_positions'][idx]['total_base_fees_growth']
@@ -551,86 +1194,338 @@ def get_virtual_tokens_withdrawn_from_curve_pool(
     if total_liquidity_provided == 0:
         return (0, 0)
 
-    tokens_incl_fees = ((lp_tokens_liquidity_provider - 1) * curve_pool_balance) / total_liquidity_provided
-    tokens_ex_fees = int(tokens_incl_fees / (10**18 + global_virtual_token_total_growth - user_virtual_token_growth_rate) * (10**18))
+    tokens_incl_fees = mul_div(lp_tokens_liquidity_provider - 1, curve_pool_balance, total_liquidity_provided)
+    tokens_ex_fees = wad_div(tokens_incl_fees, WAD + global_virtual_token_total_growth - user_virtual_token_growth_rate)
 
     return (tokens_ex_fees, tokens_incl_fees)
 
-def get_lp_trading_fees(lp_address, idx):
-    liquidity_balance = state['lp_positions'][idx][lp_address]['liquidity_balance']
-    fee_growth_difference = state['global_positions'][idx]['total_trading_fees_growth'] - state['lp_positions'][idx][lp_address]['total_trading_fees_growth']
-    return int(liquidity_balance / (10**18) * fee_growth_difference)
+def get_lp_trading_fees(record, idx):
+    liquidity_balance = record.liquidity_balance
+    fee_growth_difference = state['global_positions'][idx]['total_trading_fees_growth'] - record.total_trading_fees_growth
+    return wad_mul(liquidity_balance, fee_growth_difference)
 
-# Submits transaction
-def liquidate_position(address, idx, is_trader):
-    proposed_amount = None
-    try:
-        if is_trader:
-            proposed_amount = clearinghouse_viewer_contract.functions.getTraderProposedAmount(idx, address, int(1e18), 100, 0).call()
-        else:
-            proposed_amount = clearinghouse_viewer_contract.functions.getLpProposedAmount(idx, address, int(1e18), 100, [0,0], 0).call()
-    except Exception as e:
-        print(f'Fail: Position: {clearinghouse_viewer_contract.functions.getTraderPosition(idx, address).call()}')
+# The liquidator's part of the reward for liquidating a position of this notional
+def get_liquidator_reward(notional):
+    liquidation_reward_amount = wad_mul(notional, state['liquidation_reward'])
+    insurance_liquidation_reward = wad_mul(liquidation_reward_amount, state['liquidation_reward_insurance_share'])
+    return liquidation_reward_amount - insurance_liquidation_reward
 
-    if proposed_amount is not None:
-
-        if is_trader:
-            unsigned_tx = clearinghouse_contract.functions.liquidateTrader(idx, address, proposed_amount, 0).build_transaction(transaction_dict)
-        else:
-            unsigned_tx = clearinghouse_contract.functions.liquidateLp(idx, address, [0,0], proposed_amount, 0).build_transaction(transaction_dict)
-
-        signed_tx = web3.eth.account.sign_transaction(unsigned_tx, account.key)
+def get_position_notional(address, idx, is_trader):
+    if is_trader:
+        position_size = state['trader_positions'][idx][address]['position_size']
+    else:
+        _, position_size = get_lp_position_after_withdrawal(address, idx)
+    return abs(wad_mul(position_size, state['perps'][idx]['index_price']))
+
+# (idx, is_trader) of each open position of the account, from the index kept by the position tables
+def get_account_positions(address):
+    return [(idx, is_trader) for idx, is_trader in account_registry.get_positions(address) if idx in state['perps']]
+
+# (idx, is_trader, record) of each open position of the account, the id is looked up once for all of them
+def get_account_records(address):
+    account_id = account_registry.ids.get(address)
+    if account_id is None:
+        return []
+    return [
+        (idx, is_trader, (state['trader_positions'] if is_trader else state['lp_positions']).get_record(idx, account_id))
+        for idx, is_trader in account_registry.positions.get(account_id, ())
+        if idx in state['perps']
+    ]
+
+# Only the accounts of `shard`, the (shard, shard count) of a worker, if given
+def get_accounts_to_check(shard=None):
+    for idx in list(liquidation_price_indices):
+        if idx not in state['perps']:
+            for address in liquidation_price_indices.pop(idx).bounds:
+                indexed_markets[address].discard(idx)
+
+    accounts = set(dirty_accounts)
+    for idx in dirty_markets:
+        if idx in state['perps']:
+            accounts.update(state['trader_positions'][idx])
+            accounts.update(state['lp_positions'][idx])
+    for idx in dirty_lp_markets - dirty_markets:
+        if idx in state['perps']:
+            accounts.update(state['lp_positions'][idx])
+    for idx in price_moved_markets - dirty_markets:
+        if idx in liquidation_price_indices:
+            accounts.update(liquidation_price_indices[idx].get_candidates(state['perps'][idx]['index_price']))
+    for idx in unindexed_markets - dirty_markets:
+        if idx in state['perps']:
+            for positions in [state['trader_positions'][idx], state['lp_positions'][idx]]:
+                accounts.update(address for address in positions if idx not in indexed_markets.get(address, ()))
+    accounts.update(watchlist)
+    accounts.update(deferred_accounts)
+    if shard is not None:
+        accounts = set(address for address in accounts if get_shard(address, shard[1]) == shard[0])
+
+    dirty_accounts.clear()
+    dirty_markets.clear()
+    dirty_lp_markets.clear()
+    price_moved_markets.clear()
+    unindexed_markets.clear()
+    return accounts
+
+# Safety net in case something changed that the sync didn't mark as dirty. With numpy the whole book is
+# evaluated at once and only the accounts it flags get the exact check, otherwise every account is checked.
+# Accounts that were never checked are checked either way, price moves only find the ones with a liquidation price.
+def sweep_all_accounts():
+    if margin_engine.available():
         try:
-            tx_hash = web3.eth.send_raw_transaction(signed_tx.rawTransaction)
-            receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
-            transaction_dict['nonce'] += 1
-            return receipt['status']
-        except ValueError:
-            transaction_dict['nonce'] = web3.eth.get_transaction_count(account.address)
-            print('Attempted liquidation but nonce was incorrect. Will retry soon.\n')
-
-    return 0
+            dirty_accounts.update(MarginBook.from_state(state).find_unhealthy(MIN_FREE_COLLATERAL))
+            unindexed_markets.update(state['perps'])
+            return
+        except ValueError as e:
+            print(f'Vectorized sweep failed, checking every account: {e}\n')
+    dirty_markets.update(state['perps'])
+
+# Who would be liquidatable if the index price of every market, or only of `markets`, moved by each of `shocks`,
+# fractions such as -0.05. Evaluated on the in-memory state for all shocks at once, see MarginBook.run_scenarios.
+def get_price_shock_scenarios(shocks, markets=None, exact=False):
+    if not margin_engine.available():
+        raise RuntimeError('Price shock scenarios need numpy')
+    markets = list(state['perps']) if markets is None else markets
+    scenarios = [{idx: shock for idx in markets} for shock in shocks]
+    return MarginBook.from_state(state).run_scenarios(
+        scenarios, MIN_FREE_COLLATERAL, state['liquidation_reward'], state['liquidation_reward_insurance_share'], exact
+    )
+
+# Runs in a worker thread, the block's liquidations are handed to the event loop as one batch without waiting for them
+def check_accounts(loop, full_sweep=False, received_at=None):
+    hot_path.active = True
+    try:
+        with metrics.STAGE_SECONDS.time(stage='health_scan'):
+            if full_sweep:
+                sweep_all_accounts()
+            candidates = find_liquidation_candidates()
+    finally:
+        hot_path.active = False
+    metrics.CANDIDATES.set(len(candidates))
+
+    if len(candidates) > 0:
+        loop.call_soon_threadsafe(submitter.submit_batch, candidates, received_at)
+
+# Free collateral above MIN_FREE_COLLATERAL as a fraction of the margin requirement, negative when liquidatable
+def get_margin_slack(free_collateral, margin_required):
+    return (free_collateral - MIN_FREE_COLLATERAL) / max(margin_required, 1)
+
+# Returns (address, idx, is_trader, priority) for every position of an unhealthy account, highest priority first.
+# The priority is the expected reward, raised the further the account is below its margin requirement.
+def find_liquidation_candidates():
+    if shard_pool is None:
+        candidates, checked, deferred = check_health(get_accounts_to_check())
+        watched = len(watchlist)
+    else:
+        candidates, checked, deferred, watched = check_shards()
+
+    metrics.ACCOUNTS_EVALUATED.set(checked)
+    metrics.ACCOUNTS_EVALUATED_TOTAL.inc(checked)
+    metrics.ACCOUNTS_DEFERRED.inc(deferred)
+    metrics.WATCHLIST_SIZE.set(watched)
+    if deferred > 0:
+        print(f'Health check budget used up, {deferred} accounts left for the next block\n')
+    return candidates
+
+# Checks the accounts within HEALTH_CHECK_BUDGET, returns the candidates, the number of accounts checked and the
+# number left for the next block
+def check_health(accounts):
+    candidates = []
+    start = time.perf_counter()
+
+    # Each account is only checked once, however many markets it has positions in. Watched accounts go first,
+    # closest to liquidation first, then those the last block's budget didn't reach, in the order they were left in.
+    watched = sorted((address for address in accounts if address in watchlist), key=watchlist.get)
+    deferred = [address for address in deferred_accounts if address in accounts and address not in watchlist]
+    ordered = watched + deferred
+    first = set(ordered)
+    ordered += [address for address in accounts if address not in first]
+
+    checked = 0
+    for address in ordered:
+        if time.perf_counter() - start > HEALTH_CHECK_BUDGET:
+            break
+        checked += 1
+
+        positions = get_account_positions(address)
+        if len(positions) == 0:
+            unindex_liquidation_prices(address)
+            watchlist.pop(address, None)
+            continue
+
+        margin_components = get_margin_components(address)
+        free_collateral = get_free_collateral(*margin_components)
+        slack = get_margin_slack(free_collateral, margin_components[2])
+        if free_collateral >= MIN_FREE_COLLATERAL:
+            markets = set(idx for idx, _ in positions)
+            index_liquidation_prices(address, get_liquidation_prices(address, markets, *margin_components))
+            if slack < WATCHLIST_SLACK:
+                watchlist[address] = slack
+            else:
+                watchlist.pop(address, None)
+            continue
+
+        unindex_liquidation_prices(address)
+        # Capped at the whole margin requirement, for accounts with next to no debt the slack is meaningless
+        urgency = 1 + URGENCY_WEIGHT * min(-slack, 1)
+        for idx, is_trader in positions:
+            candidates.append((address, idx, is_trader, get_liquidator_reward(get_position_notional(address, idx, is_trader)) * urgency))
+
+        # Recheck next block, whether or not the liquidation went through
+        dirty_accounts.add(address)
+        watchlist[address] = slack
+
+    deferred_accounts[:] = ordered[checked:]
+    return (sorted(candidates, key=lambda candidate: candidate[3], reverse=True), checked, len(deferred_accounts))
+
+def start_shards():
+    global shard_pool
+    if HEALTH_CHECK_SHARDS > 0 and shard_pool is None:
+        store.track_changes()
+        # Changes made before the workers are forked are already in their copy of the state
+        store.drain_changes(state)
+        shard_pool = ShardPool(HEALTH_CHECK_SHARDS, check_shard)
+        print(f'Health checks split over {HEALTH_CHECK_SHARDS} workers\n')
+
+def stop_shards():
+    global shard_pool
+    if shard_pool is not None:
+        shard_pool.stop()
+        shard_pool = None
+
+# Sends the state changes and dirty accounts and markets of the block to every worker. Shards don't share
+# accounts, but positions are still deduplicated here so the submitter never gets one twice in a batch.
+def check_shards():
+    message = (store.drain_changes(state), dirty_accounts, dirty_markets, dirty_lp_markets, price_moved_markets, unindexed_markets)
+    try:
+        replies = shard_pool.run(message)
+    except Exception:
+        # The workers' state can't be trusted any more, the next main() starts new ones
+        stop_shards()
+        raise
+    dirty_accounts.clear()
+    dirty_markets.clear()
+    dirty_lp_markets.clear()
+    price_moved_markets.clear()
+    unindexed_markets.clear()
+
+    candidates = {}
+    for shard_candidates, _, _, _ in replies:
+        for candidate in shard_candidates:
+            key = candidate[:3]
+            if key not in candidates or candidate[3] > candidates[key][3]:
+                candidates[key] = candidate
+    candidates = sorted(candidates.values(), key=lambda candidate: candidate[3], reverse=True)
+    return (candidates, sum(reply[1] for reply in replies), sum(reply[2] for reply in replies), sum(reply[3] for reply in replies))
+
+# Runs in the worker of a shard, the counterpart of check_shards
+def check_shard(shard, count, message):
+    changes, accounts, markets, lp_markets, price_moved, unindexed = message
+    apply_changes(state, changes)
+    if any(change[0][0] == 'perps' for change in changes):
+        reset_market_constants()
+
+    dirty_accounts.update(accounts)
+    dirty_markets.update(markets)
+    dirty_lp_markets.update(lp_markets)
+    price_moved_markets.update(price_moved)
+    unindexed_markets.update(unindexed)
+
+    hot_path.active = True
+    try:
+        candidates, checked, deferred = check_health(get_accounts_to_check((shard, count)))
+    finally:
+        hot_path.active = False
+    return (candidates, checked, deferred, len(watchlist))
+
+# Called from the RPC pool's thread for every new block, by whichever endpoint announces it first
+def listen_for_heads(loop, latest_head, new_head):
+    def on_head(number):
+        received_at = time.time()
+        def update():
+            if number > latest_head['number']:
+                latest_head['number'] = number
+                latest_head['received_at'] = received_at
+                new_head.set()
+        loop.call_soon_threadsafe(update)
+    return on_head
+
+async def main():
+    global submitter
+
+    started_at = time.time()
+    submitter = LiquidationSubmitter(async_web3, async_multicall, account, clearinghouse_contract, async_clearinghouse_viewer_contract, transaction_dict, SIMULATE_LIQUIDATIONS)
+    loop = asyncio.get_running_loop()
+    head = await bootstrap()
+    start_shards()
+
+    # Heads are coalesced, if blocks arrive faster than they are processed only the latest one is synced to.
+    # The pool subscribes on every endpoint and resubscribes after reconnecting, so heads keep coming as long as one is up.
+    latest_head = {'number': head, 'received_at': time.time()}
+    new_head = asyncio.Event()
+    new_head.set()
+    on_head = listen_for_heads(loop, latest_head, new_head)
+    await asyncio.to_thread(rpc_pool.subscribe_heads, on_head)
 
-def main():
     last_heartbeat = 0
-    while True:
-        last_block = web3.eth.block_number
-        sync(last_block)
-        for idx in state['perps']:
-
-            # Check trader positions
-            for trader in state['trader_positions'][idx]:
-                if not is_position_valid(trader):
-                    status = liquidate_position(trader, int(idx), True)
-                    print(f'Liquidated trader on market {idx}: {trader}. Liquidation status: {status}.')
-                    if status == 0: # Safety measure to avoid rapid firing failed transactions
-                        time.sleep(60)
-
-            # Check LP positions
-            for lp in state['lp_positions'][idx]:
-                if not is_position_valid(lp):
-                    status = liquidate_position(lp, int(idx), False)
-                    print(f'Liquidated LP on market {idx}: {lp}. Liquidation status: {status}.')
-                    if status == 0: # Safety measure to avoid rapid firing failed transactions
-                        time.sleep(60)
-
-        # Heartbeat
-        if time.time() - last_heartbeat > 90:
-            last_heartbeat = time.time()
-            print(f'Heartbeat at block: {last_block}')
-            print(f"Total earned liquidation rewards: {round(state['liquidation_rewards'] / (10**18), 2)}")
-            print()
-
-        # No point syncing and checking again until the block changes
-        while web3.eth.block_number == last_block:
-            time.sleep(0.1)
+    last_full_sweep = 0
+    try:
+        while True:
+            await new_head.wait()
+            new_head.clear()
+
+            last_block = latest_head['number']
+            received_at = latest_head['received_at']
+            metrics.HEAD_BLOCK.set(last_block)
+            metrics.SYNC_LAG.set(last_block - state['synced_block'])
+            if last_block <= state['synced_block']:
+                continue
+
+            block_data = None
+            if last_block - state['synced_block'] <= BACKFILL_THRESHOLD:
+                try:
+                    block_data = await fetch_block_data(async_web3, async_multicall, last_block)
+                except TimeoutError:
+                    print('Timeout error\n')
+            await asyncio.to_thread(sync, last_block, block_data)
+
+            full_sweep = last_block - last_full_sweep >= FULL_SWEEP_INTERVAL
+            if full_sweep:
+                last_full_sweep = last_block
+
+            await asyncio.to_thread(check_accounts, loop, full_sweep, received_at)
+            if started_at is not None:
+                metrics.STARTUP_SECONDS.set(time.time() - started_at)
+                print(f'First health check done at block {last_block}, {round(time.time() - started_at, 3)}s after starting\n')
+                started_at = None
+            await asyncio.to_thread(compact_state)
+            metrics.SYNC_LAG.set(latest_head['number'] - state['synced_block'])
+            metrics.LIQUIDATION_REWARDS.set(state['liquidation_rewards'] / 10**18)
+
+            # Heartbeat
+            if time.time() - last_heartbeat > 90:
+                last_heartbeat = time.time()
+                print(f'Heartbeat at block: {last_block}')
+                print(f"Total earned liquidation rewards: {round(state['liquidation_rewards'] / (10**18), 2)}")
+                print()
+    finally:
+        rpc_pool.unsubscribe_heads(on_head)
+        submitter.stop()
+        stop_shards()
 
 
 if __name__ == '__main__':
+    if os.getenv('METRICS_PORT'):
+        metrics.registry.serve(int(os.getenv('METRICS_PORT')))
+
+    # Dropped connections are reopened by the pool, a restart only starts the loop over
+    backoff = RESTART_BACKOFF
     while True:
+        started = time.monotonic()
         try:
-            web3 = Web3(Web3.WebsocketProvider(rpc_url))
-            main()
+            asyncio.run(main())
         except Exception as e:
-           print(f'Exception occured: {e}\n')
-           time.sleep(60)
+            if time.monotonic() - started > MAX_RESTART_BACKOFF:
+                backoff = RESTART_BACKOFF
+            print(f'Exception occured: {e}, restarting in {backoff}s\n')
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_RESTART_BACKOFF)
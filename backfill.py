@@ -0,0 +1,114 @@
+import time
+from asyncio.exceptions import TimeoutError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# Substrings of node errors meaning the requested range has to be made smaller
+TOO_MANY_RESULTS_ERRORS = [
+    'more than',
+    'too many',
+    'limit exceeded',
+    'response size',
+    'range too large',
+    'block range',
+    'timeout',
+    'timed out'
+]
+
+MAX_ATTEMPTS = 5
+PROGRESS_INTERVAL = 10
+
+
+def is_range_too_large(error):
+    if isinstance(error, TimeoutError):
+        return True
+    message = str(error).lower()
+    return any(pattern in message for pattern in TOO_MANY_RESULTS_ERRORS)
+
+
+class ChunkSizer:
+    def __init__(self, initial, minimum, maximum, target_logs):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_logs = target_logs
+
+    def shrink(self):
+        self.size = max(self.minimum, self.size // 2)
+
+    def record(self, blocks, log_count):
+        # Sparse ranges can be fetched in bigger pieces
+        if blocks >= self.size and log_count < self.target_logs // 2:
+            self.size = min(self.maximum, self.size * 2)
+
+
+# Fetches logs for [from_block, to_block] in chunks on a bounded pool of workers and yields
+# (chunk_start, chunk_end, logs) strictly in block order, whatever order the chunks complete in.
+# fetch_range(start, end) is called from the worker threads and must return the logs of that range.
+def fetch_in_order(fetch_range, from_block, to_block, workers=8, initial_chunk=2000, min_chunk=1, max_chunk=100000, target_logs=5000, label='Backfill'):
+    sizer = ChunkSizer(initial_chunk, min_chunk, max_chunk, target_logs)
+    total_blocks = to_block - from_block + 1
+
+    next_dispatch = from_block
+    next_apply = from_block
+    retry_ranges = []
+    attempts = {}
+    in_flight = {}
+    completed = {}
+
+    start_time = time.time()
+    last_progress = start_time
+    applied_blocks = 0
+    applied_logs = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while next_apply <= to_block:
+            # Keep twice as many ranges in flight as there are workers, retries of failed ranges first
+            while len(in_flight) < 2 * workers and (len(retry_ranges) > 0 or next_dispatch <= to_block):
+                if len(retry_ranges) > 0:
+                    chunk = retry_ranges.pop(0)
+                else:
+                    chunk = (next_dispatch, min(to_block, next_dispatch + sizer.size - 1))
+                    next_dispatch = chunk[1] + 1
+                in_flight[executor.submit(fetch_range, *chunk)] = chunk
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = in_flight.pop(future)
+                start, end = chunk
+                try:
+                    logs = future.result()
+                except Exception as e:
+                    if is_range_too_large(e) and end > start:
+                        sizer.shrink()
+                        middle = (start + end) // 2
+                        retry_ranges.extend([(start, middle), (middle + 1, end)])
+                        continue
+
+                    attempts[chunk] = attempts.get(chunk, 0) + 1
+                    if attempts[chunk] >= MAX_ATTEMPTS:
+                        raise
+                    print(f'{label}: retrying blocks {start} to {end} after error: {e}')
+                    retry_ranges.append(chunk)
+                    continue
+
+                sizer.record(end - start + 1, len(logs))
+                completed[start] = (end, logs)
+
+            while next_apply in completed:
+                end, logs = completed.pop(next_apply)
+                yield (next_apply, end, logs)
+
+                applied_blocks += end - next_apply + 1
+                applied_logs += len(logs)
+                next_apply = end + 1
+
+            if time.time() - last_progress > PROGRESS_INTERVAL:
+                last_progress = time.time()
+                elapsed = last_progress - start_time
+                print(f'{label}: {applied_blocks}/{total_blocks} blocks ({round(100 * applied_blocks / total_blocks, 1)}%), '
+                      f'{round(applied_blocks / elapsed)} blocks/s, {round(applied_logs / elapsed)} logs/s, chunk size {sizer.size}')
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(f'{label}: done, {applied_blocks} blocks and {applied_logs} logs in {round(elapsed, 1)}s '
+          f'({round(applied_blocks / elapsed)} blocks/s, {round(applied_logs / elapsed)} logs/s)')
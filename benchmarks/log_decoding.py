@@ -0,0 +1,90 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from synthetic_chain import SyntheticChain, load_deployment
+
+from log_decoder import LogDecoder
+from web3 import Web3
+from web3._utils.method_formatters import filter_result_formatter
+from web3.datastructures import AttributeDict
+
+
+# Decodes the logs of a synthetic chain with web3's contract events, as the bot used to, and with LogDecoder:
+#   python benchmarks/log_decoding.py --blocks 2000
+# Both start from the node's JSON result and include what web3 does to it on the way, the result formatters
+# and AttributeDict for the old path, only AttributeDict for get_logs requests made without them.
+# Checks the two give the same logs before timing them.
+
+CONTRACT_EVENTS = {
+    'ClearingHouse': ['ClearingHouseParametersChanged', 'MarketAdded', 'MarketRemoved', 'ChangePosition', 'LiquidityProvided', 'LiquidityRemoved', 'LiquidationCall'],
+    'Vault': ['CollateralAdded', 'CollateralWeightChanged', 'Deposit', 'Withdraw'],
+    'Perpetual': ['FundingPaid', 'PerpetualParametersChanged']
+}
+
+
+def decode_with_web3(event_decoders, raw_logs):
+    formatted = AttributeDict.recursive(filter_result_formatter(raw_logs))
+    return [event_decoders[bytes(raw_log['topics'][0])].process_log(raw_log) for raw_log in formatted]
+
+
+def decode_with_log_decoder(log_decoder, raw_logs):
+    return list(log_decoder.decode(AttributeDict.recursive(raw_logs)))
+
+
+def time_decoding(decode, raw_logs, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        decode(raw_logs)
+        times.append(time.perf_counter() - start)
+    return len(raw_logs) / statistics.median(times)
+
+
+def run(args):
+    chain = SyntheticChain(args.network, args.markets, args.accounts, args.events_per_block, args.seed)
+    for _ in range(args.blocks):
+        chain.mine()
+    raw_logs = [log for block in sorted(chain.blocks) for log in chain.blocks[block]]
+
+    log_decoder = LogDecoder([(load_deployment(args.network, name)['abi'], event_names) for name, event_names in CONTRACT_EVENTS.items()])
+    w3 = Web3()
+    event_decoders = {}
+    for name, event_names in CONTRACT_EVENTS.items():
+        contract = w3.eth.contract(abi=load_deployment(args.network, name)['abi'])
+        for event_name in event_names:
+            event_decoders[bytes.fromhex(log_decoder.topics[event_name][2:])] = getattr(contract.events, event_name)()
+
+    expected = decode_with_web3(event_decoders, raw_logs)
+    decoded = decode_with_log_decoder(log_decoder, raw_logs)
+    fields = ['event', 'address', 'blockNumber', 'blockHash', 'transactionIndex', 'logIndex', 'transactionHash']
+    same = len(expected) == len(decoded) and all(
+        dict(old['args']) == new['args'] and all(old[field] == new[field] for field in fields)
+        for old, new in zip(expected, decoded)
+    )
+    print(f'{len(raw_logs)} logs, decoded the same: {same}')
+
+    web3_rate = time_decoding(lambda logs: decode_with_web3(event_decoders, logs), raw_logs, args.rounds)
+    decoder_rate = time_decoding(lambda logs: decode_with_log_decoder(log_decoder, logs), raw_logs, args.rounds)
+    print(f'{"web3 contract events":24} {round(web3_rate):>10} logs/s')
+    print(f'{"LogDecoder":24} {round(decoder_rate):>10} logs/s  ({round(decoder_rate / web3_rate, 1)}x)')
+    return same
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--network', default='zktestnet')
+    parser.add_argument('--markets', type=int, default=4)
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--events-per-block', type=int, default=20)
+    parser.add_argument('--blocks', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not run(args):
+        sys.exit(1)
@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compact_state import intern_accounts
+from margin_engine import MarginBook
+from scalar import load_helpers
+from synthetic import generate_state
+
+
+# Compares the whole-book engine to the per-account helpers of Liquidation.py on a synthetic book:
+#   python benchmarks/margin_engine.py --positions 10000 100000 1000000
+# The scalar evaluation is timed on at most --scalar-limit accounts and extrapolated to the whole book.
+
+def get_accounts(state):
+    accounts = []
+    seen = set()
+    for idx in state['perps']:
+        for positions in [state['trader_positions'][idx], state['lp_positions'][idx]]:
+            for address in positions:
+                if address not in seen:
+                    seen.add(address)
+                    accounts.append(address)
+    return accounts
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (result, time.perf_counter() - start)
+
+def run(positions, markets, scalar_limit, seed):
+    state = intern_accounts(generate_state(markets, positions, seed))
+    helpers = load_helpers(state)
+    accounts = get_accounts(state)
+
+    sample = accounts[:scalar_limit]
+    scalar_results, scalar_time = timed(lambda: [helpers['get_free_collateral'](*helpers['get_margin_components'](address)) for address in sample])
+    scalar_time = scalar_time * len(accounts) / len(sample)
+
+    book, build_time = timed(MarginBook.from_state, state)
+    exact_results, exact_time = timed(book.free_collateral, True)
+    book.free_collateral(False)
+    fast_results, fast_time = timed(book.free_collateral, False)
+
+    positions_of = {address: i for i, address in enumerate(book.accounts)}
+    mismatches = sum(1 for address, expected in zip(sample, scalar_results) if exact_results[positions_of[address]] != expected)
+
+    unhealthy = set(address for address in accounts if not helpers['is_position_valid'](address)) if len(accounts) <= scalar_limit else None
+    flagged = set(book.find_unhealthy(helpers['MIN_FREE_COLLATERAL']))
+
+    print(f'{positions} positions, {len(accounts)} accounts, {markets} markets')
+    print(f'  scalar: {round(scalar_time, 3)}s{" (extrapolated)" if len(sample) < len(accounts) else ""}')
+    print(f'  build:  {round(build_time, 3)}s')
+    print(f'  exact:  {round(exact_time, 3)}s, {mismatches} mismatches against the scalar helpers on {len(sample)} accounts')
+    print(f'  fast:   {round(fast_time, 3)}s ({round(scalar_time / fast_time, 1)}x), max deviation {np.max(np.abs(fast_results - exact_results.astype(float)))} wei')
+    if unhealthy is not None:
+        print(f'  fast mode flagged {len(flagged)} accounts for {len(unhealthy)} unhealthy, {len(unhealthy - flagged)} missed')
+    print()
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--positions', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--markets', type=int, default=4)
+    parser.add_argument('--scalar-limit', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    mismatches = sum(run(positions, args.markets, args.scalar_limit, args.seed) for positions in args.positions)
+    if mismatches > 0:
+        sys.exit(f'{mismatches} accounts differ from the scalar helpers')
@@ -0,0 +1,280 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+
+import websockets
+from eth_abi import decode, encode
+from eth_utils import function_abi_to_4byte_selector, keccak, to_checksum_address
+from eth_utils.abi import collapse_if_tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from multicall import MULTICALL3_ABI, MULTICALL3_ADDRESS
+from synthetic_chain import SyntheticChain, load_deployment
+
+
+# Websocket JSON-RPC stand-in for a zkSync node, serving a SyntheticChain to the bot:
+#   python benchmarks/mock_node.py --port 8548 --markets 4 --accounts 10000
+# Blocks are only produced when asked for with the mock_mine method, and mock_stats returns the number of
+# calls made to each method. eth_call always answers from the latest block.
+# Faults can be injected with --delay, --slow-rate, --drop-rate and --stall-rate, or changed while running
+# with mock_faults, e.g. {"delay": 0.05, "stall_rate": 1} to make the node stop answering.
+# mock_reorg [depth] replaces the last depth blocks with depth + 1 new ones, up to --max-reorg-depth.
+
+CHAIN_IDS = {'zksync': 324, 'zktestnet': 280}
+
+# Methods used to drive the node, not counted in the stats and never faulted
+CONTROL_METHODS = ['mock_mine', 'mock_reorg', 'mock_stats', 'mock_faults']
+
+
+class RpcError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def get_functions(abi):
+    return {function_abi_to_4byte_selector(item): item for item in abi if item['type'] == 'function'}
+
+
+def to_int(value):
+    return int(value, 16) if isinstance(value, str) else value
+
+
+class MockNode:
+    def __init__(self, chain, network='zktestnet', max_logs=10000, faults={}, seed=0):
+        self.chain = chain
+        self.chain_id = CHAIN_IDS[network]
+        self.max_logs = max_logs
+        self.calls = {}
+        self.subscribers = {}
+        self.transactions = []
+
+        # delay: seconds added to every answer, slow_rate: share of requests delayed by slow_delay instead,
+        # drop_rate: share of requests the connection is closed on, stall_rate: share never answered
+        self.faults = {'delay': 0, 'slow_rate': 0, 'slow_delay': 1, 'drop_rate': 0, 'stall_rate': 0, **faults}
+        self.random = random.Random(seed)
+
+        self.perp_functions = get_functions(load_deployment(network, 'Perpetual')['abi'])
+        self.market_functions = get_functions(load_deployment(network, 'Market')['abi'])
+        self.vault_functions = get_functions(load_deployment(network, 'Vault')['abi'])
+        self.multicall_functions = get_functions(MULTICALL3_ABI)
+
+    async def serve(self, websocket):
+        tasks = set()
+        try:
+            async for message in websocket:
+                request = json.loads(message)
+                if request['method'] in CONTROL_METHODS:
+                    await self.respond(websocket, request)
+                    continue
+                # Answered concurrently like a real node, so injected delays don't hold up other requests
+                task = asyncio.create_task(self.respond_with_faults(websocket, request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            for subscription_id in [key for key, subscriber in self.subscribers.items() if subscriber is websocket]:
+                del self.subscribers[subscription_id]
+
+    async def respond(self, websocket, request):
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        try:
+            response['result'] = await self.handle(websocket, request['method'], request.get('params', []))
+        except RpcError as e:
+            response['error'] = {'code': e.code, 'message': str(e)}
+        try:
+            await websocket.send(json.dumps(response))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def respond_with_faults(self, websocket, request):
+        faults = self.faults
+        if self.random.random() < faults['stall_rate']:
+            return
+        if self.random.random() < faults['drop_rate']:
+            await websocket.close()
+            return
+        delay = faults['slow_delay'] if self.random.random() < faults['slow_rate'] else faults['delay']
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.respond(websocket, request)
+
+    async def handle(self, websocket, method, params):
+        if method not in CONTROL_METHODS:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == 'eth_chainId':
+            return hex(self.chain_id)
+        if method == 'eth_blockNumber':
+            return hex(self.chain.block_number)
+        if method == 'eth_gasPrice':
+            return hex(25 * 10**7)
+        if method == 'eth_getTransactionCount':
+            return '0x0'
+        if method == 'eth_getBlockByNumber':
+            block_number = self.chain.block_number if params[0] in ['latest', 'pending', 'safe', 'finalized'] else to_int(params[0])
+            if block_number > self.chain.block_number:
+                return None
+            return self.chain.get_header(block_number)
+        if method == 'eth_getLogs':
+            return self.get_logs(params[0])
+        if method == 'eth_call':
+            transaction = params[0]
+            return '0x' + self.call(transaction['to'], bytes.fromhex(transaction.get('data', transaction.get('input', '0x'))[2:])).hex()
+        if method == 'eth_subscribe':
+            if params[0] != 'newHeads':
+                raise RpcError(-32602, f'Unsupported subscription {params[0]}')
+            subscription_id = hex(len(self.subscribers) + 1)
+            self.subscribers[subscription_id] = websocket
+            return subscription_id
+        if method == 'eth_sendRawTransaction':
+            self.transactions.append(params[0])
+            return '0x' + keccak(hexstr=params[0]).hex()
+        if method == 'eth_unsubscribe':
+            return self.subscribers.pop(params[0], None) is not None
+        if method == 'mock_mine':
+            for _ in range(params[0] if len(params) > 0 else 1):
+                self.chain.mine()
+            await self.notify_heads()
+            return hex(self.chain.block_number)
+        if method == 'mock_reorg':
+            try:
+                self.chain.reorg(*params)
+            except ValueError as e:
+                raise RpcError(-32602, str(e))
+            await self.notify_heads()
+            return hex(self.chain.block_number)
+        if method == 'mock_stats':
+            return {'calls': self.calls, 'block_number': self.chain.block_number, 'log_count': self.chain.log_count, 'accounts': len(self.chain.accounts), 'transactions': len(self.transactions)}
+        if method == 'mock_faults':
+            self.faults = {**self.faults, **params[0]}
+            return self.faults
+        raise RpcError(-32601, f'Method {method} not found')
+
+    async def notify_heads(self):
+        head = self.chain.get_header(self.chain.block_number)
+        for subscription_id, websocket in list(self.subscribers.items()):
+            try:
+                await websocket.send(json.dumps({'jsonrpc': '2.0', 'method': 'eth_subscription', 'params': {'subscription': subscription_id, 'result': head}}))
+            except websockets.ConnectionClosed:
+                self.subscribers.pop(subscription_id, None)
+
+    def get_logs(self, log_filter):
+        from_block = to_int(log_filter.get('fromBlock', self.chain.block_number))
+        to_block = min(to_int(log_filter.get('toBlock', self.chain.block_number)), self.chain.block_number)
+        addresses = log_filter.get('address', [])
+        addresses = set(address.lower() for address in ([addresses] if isinstance(addresses, str) else addresses))
+        topics = log_filter.get('topics', [])
+        first_topics = None
+        if len(topics) > 0 and topics[0] is not None:
+            first_topics = set(topic.lower() for topic in ([topics[0]] if isinstance(topics[0], str) else topics[0]))
+
+        logs = []
+        for block_number in range(from_block, to_block + 1):
+            for log in self.chain.blocks.get(block_number, []):
+                if len(addresses) > 0 and log['address'].lower() not in addresses:
+                    continue
+                if first_topics is not None and log['topics'][0] not in first_topics:
+                    continue
+                logs.append(log)
+            # Same kind of error real nodes give, the bot has to split the range
+            if len(logs) > self.max_logs:
+                raise RpcError(-32005, f'query returned more than {self.max_logs} results')
+        return logs
+
+    def call(self, to, data):
+        to = to.lower()
+        selector = data[:4]
+
+        if to == MULTICALL3_ADDRESS.lower():
+            function = self.multicall_functions[selector]
+            calls, = decode([collapse_if_tuple(item) for item in function['inputs']], data[4:])
+            results = []
+            for target, allow_failure, call_data in calls:
+                try:
+                    results.append((True, self.call(target, call_data)))
+                except RpcError:
+                    if not allow_failure:
+                        raise RpcError(3, 'execution reverted: Multicall3: call failed')
+                    results.append((False, b''))
+            return encode([collapse_if_tuple(item) for item in function['outputs']], [results])
+
+        if to == self.chain.vault_address.lower() and selector in self.vault_functions:
+            function = self.vault_functions[selector]
+            if function['name'] == 'UA':
+                return self.encode_output(function, self.chain.ua_address)
+
+        for idx, perp in enumerate(self.chain.perps):
+            if to == perp['address'].lower() and selector in self.perp_functions:
+                return self.call_perp(idx, self.perp_functions[selector], data[4:])
+            if to == perp['market_address'].lower() and selector in self.market_functions:
+                return self.call_market(idx, self.market_functions[selector], data[4:])
+
+        raise RpcError(3, 'execution reverted')
+
+    def call_perp(self, idx, function, arguments):
+        perp = self.chain.perps[idx]
+        name = function['name']
+        if name == 'market':
+            return self.encode_output(function, perp['market_address'])
+        if name == 'indexPrice':
+            return self.encode_output(function, perp['index_price'])
+        if name == 'getTotalLiquidityProvided':
+            return self.encode_output(function, perp['total_liquidity_provided'])
+        if name == 'getGlobalPosition':
+            return self.encode_output(function, self.chain.get_global_position(idx))
+
+        account = to_checksum_address(decode(['address'], arguments)[0])
+        if name == 'getTraderPosition':
+            return self.encode_output(function, self.chain.get_trader_position(idx, account))
+        if name == 'getLpPosition':
+            return self.encode_output(function, self.chain.get_lp_position(idx, account))
+        raise RpcError(3, 'execution reverted')
+
+    def call_market(self, idx, function, arguments):
+        perp = self.chain.perps[idx]
+        if function['name'] == 'out_fee':
+            return self.encode_output(function, perp['out_fee'])
+        if function['name'] == 'balances':
+            i, = decode(['uint256'], arguments)
+            return self.encode_output(function, perp['quote_balance'] if i == 0 else perp['base_balance'])
+        raise RpcError(3, 'execution reverted')
+
+    def encode_output(self, function, value):
+        return encode([collapse_if_tuple(item) for item in function['outputs']], [value])
+
+
+async def main(args):
+    chain = SyntheticChain(args.network, args.markets, args.accounts, args.events_per_block, args.seed, args.volatility, max_reorg_depth=args.max_reorg_depth)
+    faults = {'delay': args.delay, 'slow_rate': args.slow_rate, 'slow_delay': args.slow_delay, 'drop_rate': args.drop_rate, 'stall_rate': args.stall_rate}
+    node = MockNode(chain, args.network, args.max_logs, faults, args.seed)
+    async with websockets.serve(node.serve, args.host, args.port, max_size=None):
+        print(f'Mock node listening on ws://{args.host}:{args.port} at block {chain.block_number}', flush=True)
+        await asyncio.Future()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8548)
+    parser.add_argument('--network', default='zktestnet')
+    parser.add_argument('--markets', type=int, default=4)
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--events-per-block', type=int, default=20)
+    parser.add_argument('--volatility', type=float, default=0.002)
+    parser.add_argument('--max-logs', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-reorg-depth', type=int, default=0)
+    parser.add_argument('--delay', type=float, default=0)
+    parser.add_argument('--slow-rate', type=float, default=0)
+    parser.add_argument('--slow-delay', type=float, default=1)
+    parser.add_argument('--drop-rate', type=float, default=0)
+    parser.add_argument('--stall-rate', type=float, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,140 @@
+import argparse
+import statistics
+import sys
+import time
+
+from sync import get_free_port, percentile, start_node
+
+import rpc_pool
+from rpc_pool import RpcPool, RpcPoolProvider
+from web3 import Web3
+
+
+# Runs RpcPool against local mock nodes with injected delays and failures:
+#   python benchmarks/rpc_pool.py --requests 500
+# Compares read latency of a single endpoint with the pool, stalls one node to check it gets evicted
+# without failing requests, lets it back in, and checks transactions reach every node. Then checks that
+# logs up to a block only the slower of two nodes has are read from that node.
+
+class NodeArgs:
+    def __init__(self, args):
+        self.markets = 1
+        self.accounts = 100
+        self.events_per_block = 5
+        self.max_logs = 10000
+        self.seed = args.seed
+
+def start_nodes(args, node_faults):
+    nodes = []
+    for i, faults in enumerate(node_faults):
+        port = get_free_port()
+        node = start_node(NodeArgs(args), port, [f'--{name}={value}' for name, value in faults.items()])
+        nodes.append((node, f'ws://127.0.0.1:{port}'))
+    return nodes
+
+def time_requests(w3, count):
+    times = []
+    errors = 0
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            w3.eth.block_number
+        except Exception:
+            errors += 1
+        times.append(time.perf_counter() - start)
+    return times, errors
+
+def report_latency(name, times, errors):
+    print(f'{name:28} p50 {1000 * statistics.median(times):7.1f} ms  p99 {1000 * percentile(times, 0.99):7.1f} ms  max {1000 * max(times):7.1f} ms  errors {errors}')
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+# The first node, tried first, stays --lag blocks behind the second
+def check_lagging_node(args):
+    nodes = start_nodes(args, [{}, {'delay': args.delay}])
+    try:
+        pool = RpcPool([url for _, url in nodes], timeout=args.timeout)
+        pooled = Web3(RpcPoolProvider(pool))
+        pool.subscribe_heads(lambda number: None)
+        lagging, ahead = [Web3(Web3.WebsocketProvider(url)) for _, url in nodes]
+        head = int(ahead.provider.make_request('mock_mine', [args.lag])['result'], 16)
+        wait_for(lambda: pool.endpoints[1].head == head, args.timeout)
+
+        log_filter = {'fromBlock': head - args.lag + 1, 'toBlock': head}
+        logs = pooled.eth.get_logs(log_filter)
+        expected = ahead.eth.get_logs(log_filter)
+        lagging_reads = lagging.provider.make_request('mock_stats', [])['result']['calls'].get('eth_getLogs', 0)
+        print(f'Logs up to block {head} with node 0 {args.lag} blocks behind: {len(logs)} of {len(expected)}, {lagging_reads} read from node 0')
+        return len(logs) == len(expected) and lagging_reads == 0
+    finally:
+        for node, _ in nodes:
+            node.terminate()
+            node.wait()
+
+def run(args):
+    # Both nodes usually answer in a few ms, but one request in slow_rate takes slow_delay
+    tail = {'delay': args.delay, 'slow-rate': args.slow_rate, 'slow-delay': args.slow_delay}
+    nodes = start_nodes(args, [tail, tail, {'delay': args.delay}])
+    urls = [url for _, url in nodes]
+    rpc_pool.HEDGE_MAX_DELAY = args.hedge_max_delay
+
+    try:
+        single = Web3(RpcPoolProvider(RpcPool(urls[:1], timeout=args.timeout)))
+        report_latency('single endpoint', *time_requests(single, args.requests))
+
+        pool = RpcPool(urls[:2], timeout=args.timeout)
+        pooled = Web3(RpcPoolProvider(pool))
+        report_latency('hedged across 2 endpoints', *time_requests(pooled, args.requests))
+        print(f"Hedged requests: {sum(rpc_pool.metrics.RPC_HEDGED_REQUESTS.values.values())}")
+
+        # The fastest node stops answering, the requests failing over to the others should all still succeed
+        pool = RpcPool(urls, timeout=args.timeout)
+        pooled = Web3(RpcPoolProvider(pool, hedged_methods=[]))
+        time_requests(pooled, 20)
+        stalled = pool.ranked('eth_blockNumber')[0]
+        control = Web3(Web3.WebsocketProvider(stalled.url))
+        control.provider.make_request('mock_faults', [{'stall_rate': 1}])
+        times, errors = time_requests(pooled, args.requests // 5)
+        report_latency(f'node {stalled.label} stalled', times, errors)
+        evicted = stalled.evicted_until is not None
+        print(f'Node {stalled.label} evicted: {evicted}')
+
+        control.provider.make_request('mock_faults', [{'stall_rate': 0}])
+        start = time.time()
+        reinstated = wait_for(lambda: stalled.evicted_until is None, rpc_pool.EVICTION_MAX)
+        print(f'Node {stalled.label} back after {round(time.time() - start, 1)} s: {reinstated}')
+
+        # Transactions go to every node, the slower ones answering after the first
+        pooled.eth.send_raw_transaction('0x' + 'ab' * 100)
+        controls = [Web3(Web3.WebsocketProvider(url)) for url in urls]
+        def get_received():
+            return [control.provider.make_request('mock_stats', [])['result']['transactions'] for control in controls]
+        broadcast = wait_for(lambda: all(count == 1 for count in get_received()), 2 * args.slow_delay + 1)
+        print(f'Transaction received by nodes: {get_received()}')
+        return evicted and reinstated and errors == 0 and broadcast
+    finally:
+        for node, _ in nodes:
+            node.terminate()
+            node.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--delay', type=float, default=0.002)
+    parser.add_argument('--slow-rate', type=float, default=0.05)
+    parser.add_argument('--slow-delay', type=float, default=0.2)
+    parser.add_argument('--hedge-max-delay', type=float, default=0.02)
+    parser.add_argument('--timeout', type=float, default=1)
+    parser.add_argument('--lag', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not run(args) or not check_lagging_node(args):
+        sys.exit(1)
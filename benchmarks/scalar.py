@@ -0,0 +1,39 @@
+import ast
+import os
+import subprocess
+
+
+LIQUIDATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Liquidation.py')
+
+HELPER_GLOBALS = ['CURVE_TRADING_FEE_DECIMALS', 'MIN_FREE_COLLATERAL', 'LIQUIDATION_PRICE_BUFFER', 'market_constants']
+# Local modules the helpers import from, none of them touch the network
+HELPER_MODULES = ['wad']
+
+
+# Older revisions of Liquidation.py connect to the node when imported, so the helper functions are taken from
+# its source instead and run against `state`, which must have gone through intern_accounts. `source` can be
+# given to load them from another revision of the file. Returns the namespace they were defined in.
+def load_helpers(state, source=None):
+    if source is None:
+        with open(LIQUIDATION_PATH) as f:
+            source = f.read()
+    tree = ast.parse(source)
+
+    body = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            body.append(node)
+        elif isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id in HELPER_GLOBALS for target in node.targets):
+            body.append(node)
+        elif isinstance(node, ast.ImportFrom) and node.module in HELPER_MODULES:
+            body.append(node)
+
+    namespace = {'state': state, 'account_registry': state['reserves'].registry}
+    exec(compile(ast.Module(body=body, type_ignores=[]), LIQUIDATION_PATH, 'exec'), namespace)
+    if 'refresh_market_constants' in namespace:
+        namespace['refresh_market_constants'](state['perps'])
+    return namespace
+
+
+def get_source(revision):
+    return subprocess.run(['git', 'show', f'{revision}:Liquidation.py'], cwd=os.path.dirname(LIQUIDATION_PATH), capture_output=True, text=True, check=True).stdout
@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compact_state import intern_accounts
+from margin_engine import MarginBook
+from scalar import load_helpers
+from synthetic import generate_state
+
+
+# Times MarginBook.run_scenarios against rescanning the book with the per-account helpers once per scenario:
+#   python benchmarks/scenarios.py --positions 10000 100000 --scenarios 61
+# Scenarios move every market by the same percentage, evenly spread over -30% to +30%. The rescan is timed on
+# at most --scalar-limit accounts and extrapolated, and the exact mode is checked against it on those accounts.
+
+LIQUIDATION_REWARD = 15 * 10**15
+INSURANCE_SHARE = 2 * 10**17
+
+def get_shocks(count):
+    return [-0.3 + 0.6 * i / max(1, count - 1) for i in range(count)]
+
+def rescan(state, helpers, accounts, shocks):
+    prices = {idx: state['perps'][idx]['index_price'] for idx in state['perps']}
+    results = []
+    try:
+        for shock in shocks:
+            for idx in state['perps']:
+                state['perps'][idx]['index_price'] = helpers['wad_mul'](prices[idx], 10**18 + round(shock * 10**18))
+            results.append(set(address for address in accounts if not helpers['is_position_valid'](address)))
+    finally:
+        for idx in state['perps']:
+            state['perps'][idx]['index_price'] = prices[idx]
+    return results
+
+def run(positions, markets, scenario_count, scalar_limit, seed):
+    state = intern_accounts(generate_state(markets, positions, seed))
+    state['liquidation_reward'] = LIQUIDATION_REWARD
+    state['liquidation_reward_insurance_share'] = INSURANCE_SHARE
+    helpers = load_helpers(state)
+    shocks = get_shocks(scenario_count)
+    scenarios = [{idx: shock for idx in state['perps']} for shock in shocks]
+
+    book = MarginBook.from_state(state)
+    sample = book.accounts[:scalar_limit]
+    start = time.perf_counter()
+    expected = rescan(state, helpers, sample, shocks)
+    scalar_time = (time.perf_counter() - start) * len(book.accounts) / len(sample)
+
+    start = time.perf_counter()
+    fast = book.run_scenarios(scenarios, helpers['MIN_FREE_COLLATERAL'], LIQUIDATION_REWARD, INSURANCE_SHARE)
+    fast_time = time.perf_counter() - start
+    start = time.perf_counter()
+    exact = book.run_scenarios(scenarios, helpers['MIN_FREE_COLLATERAL'], LIQUIDATION_REWARD, INSURANCE_SHARE, exact=True)
+    exact_time = time.perf_counter() - start
+
+    in_sample = set(sample)
+    mismatches = sum(1 for result, liquidatable in zip(exact, expected) if set(address for address, _ in result['accounts'] if address in in_sample) != liquidatable)
+    fast_differences = sum(len(set(a for a, _ in f['accounts']) ^ set(a for a, _ in e['accounts'])) for f, e in zip(fast, exact))
+
+    print(f'{positions} positions, {len(book.accounts)} accounts, {markets} markets, {scenario_count} scenarios')
+    print(f'  rescan: {round(scalar_time, 3)}s{" (extrapolated)" if len(sample) < len(book.accounts) else ""}')
+    print(f'  exact:  {round(exact_time, 3)}s, {mismatches} scenarios differing from the rescan on {len(sample)} accounts')
+    print(f'  fast:   {round(fast_time, 3)}s ({round(scalar_time / fast_time, 1)}x), {fast_differences} accounts classified differently from exact')
+    for result, shock in list(zip(fast, shocks))[::max(1, scenario_count // 6)]:
+        print(f"    {round(100 * shock, 1):>6}%: {len(result['accounts'])} liquidatable, notional {round(result['notional'] / 10**18)}, rewards {round(result['rewards'] / 10**18, 2)}")
+    print()
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--positions', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--markets', type=int, default=4)
+    parser.add_argument('--scenarios', type=int, default=61)
+    parser.add_argument('--scalar-limit', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    mismatches = sum(run(positions, args.markets, args.scenarios, args.scalar_limit, args.seed) for positions in args.positions)
+    if mismatches > 0:
+        sys.exit(f'{mismatches} scenarios differ from the per-account helpers')
@@ -0,0 +1,128 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sync import ROOT
+from synthetic import generate_state
+
+
+# Times the health check of a large book in one process and split over worker processes:
+#   python benchmarks/shards.py --positions 200000 --shards 0 2 4 8
+# The book is first checked by a full sweep, as main() does on its first block, then again after every index price
+# drops by --shock, which goes to the workers as a state change like a synced block would. The candidates of each
+# shard count must be the same as those of the single process, and after the shock they must be every account the
+# exact whole-book evaluation finds unhealthy, as only the price moved. The book is synthetic, no node is needed.
+
+LIQUIDATION_REWARD = 15 * 10**15
+INSURANCE_SHARE = 2 * 10**17
+
+def load_book(Liquidation, markets, positions, seed):
+    from compact_state import intern_accounts
+    from state_store import StateStore
+
+    state = intern_accounts(generate_state(markets, positions, seed))
+    state['liquidation_reward'] = LIQUIDATION_REWARD
+    state['liquidation_reward_insurance_share'] = INSURANCE_SHARE
+    Liquidation.state = state
+    Liquidation.account_registry = state['reserves'].registry
+    Liquidation.reset_market_constants()
+    # Deltas are only kept in memory, the book is never written out
+    Liquidation.store = StateStore('state.json', 'state.journal', 10**9, 10**9, 10**9)
+
+def set_prices(Liquidation, prices):
+    state = Liquidation.state
+    for idx in state['perps']:
+        Liquidation.store.touch(state, 'perps', idx)
+        state['perps'][idx]['index_price'] = prices[idx]
+    state['synced_block'] += 1
+    Liquidation.store.commit(state)
+    Liquidation.reset_market_constants()
+    Liquidation.price_moved_markets.update(state['perps'])
+
+def time_check(Liquidation, full_sweep=False):
+    start = time.perf_counter()
+    Liquidation.hot_path.active = True
+    try:
+        if full_sweep:
+            Liquidation.sweep_all_accounts()
+        candidates = Liquidation.find_liquidation_candidates()
+    finally:
+        Liquidation.hot_path.active = False
+    return time.perf_counter() - start, candidates
+
+def run_checks(Liquidation, shards, shock):
+    from wad import WAD, wad_mul
+
+    prices = {idx: perp['index_price'] for idx, perp in Liquidation.state['perps'].items()}
+    Liquidation.HEALTH_CHECK_SHARDS = shards
+    for values in [Liquidation.dirty_accounts, Liquidation.dirty_markets, Liquidation.dirty_lp_markets, Liquidation.price_moved_markets,
+                   Liquidation.unindexed_markets, Liquidation.watchlist, Liquidation.liquidation_price_indices, Liquidation.indexed_markets]:
+        values.clear()
+    Liquidation.start_shards()
+    try:
+        full_time, full_candidates = time_check(Liquidation, full_sweep=True)
+        set_prices(Liquidation, {idx: wad_mul(price, WAD + round(shock * WAD)) for idx, price in prices.items()})
+        shock_time, shock_candidates = time_check(Liquidation)
+        unhealthy = get_unhealthy(Liquidation)
+    finally:
+        Liquidation.stop_shards()
+        set_prices(Liquidation, prices)
+    return full_time, full_candidates, shock_time, shock_candidates, unhealthy
+
+# Every unhealthy account, from the exact whole-book evaluation, or every account's scalar check without numpy
+def get_unhealthy(Liquidation):
+    import margin_engine
+    if margin_engine.available():
+        return set(margin_engine.MarginBook.from_state(Liquidation.state).find_unhealthy(Liquidation.MIN_FREE_COLLATERAL, exact=True))
+    state = Liquidation.state
+    accounts = set()
+    for idx in state['perps']:
+        accounts.update(state['trader_positions'][idx])
+        accounts.update(state['lp_positions'][idx])
+    return set(address for address in accounts if not Liquidation.is_position_valid(address))
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='liquidation-bot-benchmark-')
+    os.symlink(os.path.join(os.path.abspath(ROOT), 'deployments'), os.path.join(workdir, 'deployments'))
+    os.chdir(workdir)
+    os.environ['NETWORK'] = 'zktestnet'
+    os.environ['PRIVATE_KEY'] = '0x' + '11' * 32
+
+    import Liquidation
+    Liquidation.HEALTH_CHECK_BUDGET = float('inf')
+    load_book(Liquidation, args.markets, args.positions, args.seed)
+    print(f'{args.positions} positions, {len(Liquidation.account_registry)} accounts, {os.cpu_count()} CPUs')
+
+    baseline = None
+    same = True
+    for shards in args.shards:
+        full_time, full_candidates, shock_time, shock_candidates, unhealthy = run_checks(Liquidation, shards, args.shock)
+        if baseline is None:
+            baseline = (full_time, full_candidates, shock_time, shock_candidates)
+        # Positions of the same priority can come in any order
+        matches = set(full_candidates) == set(baseline[1]) and set(shock_candidates) == set(baseline[3])
+        missed = len(unhealthy - set(candidate[0] for candidate in shock_candidates))
+        same = same and matches and missed == 0
+        print(
+            f'  {shards or "no":>2} workers: full check {round(full_time, 3)}s ({round(baseline[0] / full_time, 2)}x), '
+            f'{len(full_candidates)} candidates, after the shock {round(shock_time, 3)}s ({round(baseline[2] / shock_time, 2)}x), '
+            f'{len(shock_candidates)} candidates, same candidates: {matches}, unhealthy accounts missed: {missed}'
+        )
+    return same
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--positions', type=int, default=200000)
+    parser.add_argument('--markets', type=int, default=4)
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 2, 4, 8])
+    parser.add_argument('--shock', type=float, default=-0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not run(args):
+        sys.exit('Sharded health checks found different candidates or missed unhealthy accounts')
@@ -0,0 +1,126 @@
+import argparse
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sync import ROOT, count_calls, get_free_port, start_node
+
+
+# Starts the bot as a process against benchmarks/mock_node.py and times how long it takes to get to its first
+# health check, once from a clean directory and then restarting over a synced state:
+#   python benchmarks/startup.py --history 400 --downtime 60 --restarts 5 --delay 0.05
+# The state is synced to the head in this process, then --downtime blocks are mined, as if the bot had been down
+# that long, and every restart starts from the same state files and chain cache. The time in main() is what a
+# restart after a crash costs, as that only runs main() again, and is compared with --block-time. The time from
+# starting the process also includes the interpreter and the imports. The node answers without delay by default,
+# like a node on localhost, the first RPC endpoint should be one.
+
+STATE_FILES = ['state.json', 'state.journal', 'chain_cache.json']
+
+FIRST_CHECK = re.compile(r'First health check done at block (\d+), ([\d.]+)s after starting')
+CRASHED = 'Exception occured'
+
+def start_bot(workdir, env, timeout):
+    start = time.perf_counter()
+    bot = subprocess.Popen([sys.executable, os.path.join(os.path.abspath(ROOT), 'Liquidation.py')], cwd=workdir, env=env,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    watchdog = threading.Timer(timeout, bot.kill)
+    watchdog.start()
+    output = []
+    try:
+        for line in bot.stdout:
+            output.append(line)
+            match = FIRST_CHECK.match(line)
+            if match is not None:
+                return time.perf_counter() - start, float(match.group(2))
+            if line.startswith(CRASHED):
+                break
+        raise RuntimeError('The bot did not get to a health check:\n' + ''.join(output))
+    finally:
+        watchdog.cancel()
+        bot.terminate()
+        bot.wait()
+
+def run(args):
+    port = get_free_port()
+    node = start_node(args, port, ['--delay', str(args.delay)])
+
+    workdir = tempfile.mkdtemp(prefix='liquidation-bot-benchmark-')
+    os.symlink(os.path.join(os.path.abspath(ROOT), 'deployments'), os.path.join(workdir, 'deployments'))
+    env = {
+        **os.environ,
+        'PYTHONUNBUFFERED': '1',
+        'RPC': f'ws://127.0.0.1:{port}',
+        'NETWORK': 'zktestnet',
+        'PRIVATE_KEY': '0x' + '11' * 32
+    }
+
+    os.chdir(workdir)
+    os.environ.update(env)
+
+    try:
+        from web3 import Web3
+        control = Web3(Web3.WebsocketProvider(env['RPC']))
+
+        def node_request(method, params=[]):
+            return control.provider.make_request(method, params)['result']
+
+        node_request('mock_mine', [args.history])
+        before = node_request('mock_stats')
+        cold, cold_main = start_bot(workdir, env, args.timeout)
+        cold_calls = count_calls(node_request('mock_stats')) - count_calls(before)
+        print(f'Cold start: first health check after {round(cold, 3)}s, {round(cold_main, 3)}s of it in main(), {cold_calls} RPC calls')
+
+        # The bot only writes a block once it is CONFIRMATION_DEPTH deep, which the cold start didn't get to
+        import Liquidation
+        Liquidation.sync(int(node_request('eth_blockNumber'), 16))
+        os.makedirs('synced')
+        for name in STATE_FILES:
+            shutil.copy(name, os.path.join('synced', name))
+        node_request('mock_mine', [args.downtime])
+
+        restarts = []
+        restart_calls = []
+        for _ in range(args.restarts):
+            for name in STATE_FILES:
+                shutil.copy(os.path.join('synced', name), name)
+            before = node_request('mock_stats')
+            elapsed, in_main = start_bot(workdir, env, args.timeout)
+            restart_calls.append(count_calls(node_request('mock_stats')) - count_calls(before))
+            restarts.append((elapsed, in_main))
+            print(f'Restart {args.downtime} blocks behind: first health check after {round(elapsed, 3)}s, {round(in_main, 3)}s of it in main(), {restart_calls[-1]} RPC calls')
+
+        median = statistics.median(elapsed for elapsed, _ in restarts)
+        median_main = statistics.median(in_main for _, in_main in restarts)
+        print(f'Median restart {round(median, 3)}s, {round(median_main, 3)}s in main(), within a {args.block_time}s block: {median < args.block_time}')
+        return median < args.block_time
+    finally:
+        node.terminate()
+        node.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--markets', type=int, default=4)
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--events-per-block', type=int, default=20)
+    parser.add_argument('--history', type=int, default=400)
+    parser.add_argument('--downtime', type=int, default=60, help='blocks mined before every restart')
+    parser.add_argument('--restarts', type=int, default=5)
+    parser.add_argument('--delay', type=float, default=0, help='latency the mock node adds to every request')
+    parser.add_argument('--block-time', type=float, default=1)
+    parser.add_argument('--max-logs', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    if not run(args):
+        sys.exit('Restarts took longer than a block')
@@ -0,0 +1,89 @@
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compact_state import intern_accounts, evict_inactive
+from scalar import load_helpers
+from synthetic import generate_state, get_address
+
+
+# Memory held by the state as loaded from state.json, with the plain nested dicts and with interned accounts:
+#   python benchmarks/state_memory.py --positions 10000 100000
+# Then --rounds times, --churn of the accounts close everything and withdraw and as many new ones take over their
+# positions. The interned state is measured after that with the closed accounts kept and with them evicted.
+
+def measure(load):
+    gc.collect()
+    tracemalloc.start()
+    state = load()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (state, size)
+
+def time_checks(state, accounts):
+    helpers = load_helpers(state)
+    start = time.perf_counter()
+    for address in accounts:
+        helpers['is_position_valid'](address)
+    return time.perf_counter() - start
+
+# Each closed account's positions and balances move to a new account, so the book keeps its size
+def churn(state, share, rounds, evict, seed):
+    rng = random.Random(seed)
+    for _ in range(rounds):
+        active = sorted(address for address, balances in state['reserves'].items() if any(balance != 0 for balance in balances.values()))
+        closed = rng.sample(active, int(share * len(active)))
+        for address in closed:
+            new_address = get_address(rng)
+            for section in ['trader_positions', 'lp_positions']:
+                for positions in state[section].values():
+                    if address in positions:
+                        positions[new_address] = dict(positions[address])
+                        del positions[address]
+            state['reserves'][new_address] = dict(state['reserves'][address])
+            for asset in list(state['reserves'][address]):
+                state['reserves'][address][asset] = 0
+        if evict:
+            evict_inactive(state, closed)
+    return state
+
+def run(positions, markets, seed, share, rounds):
+    raw = json.dumps(generate_state(markets, positions, seed))
+
+    plain, plain_size = measure(lambda: json.loads(raw))
+    compact, compact_size = measure(lambda: intern_accounts(json.loads(raw)))
+
+    accounts = list(plain['reserves'])
+    print(f'{positions} positions, {len(accounts)} accounts, {markets} markets')
+    print(f'  dicts:    {round(plain_size / 2**20, 1)} MiB, {round(plain_size / positions)} bytes per position')
+    print(f'  interned: {round(compact_size / 2**20, 1)} MiB, {round(compact_size / positions)} bytes per position ({round(100 * (1 - compact_size / plain_size))}% less)')
+    print(f'  health check of every account: {round(time_checks(compact, accounts), 3)}s')
+
+    if rounds > 0:
+        kept, kept_size = measure(lambda: churn(intern_accounts(json.loads(raw)), share, rounds, False, seed))
+        evicted, evicted_size = measure(lambda: churn(intern_accounts(json.loads(raw)), share, rounds, True, seed))
+        print(f'  after {rounds} rounds of {round(100 * share)}% of the accounts closing:')
+        print(f'    closed accounts kept:    {round(kept_size / 2**20, 1)} MiB, {len(kept["reserves"])} accounts')
+        print(f'    closed accounts evicted: {round(evicted_size / 2**20, 1)} MiB, {len(evicted["reserves"])} accounts ({round(100 * (1 - evicted_size / kept_size))}% less)')
+    print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--positions', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--markets', type=int, default=4)
+    parser.add_argument('--churn', type=float, default=0.2)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for positions in args.positions:
+        run(positions, args.markets, args.seed, args.churn, args.rounds)
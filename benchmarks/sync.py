@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, '..')
+RESULTS = os.path.join(BENCHMARKS, 'results')
+
+sys.path.insert(0, ROOT)
+
+
+# Runs the bot against benchmarks/mock_node.py and a synthetic chain, without a real node:
+#   python benchmarks/sync.py --markets 4 --accounts 10000 --history 2000 --blocks 200
+# The history is synced in one go first, then one block at a time as main() would, with the health check
+# after every block. Results are saved to benchmarks/results/ and can be compared with an earlier run
+# using --compare. With --reorg-interval every that many blocks the last --reorg-depth blocks are replaced
+# by the node, and --verify checks the state in the end is the same as that of a fresh sync from scratch.
+# With --archive the bot keeps a log archive, which the fresh sync of --verify replays instead of fetching the logs.
+# With --shards the health checks run in that many worker processes, started once the history is synced.
+
+def start_node(args, port, extra_args=[]):
+    node = subprocess.Popen([
+        sys.executable, os.path.join(BENCHMARKS, 'mock_node.py'),
+        '--port', str(port),
+        '--markets', str(args.markets),
+        '--accounts', str(args.accounts),
+        '--events-per-block', str(args.events_per_block),
+        '--max-logs', str(args.max_logs),
+        '--seed', str(args.seed)
+    ] + extra_args)
+    deadline = time.time() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return node
+        except OSError:
+            if node.poll() is not None or time.time() > deadline:
+                node.kill()
+                raise RuntimeError('Mock node did not start')
+            time.sleep(0.1)
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def get_revision():
+    revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return f'{revision}-dirty' if dirty else revision
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def count_calls(stats):
+    return sum(stats['calls'].values())
+
+# The state as plain JSON, for comparisons
+def get_state_json(Liquidation):
+    from state_store import _to_json
+    return json.dumps(Liquidation.state, default=_to_json, sort_keys=True)
+
+def run(args):
+    port = get_free_port()
+    node = start_node(args, port, ['--max-reorg-depth', str(args.reorg_depth)])
+
+    # The bot reads its deployment files and writes its state relative to the working directory
+    workdir = tempfile.mkdtemp(prefix='liquidation-bot-benchmark-')
+    os.symlink(os.path.join(os.path.abspath(ROOT), 'deployments'), os.path.join(workdir, 'deployments'))
+    os.chdir(workdir)
+    os.environ['RPC'] = f'ws://127.0.0.1:{port}'
+    os.environ['NETWORK'] = 'zktestnet'
+    os.environ['PRIVATE_KEY'] = '0x' + '11' * 32
+    if args.archive:
+        os.environ['LOG_ARCHIVE'] = os.path.join(workdir, 'logs')
+    os.environ['HEALTH_CHECK_SHARDS'] = str(args.shards)
+
+    try:
+        import Liquidation
+        import metrics
+        from web3 import Web3
+        # Writes the starting state.json, with the UA address read from the node
+        Liquidation.load_state()
+        shutil.copy('state.json', 'state.initial.json')
+
+        control = Web3(Web3.WebsocketProvider(os.environ['RPC']))
+
+        def node_request(method, params=[]):
+            return control.provider.make_request(method, params)['result']
+
+        results = {'revision': get_revision(), 'time': int(time.time()), 'config': vars(args)}
+
+        # Initial sync of the history, the backfill path if it is longer than BACKFILL_THRESHOLD
+        head = int(node_request('mock_mine', [args.history]), 16)
+        stats = node_request('mock_stats')
+        start = time.perf_counter()
+        Liquidation.sync(head)
+        elapsed = time.perf_counter() - start
+        after = node_request('mock_stats')
+        results['initial_sync'] = {
+            'blocks': args.history,
+            'events': stats['log_count'],
+            'seconds': elapsed,
+            'events_per_second': stats['log_count'] / elapsed,
+            'rpc_calls': count_calls(after) - count_calls(stats)
+        }
+
+        Liquidation.start_shards()
+
+        sync_times = []
+        check_times = []
+        rpc_calls = []
+        events = []
+        checked_accounts = []
+        candidates = []
+
+        reorgs = 0
+        for block in range(args.blocks):
+            before = node_request('mock_stats')
+            if args.reorg_interval > 0 and block % args.reorg_interval == args.reorg_interval - 1:
+                head = int(node_request('mock_reorg', [args.reorg_depth]), 16)
+                reorgs += 1
+            else:
+                head = int(node_request('mock_mine'), 16)
+            mined = node_request('mock_stats')
+
+            start = time.perf_counter()
+            Liquidation.sync(head)
+            synced = time.perf_counter()
+            after = node_request('mock_stats')
+
+            if head % Liquidation.FULL_SWEEP_INTERVAL == 0:
+                Liquidation.sweep_all_accounts()
+            check_start = time.perf_counter()
+            Liquidation.hot_path.active = True
+            try:
+                candidates.append(len(Liquidation.find_liquidation_candidates()))
+            finally:
+                Liquidation.hot_path.active = False
+            check_times.append(time.perf_counter() - check_start)
+            Liquidation.compact_state()
+
+            checked_accounts.append(metrics.ACCOUNTS_EVALUATED.values[()])
+            sync_times.append(synced - start)
+            rpc_calls.append(count_calls(after) - count_calls(mined))
+            events.append(mined['log_count'] - before['log_count'])
+
+        results['per_block'] = {
+            'blocks': args.blocks,
+            'sync_ms_p50': 1000 * statistics.median(sync_times),
+            'sync_ms_p95': 1000 * percentile(sync_times, 0.95),
+            'sync_ms_max': 1000 * max(sync_times),
+            'check_ms_p50': 1000 * statistics.median(check_times),
+            'check_ms_p95': 1000 * percentile(check_times, 0.95),
+            'check_us_per_checked_account': 1e6 * sum(check_times) / max(1, sum(checked_accounts)),
+            'accounts_checked_per_block': sum(checked_accounts) / len(checked_accounts),
+            'candidates_per_block': sum(candidates) / len(candidates),
+            'events_per_second': sum(events) / sum(sync_times),
+            'rpc_calls_per_block': sum(rpc_calls) / len(rpc_calls),
+            'reorgs': reorgs
+        }
+
+        Liquidation.stop_shards()
+
+        if args.verify:
+            from state_store import StateStore
+            synced = get_state_json(Liquidation)
+            shutil.copy('state.initial.json', 'state.json')
+            if os.path.isfile('state.journal'):
+                os.remove('state.journal')
+            if args.archive:
+                Liquidation.archive.flush()
+            Liquidation.state = {}
+            Liquidation.store = StateStore('state.json', 'state.journal', Liquidation.STATE_COMPACTION_INTERVAL, Liquidation.CONFIRMATION_DEPTH, Liquidation.REORG_HISTORY)
+            stats = node_request('mock_stats')
+            start = time.perf_counter()
+            Liquidation.sync(head)
+            elapsed = time.perf_counter() - start
+            after = node_request('mock_stats')
+            results['resync'] = {
+                'blocks': args.history + args.blocks,
+                'seconds': elapsed,
+                'events_per_second': stats['log_count'] / elapsed,
+                'rpc_calls': count_calls(after) - count_calls(stats)
+            }
+            if args.archive:
+                results['resync']['archive_mib'] = Liquidation.archive.get_size() / 2**20
+            results['verified'] = int(get_state_json(Liquidation) == synced)
+
+        # Health check of every account, the cost of a full sweep without the margin engine
+        accounts = list(Liquidation.state['reserves'])
+        start = time.perf_counter()
+        for address in accounts:
+            if len(Liquidation.get_account_positions(address)) > 0:
+                Liquidation.is_position_valid(address)
+        elapsed = time.perf_counter() - start
+        results['health_check'] = {
+            'accounts': len(accounts),
+            'us_per_account': 1e6 * elapsed / len(accounts)
+        }
+
+        # ru_maxrss is in KiB on Linux
+        results['peak_memory_mib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return results
+    finally:
+        node.terminate()
+        node.wait()
+
+# Leaf metrics of a result file, e.g. per_block.sync_ms_p50
+def flatten(results, prefix=''):
+    metrics = {}
+    for key, value in results.items():
+        if key in ['config', 'revision', 'time']:
+            continue
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f'{prefix}{key}.'))
+        else:
+            metrics[f'{prefix}{key}'] = value
+    return metrics
+
+def report(results, baseline=None):
+    metrics = flatten(results)
+    baseline_metrics = flatten(baseline) if baseline is not None else {}
+    if baseline is not None:
+        print(f"Compared with {baseline['revision']}")
+    for name, value in metrics.items():
+        line = f'{name:45} {round(value, 3):>14}'
+        if baseline_metrics.get(name):
+            line += f'  ({round(100 * (value / baseline_metrics[name] - 1), 1):+}%)'
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--markets', type=int, default=4)
+    parser.add_argument('--accounts', type=int, default=10000)
+    parser.add_argument('--events-per-block', type=int, default=20)
+    parser.add_argument('--history', type=int, default=2000)
+    parser.add_argument('--blocks', type=int, default=200)
+    parser.add_argument('--max-logs', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reorg-interval', type=int, default=0)
+    parser.add_argument('--reorg-depth', type=int, default=3)
+    parser.add_argument('--verify', action='store_true', help='compare the state with a fresh sync in the end')
+    parser.add_argument('--archive', action='store_true', help='keep a log archive, replayed by the fresh sync of --verify')
+    parser.add_argument('--shards', type=int, default=0, help='health check worker processes')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, f"{results['revision']}-{results['time']}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    print(f'Saved to {path}')
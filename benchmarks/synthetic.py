@@ -0,0 +1,89 @@
+import random
+
+
+UA_ADDRESS = '0x' + 'ua'.encode().hex().rjust(40, '0')
+
+
+def get_address(rng):
+    return '0x' + ''.join(rng.choice('0123456789abcdef') for _ in range(40))
+
+
+# A state shaped like the one the bot keeps in state.json, with `positions` positions spread over `markets`
+# markets. About lp_share of them are LP positions and shared_share of the accounts trade in more than one market.
+def generate_state(markets=4, positions=10000, seed=0, lp_share=0.2, shared_share=0.1):
+    rng = random.Random(seed)
+
+    state = {
+        'synced_block': 0,
+        'perps': {},
+        'trader_positions': {},
+        'lp_positions': {},
+        'global_positions': {},
+        'reserves': {},
+        'reserve_weights': {UA_ADDRESS: 10**18},
+        'ua_address': UA_ADDRESS,
+        'liquidation_rewards': 0,
+        'min_margin': 3 * 10**16
+    }
+
+    for i in range(markets):
+        idx = str(i)
+        price = rng.randint(1, 3000) * 10**18
+        base_balance = rng.randint(10**4, 10**6) * 10**18
+        state['perps'][idx] = {
+            'address': get_address(rng),
+            'market_address': get_address(rng),
+            'market_out_fee': rng.randint(5, 50) * 10**6,
+            'risk_weight': rng.choice([10**18, 12 * 10**17, 15 * 10**17]),
+            'lp_debt_coef': 3 * 10**18,
+            'index_price': price,
+            'total_liquidity_provided': base_balance * 2,
+            'base_balance': base_balance,
+            'quote_balance': base_balance * price // 10**18
+        }
+        state['global_positions'][idx] = {
+            'cumulative_funding_rate': rng.randint(-10**17, 10**17),
+            'cumulative_funding_rate_per_lp_token': rng.randint(-10**17, 10**17),
+            'total_quote_fees_growth': rng.randint(0, 10**16),
+            'total_base_fees_growth': rng.randint(0, 10**16),
+            'total_trading_fees_growth': rng.randint(0, 10**16)
+        }
+        state['trader_positions'][idx] = {}
+        state['lp_positions'][idx] = {}
+
+    accounts = []
+    for _ in range(positions):
+        if len(accounts) > 0 and rng.random() < shared_share:
+            address = rng.choice(accounts)
+        else:
+            address = get_address(rng)
+            accounts.append(address)
+            state['reserves'][address] = {UA_ADDRESS: rng.randint(100, 10**5) * 10**18}
+
+        idx = str(rng.randrange(markets))
+        perp = state['perps'][idx]
+        global_position = state['global_positions'][idx]
+        # Leverage of up to 8x on the account's collateral, entered up to 10% away from the current price
+        notional = state['reserves'][address][UA_ADDRESS] * rng.randint(-80, 80) // 10
+        position_size = notional * 10**18 // perp['index_price']
+        entry_price = perp['index_price'] * rng.randint(90, 110) // 100
+        open_notional = -position_size * entry_price // 10**18
+
+        if rng.random() < lp_share:
+            state['lp_positions'][idx][address] = {
+                'open_notional': open_notional // 10,
+                'position_size': position_size // 10,
+                'liquidity_balance': rng.randint(1, 10**4) * 10**18,
+                'cumulative_funding_rate_per_lp_token': global_position['cumulative_funding_rate_per_lp_token'] - rng.randint(-10**15, 10**15),
+                'total_quote_fees_growth': global_position['total_quote_fees_growth'] - rng.randint(0, 10**14),
+                'total_base_fees_growth': global_position['total_base_fees_growth'] - rng.randint(0, 10**14),
+                'total_trading_fees_growth': global_position['total_trading_fees_growth'] - rng.randint(0, 10**14)
+            }
+        else:
+            state['trader_positions'][idx][address] = {
+                'open_notional': open_notional,
+                'position_size': position_size,
+                'cumulative_funding_rate': global_position['cumulative_funding_rate'] - rng.randint(-10**15, 10**15)
+            }
+
+    return state
@@ -0,0 +1,415 @@
+import copy
+import json
+import os
+import random
+
+from eth_abi import encode
+from eth_utils import event_abi_to_log_topic, keccak, to_checksum_address
+
+
+DEPLOYMENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deployments')
+
+WAD = 10**18
+CURVE_TRADING_FEE_DECIMALS = 10
+
+# Relative frequency of each kind of event in a block
+EVENT_MIX = {
+    'Deposit': 20,
+    'Withdraw': 5,
+    'ChangePosition': 45,
+    'LiquidityProvided': 8,
+    'LiquidityRemoved': 6,
+    'FundingPaid': 12,
+    'LiquidationCall': 4
+}
+
+
+def load_deployment(network, name):
+    with open(os.path.join(DEPLOYMENTS, network, f'{name}.json')) as f:
+        return json.load(f)
+
+
+def get_events(abi):
+    return {item['name']: item for item in abi if item['type'] == 'event'}
+
+
+def get_address(rng):
+    return to_checksum_address(rng.randbytes(20))
+
+
+# A made up exchange that produces one block of events at a time, with the contract state the bot reads
+# back over eth_call kept next to it. Positions, reserves and pool balances follow the events the same way
+# the bot's handlers apply them, so the state synced by the bot stays consistent.
+# With max_reorg_depth the contract state of that many past blocks is kept, so reorg() can replace them.
+class SyntheticChain:
+    def __init__(self, network='zktestnet', markets=4, accounts=10000, events_per_block=20, seed=0, volatility=0.002, funding_interval=10, max_reorg_depth=0):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.markets = markets
+        self.max_accounts = accounts
+        self.events_per_block = events_per_block
+        self.volatility = volatility
+        self.funding_interval = funding_interval
+
+        clearinghouse = load_deployment(network, 'ClearingHouse')
+        vault = load_deployment(network, 'Vault')
+        self.clearinghouse_address = clearinghouse['address']
+        self.vault_address = vault['address']
+        self.clearinghouse_events = get_events(clearinghouse['abi'])
+        self.vault_events = get_events(vault['abi'])
+        self.perp_events = get_events(load_deployment(network, 'Perpetual')['abi'])
+
+        with open(os.path.join(DEPLOYMENTS, network, 'DeploymentBlock.txt')) as f:
+            self.block_number = int(f.read())
+
+        self.ua_address = get_address(self.rng)
+        self.keeper_address = get_address(self.rng)
+        self.accounts = []
+        self.reserves = {}
+
+        # Contract state, as returned by the view functions
+        self.perps = []
+        self.trader_positions = []
+        self.lp_positions = []
+
+        # block number -> raw logs
+        self.blocks = {}
+        self.log_count = 0
+
+        # block number -> hash, and the contract state as of the end of each of the last max_reorg_depth blocks
+        self.block_hashes = {}
+        self.max_reorg_depth = max_reorg_depth
+        self.history = {}
+        self.forks = 0
+
+    def get_block_hash(self, block_number):
+        if block_number not in self.block_hashes:
+            # Blocks from before the synthetic history
+            return '0x' + keccak(block_number.to_bytes(32, 'big')).hex()
+        return self.block_hashes[block_number]
+
+    def get_header(self, block_number):
+        return {
+            'number': hex(block_number),
+            'hash': self.get_block_hash(block_number),
+            'parentHash': self.get_block_hash(block_number - 1),
+            'timestamp': hex(block_number),
+            'gasLimit': hex(2**32),
+            'gasUsed': '0x0',
+            'miner': '0x' + '00' * 20,
+            'transactions': []
+        }
+
+    def get_contract_state(self):
+        return copy.deepcopy((self.accounts, self.reserves, self.perps, self.trader_positions, self.lp_positions))
+
+    def mine(self):
+        self.block_number += 1
+        self.logs = []
+        self.transaction_index = 0
+        self.block_hashes[self.block_number] = '0x' + keccak(bytes.fromhex(self.get_block_hash(self.block_number - 1)[2:]) + self.block_number.to_bytes(32, 'big') + self.forks.to_bytes(32, 'big')).hex()
+
+        if len(self.blocks) == 0:
+            self.list_markets()
+
+        for _ in range(self.events_per_block):
+            self.emit_random_event()
+
+        for perp in self.perps:
+            perp['index_price'] = max(1, int(perp['index_price'] * (1 + self.rng.gauss(0, self.volatility))))
+            perp['total_trading_fees_growth'] += self.rng.randint(0, 10**12)
+            if self.block_number % self.funding_interval == 0:
+                perp['cum_funding_rate'] += self.rng.randint(-10**15, 10**15)
+                perp['cum_funding_per_lp_token'] += self.rng.randint(-10**15, 10**15)
+
+        self.blocks[self.block_number] = self.logs
+        self.log_count += len(self.logs)
+
+        if self.max_reorg_depth > 0:
+            self.history[self.block_number] = self.get_contract_state()
+            self.history.pop(self.block_number - self.max_reorg_depth - 1, None)
+        return self.block_number
+
+    # Drops the last `depth` blocks and mines `length` different ones in their place
+    def reorg(self, depth, length=None):
+        if depth > self.max_reorg_depth or self.block_number - depth not in self.history:
+            raise ValueError(f'Only the last {self.max_reorg_depth} blocks can be reorged')
+        ancestor = self.block_number - depth
+        self.accounts, self.reserves, self.perps, self.trader_positions, self.lp_positions = copy.deepcopy(self.history[ancestor])
+
+        for block_number in range(ancestor + 1, self.block_number + 1):
+            self.log_count -= len(self.blocks.pop(block_number))
+            self.block_hashes.pop(block_number)
+            self.history.pop(block_number, None)
+        self.block_number = ancestor
+
+        # Different hashes and different events from here on
+        self.forks += 1
+        self.rng.seed(f'{self.seed}-{self.forks}')
+        for _ in range(depth + 1 if length is None else length):
+            self.mine()
+        return self.block_number
+
+    def emit(self, address, event_abi, args):
+        topics = [event_abi_to_log_topic(event_abi)]
+        data_types = []
+        data_values = []
+        for item in event_abi['inputs']:
+            if item['indexed']:
+                topics.append(encode([item['type']], [args[item['name']]]))
+            else:
+                data_types.append(item['type'])
+                data_values.append(args[item['name']])
+
+        transaction_hash = keccak(self.block_number.to_bytes(32, 'big') + self.transaction_index.to_bytes(32, 'big'))
+        self.logs.append({
+            'address': address,
+            'topics': ['0x' + topic.hex() for topic in topics],
+            'data': '0x' + encode(data_types, data_values).hex(),
+            'blockNumber': hex(self.block_number),
+            'blockHash': self.block_hashes[self.block_number],
+            'transactionHash': '0x' + transaction_hash.hex(),
+            'transactionIndex': hex(self.transaction_index),
+            'logIndex': hex(len(self.logs)),
+            'removed': False
+        })
+        self.transaction_index += 1
+
+    def list_markets(self):
+        self.emit(self.clearinghouse_address, self.clearinghouse_events['ClearingHouseParametersChanged'], {
+            'newMinMargin': 3 * 10**16,
+            'newMinMarginAtCreation': 5 * 10**16,
+            'newMinPositiveOpenNotional': 35 * WAD,
+            'newLiquidationReward': 15 * 10**15,
+            'newInsuranceRatio': 10**17,
+            'newLiquidationRewardInsuranceShare': 5 * 10**17,
+            'newLiquidationDiscount': 95 * 10**16,
+            'nonUACollSeizureDiscount': 75 * 10**16,
+            'uaDebtSeizureThreshold': 10000 * WAD
+        })
+        self.emit(self.vault_address, self.vault_events['CollateralAdded'], {'asset': self.ua_address, 'weight': WAD, 'maxAmount': 2**255})
+
+        for idx in range(self.markets):
+            price = self.rng.randint(1, 3000) * WAD
+            base_balance = self.rng.randint(10**4, 10**6) * WAD
+            perp = {
+                'address': get_address(self.rng),
+                'market_address': get_address(self.rng),
+                'out_fee': self.rng.randint(5, 50) * 10**6,
+                'index_price': price,
+                'total_liquidity_provided': 2 * base_balance,
+                'base_balance': base_balance,
+                'quote_balance': base_balance * price // WAD,
+                'cum_funding_rate': 0,
+                'cum_funding_per_lp_token': 0,
+                'total_trading_fees_growth': 0,
+                'total_base_fees_growth': 0,
+                'total_quote_fees_growth': 0
+            }
+            self.perps.append(perp)
+            self.trader_positions.append({})
+            self.lp_positions.append({})
+
+            self.emit(self.clearinghouse_address, self.clearinghouse_events['MarketAdded'], {'perpetual': perp['address'], 'listedIdx': idx, 'numPerpetuals': idx + 1})
+            self.emit(perp['address'], self.perp_events['PerpetualParametersChanged'], {
+                'newRiskWeight': self.rng.choice([WAD, 12 * 10**17, 15 * 10**17]),
+                'newMaxLiquidityProvided': 10**30,
+                'newTwapFrequency': 900,
+                'newSensitivity': WAD,
+                'newMaxBlockTradeAmount': 10**30,
+                'newInsuranceFee': 10**15,
+                'newLpDebtCoef': 3 * WAD,
+                'lockPeriod': 0
+            })
+
+    def emit_random_event(self):
+        kinds = list(EVENT_MIX)
+        kind = self.rng.choices(kinds, weights=[EVENT_MIX[kind] for kind in kinds])[0]
+        if len(self.accounts) == 0 or (kind == 'Deposit' and len(self.accounts) < self.max_accounts):
+            self.deposit(None)
+        elif kind == 'Deposit':
+            self.deposit(self.rng.choice(self.accounts))
+        elif kind == 'Withdraw':
+            self.withdraw(self.rng.choice(self.accounts))
+        elif kind == 'ChangePosition':
+            self.change_position(self.rng.choice(self.accounts), self.rng.randrange(self.markets))
+        elif kind == 'LiquidityProvided':
+            self.provide_liquidity(self.rng.choice(self.accounts), self.rng.randrange(self.markets))
+        elif kind == 'LiquidityRemoved':
+            self.remove_liquidity(self.rng.randrange(self.markets))
+        elif kind == 'FundingPaid':
+            self.pay_funding(self.rng.randrange(self.markets))
+        else:
+            self.liquidate(self.rng.randrange(self.markets))
+
+    def deposit(self, user):
+        if user is None:
+            user = get_address(self.rng)
+            self.accounts.append(user)
+            self.reserves[user] = 0
+        amount = self.rng.randint(100, 10**5) * WAD
+        self.reserves[user] += amount
+        self.emit(self.vault_address, self.vault_events['Deposit'], {'user': user, 'asset': self.ua_address, 'amount': amount})
+
+    def withdraw(self, user):
+        if self.reserves[user] <= 0:
+            return
+        amount = self.rng.randint(0, self.reserves[user] // 2)
+        self.reserves[user] -= amount
+        self.emit(self.vault_address, self.vault_events['Withdraw'], {'user': user, 'asset': self.ua_address, 'amount': amount})
+
+    def change_position(self, user, idx):
+        perp = self.perps[idx]
+        positions = self.trader_positions[idx]
+        fees_in_wad = perp['out_fee'] * 10**(18 - CURVE_TRADING_FEE_DECIMALS)
+
+        if user in positions and self.rng.random() < 0.3:
+            open_notional, position_size, _ = positions.pop(user)
+            proceeds = position_size * perp['index_price'] // WAD
+            trading_fees = abs(proceeds) * fees_in_wad // WAD
+            profit = open_notional + proceeds - trading_fees
+            args = (-open_notional + profit + trading_fees, -position_size, profit, trading_fees, False, True)
+        else:
+            # Up to 8x leverage on the account's collateral
+            notional = max(1, self.reserves[user]) * self.rng.randint(-80, 80) // 10
+            position_size = notional * WAD // perp['index_price']
+            open_notional = -notional
+            trading_fees = abs(notional) * fees_in_wad // WAD
+            if user not in positions:
+                positions[user] = [0, 0, perp['cum_funding_rate']]
+            positions[user][0] += open_notional
+            positions[user][1] += position_size
+            args = (open_notional, position_size, 0, trading_fees, True, False)
+
+        added_open_notional, added_position_size, profit, trading_fees, is_position_increased, is_position_closed = args
+        self.reserves[user] += profit
+        self.emit(self.clearinghouse_address, self.clearinghouse_events['ChangePosition'], {
+            'idx': idx,
+            'user': user,
+            'direction': 0 if added_position_size >= 0 else 1,
+            'addedOpenNotional': added_open_notional,
+            'addedPositionSize': added_position_size,
+            'profit': profit,
+            'tradingFeesPayed': trading_fees,
+            'insuranceFeesPayed': 0,
+            'isPositionIncreased': is_position_increased,
+            'isPositionClosed': is_position_closed
+        })
+
+    def provide_liquidity(self, provider, idx):
+        perp = self.perps[idx]
+        quote_amount = self.rng.randint(1, 10**4) * WAD
+        base_amount = quote_amount * WAD // perp['index_price']
+        liquidity = 2 * base_amount
+
+        if provider not in self.lp_positions[idx]:
+            self.lp_positions[idx][provider] = [0, 0, 0, 0, 0, 0, 0, 0]
+        position = self.lp_positions[idx][provider]
+        position[0] -= quote_amount
+        position[1] -= base_amount
+        position[2] += liquidity
+        position[4] = perp['total_trading_fees_growth']
+        position[5] = perp['total_base_fees_growth']
+        position[6] = perp['total_quote_fees_growth']
+        position[7] = perp['cum_funding_per_lp_token']
+
+        perp['total_liquidity_provided'] += liquidity
+        perp['quote_balance'] += quote_amount
+        perp['base_balance'] += base_amount
+
+        self.emit(self.clearinghouse_address, self.clearinghouse_events['LiquidityProvided'], {
+            'idx': idx,
+            'liquidityProvider': provider,
+            'quoteAmount': quote_amount,
+            'baseAmount': base_amount,
+            'tradingFeesEarned': 0
+        })
+
+    def remove_liquidity(self, idx):
+        if len(self.lp_positions[idx]) == 0:
+            return
+        perp = self.perps[idx]
+        provider = self.rng.choice(list(self.lp_positions[idx]))
+        position = self.lp_positions[idx][provider]
+        is_closed = self.rng.random() < 0.5
+        reduction_ratio = WAD if is_closed else self.rng.randint(1, 9) * 10**17
+
+        liquidity = position[2] * reduction_ratio // WAD
+        perp['total_liquidity_provided'] -= liquidity
+        perp['quote_balance'] -= min(perp['quote_balance'], -position[0] * reduction_ratio // WAD)
+        perp['base_balance'] -= min(perp['base_balance'], -position[1] * reduction_ratio // WAD)
+        if is_closed:
+            del self.lp_positions[idx][provider]
+        else:
+            position[0] -= position[0] * reduction_ratio // WAD
+            position[1] -= position[1] * reduction_ratio // WAD
+            position[2] -= liquidity
+
+        profit = self.rng.randint(-10**3, 10**3) * 10**15
+        self.reserves[provider] += profit
+        self.emit(self.clearinghouse_address, self.clearinghouse_events['LiquidityRemoved'], {
+            'idx': idx,
+            'liquidityProvider': provider,
+            'reductionRatio': reduction_ratio,
+            'profit': profit,
+            'tradingFeesPayed': 0,
+            'isPositionClosed': is_closed
+        })
+
+    def pay_funding(self, idx):
+        perp = self.perps[idx]
+        is_trader = self.rng.random() < 0.8
+        positions = self.trader_positions[idx] if is_trader else self.lp_positions[idx]
+        if len(positions) == 0:
+            return
+        account = self.rng.choice(list(positions))
+        global_rate = perp['cum_funding_rate'] if is_trader else perp['cum_funding_per_lp_token']
+        user_rate = positions[account][2] if is_trader else positions[account][7]
+        if is_trader:
+            positions[account][2] = global_rate
+        else:
+            positions[account][7] = global_rate
+
+        amount = self.rng.randint(-10**3, 10**3) * 10**15
+        self.reserves[account] += amount
+        self.emit(perp['address'], self.perp_events['FundingPaid'], {
+            'account': account,
+            'amount': amount,
+            'globalCumulativeFundingRate': global_rate,
+            'userCumulativeFundingRate': user_rate,
+            'isTrader': is_trader
+        })
+
+    def liquidate(self, idx):
+        positions = self.trader_positions[idx]
+        if len(positions) == 0:
+            return
+        perp = self.perps[idx]
+        liquidatee = self.rng.choice(list(positions))
+        open_notional, position_size, _ = positions.pop(liquidatee)
+        notional = abs(position_size * perp['index_price'] // WAD)
+        profit = -notional // 100
+
+        self.reserves[liquidatee] += profit
+        self.reserves.setdefault(self.keeper_address, 0)
+        self.emit(self.clearinghouse_address, self.clearinghouse_events['LiquidationCall'], {
+            'idx': idx,
+            'liquidatee': liquidatee,
+            'liquidator': self.keeper_address,
+            'notional': notional,
+            'profit': profit,
+            'tradingFeesPayed': 0,
+            'isTrader': True
+        })
+
+    # Return values of the view functions the bot calls, by contract address and function name
+    def get_global_position(self, idx):
+        perp = self.perps[idx]
+        return (0, 0, perp['cum_funding_rate'], 0, 0, perp['cum_funding_per_lp_token'], 0,
+                perp['total_trading_fees_growth'], perp['total_base_fees_growth'], perp['total_quote_fees_growth'], 0, 0)
+
+    def get_trader_position(self, idx, account):
+        return tuple(self.trader_positions[idx].get(account, (0, 0, 0)))
+
+    def get_lp_position(self, idx, account):
+        return tuple(self.lp_positions[idx].get(account, (0, 0, 0, 0, 0, 0, 0, 0)))
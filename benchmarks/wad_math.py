@@ -0,0 +1,90 @@
+import argparse
+import os
+import random
+import sys
+import timeit
+from fractions import Fraction
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compact_state import intern_accounts
+from scalar import load_helpers, get_source
+from synthetic import generate_state
+from wad import WAD, wad_mul, wad_div, mul_div
+
+
+# Checks the fixed-point functions against exact rational arithmetic, measures how far the float formulas
+# they replaced are off, and times both:
+#   python benchmarks/wad_math.py --baseline <revision with the float helpers>
+
+def truncate(value):
+    return int(value) if value >= 0 else -int(-value)
+
+def get_operands(rng, count):
+    # Magnitudes seen in the state, from fee growths around 1e12 up to notionals around 1e27
+    return [
+        (rng.choice([-1, 1]) * rng.randint(1, 10**rng.randint(12, 27)), rng.randint(1, 10**rng.randint(12, 22)))
+        for _ in range(count)
+    ]
+
+OPERATIONS = [
+    ('wad_mul', wad_mul, lambda a, b: int(a / (10**18) * b), lambda a, b: truncate(Fraction(a * b, WAD))),
+    ('wad_div', wad_div, lambda a, b: int(a / b * (10**18)), lambda a, b: truncate(Fraction(a * WAD, b))),
+    ('mul_div', lambda a, b: mul_div(a, b, b + WAD), lambda a, b: int(a * b / (b + WAD)), lambda a, b: truncate(Fraction(a * b, b + WAD)))
+]
+
+def check_operations(operands):
+    failures = 0
+    for name, exact, approximate, reference in OPERATIONS:
+        wrong = sum(1 for a, b in operands if exact(a, b) != reference(a, b))
+        errors = [abs(approximate(a, b) - reference(a, b)) for a, b in operands]
+        off = sum(1 for error in errors if error != 0)
+
+        # Best of several runs, a single one is too noisy to compare functions a few ns apart
+        exact_time = min(timeit.repeat(lambda: [exact(a, b) for a, b in operands], number=1, repeat=7))
+        float_time = min(timeit.repeat(lambda: [approximate(a, b) for a, b in operands], number=1, repeat=7))
+        per_call = 1e9 / len(operands)
+
+        print(f'{name}: {wrong} wrong, float formula off on {off}/{len(operands)} (max {max(errors)} wei), '
+              f'{round(exact_time * per_call)}ns exact vs {round(float_time * per_call)}ns float')
+        failures += wrong
+    print()
+    return failures
+
+def check_helpers(positions, markets, seed, baseline):
+    state = intern_accounts(generate_state(markets, positions, seed))
+    accounts = list(state['reserves'])
+    exact = load_helpers(state)
+
+    def free_collateral(helpers):
+        return {address: helpers['get_free_collateral'](*helpers['get_margin_components'](address)) for address in accounts}
+
+    exact_results = free_collateral(exact)
+    exact_time = timeit.timeit(lambda: free_collateral(exact), number=3) / 3
+    print(f'{positions} positions: exact helpers {round(1e6 * exact_time / len(accounts), 2)}us per account')
+    if baseline is None:
+        return
+
+    approximate = load_helpers(state, get_source(baseline))
+    float_results = free_collateral(approximate)
+    float_time = timeit.timeit(lambda: free_collateral(approximate), number=3) / 3
+    deviations = [abs(exact_results[address] - float_results[address]) for address in accounts]
+    flipped = sum(1 for address in accounts if (exact_results[address] >= exact['MIN_FREE_COLLATERAL']) != (float_results[address] >= approximate['MIN_FREE_COLLATERAL']))
+    print(f'  float helpers at {baseline}: {round(1e6 * float_time / len(accounts), 2)}us per account')
+    print(f'  free collateral differs for {sum(1 for deviation in deviations if deviation != 0)}/{len(accounts)} accounts, '
+          f'by up to {max(deviations)} wei, {flipped} classified differently')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--positions', type=int, default=100000)
+    parser.add_argument('--markets', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help='git revision whose helpers to compare with')
+    args = parser.parse_args()
+
+    failures = check_operations(get_operands(random.Random(args.seed), args.samples))
+    check_helpers(args.positions, args.markets, args.seed, args.baseline)
+    if failures > 0:
+        sys.exit(f'{failures} results differ from exact rational arithmetic')
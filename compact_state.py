@@ -0,0 +1,410 @@
+import argparse
+import json
+from collections.abc import MutableMapping
+
+from state_store import StateStore
+
+
+# Compact in-memory layout for the per-account parts of the state. Addresses are interned to integer ids
+# once, positions are slotted records instead of string-keyed dicts and reserve balances live in one column
+# per asset, indexed by account id. Every level still behaves like the nested dicts it replaces, so
+# state['lp_positions'][idx][address]['position_size'] and friends read and write exactly as before.
+#
+# Accounts that hold nothing any more are removed from the state by evict_inactive, and their ids are reused by
+# the next new accounts, so memory follows the accounts with open positions or balances rather than every account
+# ever seen. `python compact_state.py` does the same to state.json offline and reports its size by section.
+
+TRADER_FIELDS = ('open_notional', 'position_size', 'cumulative_funding_rate')
+LP_FIELDS = (
+    'open_notional',
+    'position_size',
+    'liquidity_balance',
+    'cumulative_funding_rate_per_lp_token',
+    'total_quote_fees_growth',
+    'total_base_fees_growth',
+    'total_trading_fees_growth'
+)
+
+
+class AccountRegistry:
+    def __init__(self):
+        self.ids = {}
+        self.addresses = []
+        # account id -> (idx, is_trader) of every open position, kept up to date by the position tables
+        self.positions = {}
+        # Ids of removed accounts, handed out again before new ones
+        self.free_ids = []
+        # The ReserveColumns of the state, set by it. An account's id is only freed once it has no reserves entry either.
+        self.reserves = None
+
+    # Number of ids handed out, the length of the per-account columns
+    def __len__(self):
+        return len(self.addresses)
+
+    def get_account_count(self):
+        return len(self.ids)
+
+    def intern(self, address):
+        account_id = self.ids.get(address)
+        if account_id is None:
+            if len(self.free_ids) > 0:
+                account_id = self.free_ids.pop()
+                self.addresses[account_id] = address
+            else:
+                account_id = len(self.addresses)
+                self.addresses.append(address)
+            self.ids[address] = account_id
+        return account_id
+
+    def release(self, account_id):
+        if account_id in self.positions or (self.reserves is not None and self.reserves.has_id(account_id)):
+            return
+        del self.ids[self.addresses[account_id]]
+        self.addresses[account_id] = None
+        self.free_ids.append(account_id)
+
+    def get_positions(self, address):
+        return self.positions.get(self.ids.get(address), ())
+
+    def add_position(self, account_id, position):
+        self.positions[account_id] = self.positions.get(account_id, ()) + (position,)
+
+    def remove_position(self, account_id, position):
+        positions = tuple(item for item in self.positions[account_id] if item != position)
+        if len(positions) > 0:
+            self.positions[account_id] = positions
+        else:
+            del self.positions[account_id]
+            self.release(account_id)
+
+
+# Fields that were never set are missing from the mapping, like keys that were never added to a dict
+class PositionRecord(MutableMapping):
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, values=()):
+        for key, value in dict(values).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.fields and hasattr(self, key)
+
+    def __iter__(self):
+        return (key for key in self.fields if hasattr(self, key))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)})'
+
+
+class TraderPosition(PositionRecord):
+    __slots__ = TRADER_FIELDS
+    fields = TRADER_FIELDS
+
+
+class LpPosition(PositionRecord):
+    __slots__ = LP_FIELDS
+    fields = LP_FIELDS
+
+
+# The positions of one market, address -> record
+class PositionTable(MutableMapping):
+    def __init__(self, registry, record_class, idx, is_trader, positions=()):
+        self.registry = registry
+        self.record_class = record_class
+        self.position = (idx, is_trader)
+        self.records = {}
+        for address, position in dict(positions).items():
+            self[address] = position
+
+    def __getitem__(self, address):
+        return self.records[self.registry.ids[address]]
+
+    def __setitem__(self, address, position):
+        if not isinstance(position, self.record_class):
+            position = self.record_class(position)
+        account_id = self.registry.intern(address)
+        if account_id not in self.records:
+            self.registry.add_position(account_id, self.position)
+        self.records[account_id] = position
+
+    def __delitem__(self, address):
+        account_id = self.registry.ids[address]
+        del self.records[account_id]
+        self.registry.remove_position(account_id, self.position)
+
+    def __contains__(self, address):
+        return self.registry.ids.get(address) in self.records
+
+    def __iter__(self):
+        addresses = self.registry.addresses
+        return (addresses[account_id] for account_id in self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    # Takes the table's positions out of the registry before it is replaced or removed
+    def detach(self):
+        for account_id in self.records:
+            self.registry.remove_position(account_id, self.position)
+
+
+# market idx -> PositionTable, markets set from plain dicts (new listings, rollbacks) are converted
+class MarketPositions(MutableMapping):
+    def __init__(self, registry, record_class, is_trader, markets=()):
+        self.registry = registry
+        self.record_class = record_class
+        self.is_trader = is_trader
+        self.markets = {}
+        for idx, positions in dict(markets).items():
+            self[idx] = positions
+
+    def __getitem__(self, idx):
+        return self.markets[idx]
+
+    # The record itself for code on the hot path, which already has the account id
+    def get_record(self, idx, account_id):
+        return self.markets[idx].records[account_id]
+
+    def __setitem__(self, idx, positions):
+        if idx in self.markets:
+            self.markets[idx].detach()
+        self.markets[idx] = PositionTable(self.registry, self.record_class, idx, self.is_trader, positions)
+
+    def __delitem__(self, idx):
+        self.markets.pop(idx).detach()
+
+    def __contains__(self, idx):
+        return idx in self.markets
+
+    def __iter__(self):
+        return iter(self.markets)
+
+    def __len__(self):
+        return len(self.markets)
+
+
+# address -> {asset: balance}, stored as one list per asset indexed by account id. None marks an asset
+# the account has no entry for.
+class ReserveColumns(MutableMapping):
+    def __init__(self, registry, reserves=()):
+        self.registry = registry
+        registry.reserves = self
+        self.columns = {}
+        self.present = bytearray()
+        self.count = 0
+        for address, balances in dict(reserves).items():
+            self[address] = balances
+
+    def column(self, asset, account_id):
+        column = self.columns.setdefault(asset, [])
+        if len(column) <= account_id:
+            column.extend([None] * (len(self.registry) - len(column)))
+        return column
+
+    # (asset, balance) of every asset the account has an entry for
+    def get_balances(self, account_id):
+        return [
+            (asset, column[account_id]) for asset, column in self.columns.items()
+            if account_id < len(column) and column[account_id] is not None
+        ]
+
+    def has_id(self, account_id):
+        return account_id < len(self.present) and self.present[account_id] == 1
+
+    def get_id(self, address):
+        account_id = self.registry.ids.get(address)
+        if account_id is None or account_id >= len(self.present) or not self.present[account_id]:
+            raise KeyError(address)
+        return account_id
+
+    def __getitem__(self, address):
+        return AccountReserves(self, self.get_id(address))
+
+    def __setitem__(self, address, balances):
+        balances = dict(balances)
+        account_id = self.registry.intern(address)
+        if account_id >= len(self.present):
+            self.present.extend(bytes(len(self.registry) - len(self.present)))
+        if not self.present[account_id]:
+            self.present[account_id] = 1
+            self.count += 1
+
+        for asset, column in self.columns.items():
+            if account_id < len(column):
+                column[account_id] = None
+        for asset, balance in balances.items():
+            self.column(asset, account_id)[account_id] = balance
+
+    def __delitem__(self, address):
+        account_id = self.get_id(address)
+        self.present[account_id] = 0
+        self.count -= 1
+        for column in self.columns.values():
+            if account_id < len(column):
+                column[account_id] = None
+        self.registry.release(account_id)
+
+    def __contains__(self, address):
+        account_id = self.registry.ids.get(address)
+        return account_id is not None and self.has_id(account_id)
+
+    def __iter__(self):
+        addresses = self.registry.addresses
+        return (addresses[account_id] for account_id, present in enumerate(self.present) if present)
+
+    def __len__(self):
+        return self.count
+
+
+class AccountReserves(MutableMapping):
+    __slots__ = ('table', 'account_id')
+
+    def __init__(self, table, account_id):
+        self.table = table
+        self.account_id = account_id
+
+    def __getitem__(self, asset):
+        column = self.table.columns.get(asset)
+        if column is None or self.account_id >= len(column) or column[self.account_id] is None:
+            raise KeyError(asset)
+        return column[self.account_id]
+
+    def __setitem__(self, asset, balance):
+        self.table.column(asset, self.account_id)[self.account_id] = balance
+
+    def __delitem__(self, asset):
+        self[asset]
+        self.table.columns[asset][self.account_id] = None
+
+    def __iter__(self):
+        return (asset for asset, column in self.table.columns.items() if self.account_id < len(column) and column[self.account_id] is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+# Converts a state loaded from state.json in place and returns it
+def intern_accounts(state):
+    registry = AccountRegistry()
+    state['trader_positions'] = MarketPositions(registry, TraderPosition, True, state['trader_positions'])
+    state['lp_positions'] = MarketPositions(registry, LpPosition, False, state['lp_positions'])
+    state['reserves'] = ReserveColumns(registry, state['reserves'])
+    return state
+
+
+
+# An LP position with no liquidity, size or open notional left, or one never filled in by refresh_lp_positions
+def is_empty_lp_position(position):
+    return all(position.get(field, 0) == 0 for field in ('liquidity_balance', 'position_size', 'open_notional'))
+
+
+# Drops what can no longer matter to a health check from the given accounts: zero reserve balances, empty LP
+# positions, and the whole reserves entry once the account has neither a balance nor a position. Events that
+# bring an account back recreate its entries from zero. touch(*path) is called before every change, for the
+# state store. Works on both the interned and the plain state, returns the accounts removed.
+def evict_inactive(state, addresses, touch=lambda *path: None):
+    evicted = []
+    for address in addresses:
+        has_positions = False
+        for idx, positions in state['lp_positions'].items():
+            position = positions.get(address)
+            if position is None:
+                continue
+            if is_empty_lp_position(position):
+                touch('lp_positions', idx, address)
+                del positions[address]
+            else:
+                has_positions = True
+        has_positions = has_positions or any(address in positions for positions in state['trader_positions'].values())
+
+        reserves = state['reserves'].get(address)
+        if reserves is None:
+            continue
+        zero_assets = [asset for asset, balance in reserves.items() if balance == 0]
+        if len(zero_assets) == len(reserves) and not has_positions:
+            touch('reserves', address)
+            del state['reserves'][address]
+            evicted.append(address)
+        elif len(zero_assets) > 0:
+            touch('reserves', address)
+            for asset in zero_assets:
+                del reserves[asset]
+    return evicted
+
+
+def get_accounts(state):
+    accounts = set(state['reserves'])
+    for section in ['trader_positions', 'lp_positions']:
+        for positions in state[section].values():
+            accounts.update(positions)
+    return accounts
+
+
+# Entries and JSON bytes of each section of the state, the per-account sections first
+def get_section_sizes(state):
+    sizes = {
+        'accounts': (len(get_accounts(state)), 0),
+        'reserves': (len(state['reserves']), len(json.dumps(state['reserves']))),
+        'zero balances': (sum(1 for balances in state['reserves'].values() for balance in balances.values() if balance == 0), 0),
+        'trader_positions': (sum(len(positions) for positions in state['trader_positions'].values()), len(json.dumps(state['trader_positions']))),
+        'lp_positions': (sum(len(positions) for positions in state['lp_positions'].values()), len(json.dumps(state['lp_positions']))),
+        'empty lp positions': (sum(1 for positions in state['lp_positions'].values() for position in positions.values() if is_empty_lp_position(position)), 0)
+    }
+    for key, value in state.items():
+        if key not in sizes:
+            sizes[key] = (len(value) if isinstance(value, dict) else 1, len(json.dumps(value)))
+    return sizes
+
+
+def print_section_sizes(before, after=None):
+    for section, (entries, size) in before.items():
+        line = f'{section:30} {entries:>10}'
+        if after is not None:
+            line += f' -> {after[section][0]:>10}'
+        if size > 0:
+            line += f'  {round(size / 2**10, 1):>10} KiB'
+            if after is not None:
+                line += f' -> {round(after[section][1] / 2**10, 1):>10} KiB'
+        print(line)
+
+
+if __name__ == '__main__':
+    # Evicts inactive accounts from state.json and state.journal, with the bot stopped as the files are rewritten
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--state', default='state.json')
+    parser.add_argument('--journal', default='state.journal')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be removed')
+    args = parser.parse_args()
+
+    store = StateStore(args.state, args.journal)
+    state = store.load()
+    before = get_section_sizes(state)
+    evicted = evict_inactive(state, get_accounts(state))
+    print_section_sizes(before, get_section_sizes(state))
+    print(f'{len(evicted)} inactive accounts removed')
+    if not args.dry_run:
+        store.compact(state)
+        print(f'Wrote {args.state}')
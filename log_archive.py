@@ -0,0 +1,216 @@
+import gzip
+import os
+import re
+import struct
+import sys
+
+from log_decoder import to_bytes, to_int
+
+
+# Raw logs fetched by the sync, kept on disk so a cold start can replay the history instead of fetching it again.
+# The archive covers a run of consecutive blocks with every followed log in them, split over gzip compressed chunk
+# files named <first block>-<last block>.logs.gz. Each chunk is a sequence of length-prefixed binary records in
+# (block number, transaction index, log index) order. Only blocks CONFIRMATION_DEPTH deep are written, newer ones
+# are kept in memory where a reorg can drop them, and chunks are never changed once written except to cut off
+# blocks rolled back by a reorg deeper than that.
+
+# block number, transaction index, log index, address, block hash, transaction hash, topic count, data length,
+# followed by the topics and the data
+RECORD = struct.Struct('>QII20s32s32sBI')
+
+CHUNK_NAME = re.compile(r'(\d+)-(\d+)\.logs\.gz')
+
+
+def encode_log(raw_log):
+    topics = [to_bytes(topic) for topic in raw_log['topics']]
+    data = to_bytes(raw_log['data'])
+    key = (to_int(raw_log['blockNumber']), to_int(raw_log['transactionIndex']), to_int(raw_log['logIndex']))
+    header = RECORD.pack(*key, to_bytes(raw_log['address']), to_bytes(raw_log['blockHash']), to_bytes(raw_log['transactionHash']), len(topics), len(data))
+    return key, header + b''.join(topics) + data
+
+
+# Records back into raw logs, with bytes and ints where the node has hex strings, as LogDecoder takes either
+def decode_records(buffer):
+    offset = 0
+    while offset < len(buffer):
+        block_number, transaction_index, log_index, address, block_hash, transaction_hash, topic_count, data_length = RECORD.unpack_from(buffer, offset)
+        offset += RECORD.size
+        topics = [buffer[offset + 32 * i:offset + 32 * (i + 1)] for i in range(topic_count)]
+        offset += 32 * topic_count
+        yield {
+            'address': address,
+            'topics': topics,
+            'data': buffer[offset:offset + data_length],
+            'blockNumber': block_number,
+            'blockHash': block_hash,
+            'transactionHash': transaction_hash,
+            'transactionIndex': transaction_index,
+            'logIndex': log_index
+        }
+        offset += data_length
+
+
+class PendingRange:
+    __slots__ = ('from_block', 'to_block', 'records')
+
+    def __init__(self, from_block, to_block, records):
+        self.from_block = from_block
+        self.to_block = to_block
+        self.records = records
+
+
+class LogArchive:
+    def __init__(self, path, confirmation_depth=0, chunk_blocks=10000, chunk_logs=20000):
+        self.path = path
+        self.confirmation_depth = confirmation_depth
+        self.chunk_blocks = chunk_blocks
+        self.chunk_logs = chunk_logs
+
+        os.makedirs(path, exist_ok=True)
+        # (first block, last block) of every chunk file in block order
+        self.chunks = []
+        for name in os.listdir(path):
+            match = CHUNK_NAME.fullmatch(name)
+            if match is not None:
+                self.chunks.append((int(match.group(1)), int(match.group(2))))
+            elif name.endswith('.tmp'):
+                os.remove(os.path.join(path, name))
+        self.chunks.sort()
+
+        # Only the run of chunks from the first one is used, a gap means the files after it were left by something else
+        for i in range(1, len(self.chunks)):
+            if self.chunks[i][0] != self.chunks[i - 1][1] + 1:
+                print(f'Log archive: ignoring chunks from block {self.chunks[i][0]}, blocks {self.chunks[i - 1][1] + 1} to {self.chunks[i][0] - 1} are missing')
+                self.chunks = self.chunks[:i]
+                break
+
+        # Ranges added since the last chunk was written, confirmed or not
+        self.pending = []
+
+    def get_chunk_path(self, first_block, last_block):
+        return os.path.join(self.path, f'{first_block}-{last_block}.logs.gz')
+
+    def get_first_block(self):
+        if len(self.chunks) > 0:
+            return self.chunks[0][0]
+        if len(self.pending) > 0:
+            return self.pending[0].from_block
+        return None
+
+    # Last block with its logs in the archive, None when empty
+    def get_end(self):
+        if len(self.pending) > 0:
+            return self.pending[-1].to_block
+        if len(self.chunks) > 0:
+            return self.chunks[-1][1]
+        return None
+
+    # Last block of the archive that is deep enough to be trusted
+    def get_confirmed_end(self):
+        end = self.chunks[-1][1] if len(self.chunks) > 0 else None
+        if len(self.pending) > 0:
+            confirmed_block = self.pending[-1].to_block - self.confirmation_depth
+            for pending in self.pending:
+                if pending.to_block > confirmed_block:
+                    break
+                end = pending.to_block
+        return end
+
+    # Last block of [from_block, to_block] the archive can replay from from_block on, from_block - 1 if none
+    def get_replay_end(self, from_block, to_block):
+        first_block = self.get_first_block()
+        confirmed_end = self.get_confirmed_end()
+        if first_block is None or confirmed_end is None or not first_block <= from_block <= confirmed_end:
+            return from_block - 1
+        return min(to_block, confirmed_end)
+
+    # Adds every followed log of [from_block, to_block], replacing what the archive had from from_block on.
+    # Ranges already confirmed in the archive are left as they are, and ones that would leave a gap are skipped.
+    def add(self, from_block, to_block, raw_logs):
+        end = self.get_end()
+        if end is not None and from_block != end + 1:
+            confirmed_end = self.get_confirmed_end()
+            if from_block < self.get_first_block() or from_block > end + 1 or (confirmed_end is not None and to_block <= confirmed_end):
+                return False
+            self.revert(from_block - 1)
+
+        records = sorted(encode_log(raw_log) for raw_log in raw_logs)
+        self.pending.append(PendingRange(from_block, to_block, [record for _, record in records]))
+        self.write_confirmed()
+        return True
+
+    # Writes the confirmed pending ranges once there are enough of them for a chunk, or all of them with force
+    def write_confirmed(self, force=False):
+        confirmed_end = self.get_confirmed_end()
+        confirmed = [pending for pending in self.pending if confirmed_end is not None and pending.to_block <= confirmed_end]
+        if len(confirmed) == 0:
+            return
+        blocks = confirmed[-1].to_block - confirmed[0].from_block + 1
+        log_count = sum(len(pending.records) for pending in confirmed)
+        if not force and blocks < self.chunk_blocks and log_count < self.chunk_logs:
+            return
+
+        self.write_chunk(confirmed[0].from_block, confirmed[-1].to_block, [record for pending in confirmed for record in pending.records])
+        self.pending = self.pending[len(confirmed):]
+
+    def flush(self):
+        self.write_confirmed(force=True)
+
+    def write_chunk(self, first_block, last_block, records):
+        path = self.get_chunk_path(first_block, last_block)
+        with gzip.open(path + '.tmp', 'wb') as f:
+            f.write(b''.join(records))
+        os.replace(path + '.tmp', path)
+        self.chunks.append((first_block, last_block))
+
+    def read_chunk(self, first_block, last_block):
+        with gzip.open(self.get_chunk_path(first_block, last_block), 'rb') as f:
+            return f.read()
+
+    # Raw logs of [from_block, to_block] in order, streamed a chunk at a time
+    def read(self, from_block, to_block):
+        for first_block, last_block in list(self.chunks):
+            if last_block < from_block or first_block > to_block:
+                continue
+            for raw_log in decode_records(self.read_chunk(first_block, last_block)):
+                if from_block <= raw_log['blockNumber'] <= to_block:
+                    yield raw_log
+        for pending in list(self.pending):
+            if pending.to_block < from_block or pending.from_block > to_block:
+                continue
+            for raw_log in decode_records(b''.join(pending.records)):
+                if from_block <= raw_log['blockNumber'] <= to_block:
+                    yield raw_log
+
+    # Drops everything after block, cutting the chunk it falls in short
+    def revert(self, block):
+        self.pending = [pending for pending in self.pending if pending.to_block <= block]
+        if len(self.pending) > 0 or len(self.chunks) == 0 or self.chunks[-1][1] <= block:
+            return
+
+        while len(self.chunks) > 0 and self.chunks[-1][1] > block:
+            first_block, last_block = self.chunks.pop()
+            path = self.get_chunk_path(first_block, last_block)
+            if first_block <= block:
+                kept = [raw_log for raw_log in decode_records(self.read_chunk(first_block, last_block)) if raw_log['blockNumber'] <= block]
+                self.write_chunk(first_block, block, [encode_log(raw_log)[1] for raw_log in kept])
+            os.remove(path)
+
+    def get_size(self):
+        return sum(os.path.getsize(self.get_chunk_path(*chunk)) for chunk in self.chunks)
+
+
+if __name__ == '__main__':
+    # python log_archive.py <archive directory>, reads every chunk back and prints what the archive holds
+    archive = LogArchive(sys.argv[1])
+    if len(archive.chunks) == 0:
+        print('Empty archive')
+        sys.exit()
+    log_count = 0
+    raw_size = 0
+    for first_block, last_block in archive.chunks:
+        buffer = archive.read_chunk(first_block, last_block)
+        raw_size += len(buffer)
+        log_count += sum(1 for _ in decode_records(buffer))
+    print(f'Blocks {archive.chunks[0][0]} to {archive.chunks[-1][1]} in {len(archive.chunks)} chunks, {log_count} logs')
+    print(f'{round(archive.get_size() / 2**20, 1)} MiB on disk, {round(raw_size / 2**20, 1)} MiB uncompressed')
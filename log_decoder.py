@@ -0,0 +1,161 @@
+import re
+from functools import lru_cache, partial
+
+from eth_abi.decoding import ContextFramesBytesIO
+from eth_abi.registry import registry
+from eth_utils import event_abi_to_log_topic, to_checksum_address
+from eth_utils.abi import collapse_if_tuple
+from hexbytes import HexBytes
+
+
+# Decodes raw eth_getLogs results without web3's contract event machinery. A decoder per followed event is
+# built once from the ABIs, keyed by topic0, and logs come out as slotted EventLog records that read like
+# web3's: log['event'], log['args']['amount'], log['address'] (checksummed), log['blockNumber'] and so on.
+# Raw logs can be the node's hex strings or already formatted by web3.
+
+STATIC_TYPE = re.compile(r'(u?int)(\d*)|bytes(\d+)|address|bool')
+
+# Checksummed addresses cached, the same few thousand accounts come up over and over. Bounded, so accounts
+# long gone don't stay in memory.
+CHECKSUM_CACHE_SIZE = 2**15
+
+
+@lru_cache(maxsize=CHECKSUM_CACHE_SIZE)
+def checksum_address(address):
+    return to_checksum_address(address)
+
+
+# Takes a raw address or a 32 byte word, as bytes or hex, the cache is keyed by the 20 byte address either way
+def get_checksum_address(value):
+    if isinstance(value, str):
+        return checksum_address(bytes.fromhex(value[-40:]))
+    return checksum_address(bytes(value[-20:]))
+
+
+def to_bytes(value):
+    if isinstance(value, str):
+        return bytes.fromhex(value[2:])
+    return bytes(value)
+
+
+def to_int(value):
+    return int(value, 16) if isinstance(value, str) else value
+
+
+# Decoder of one 32 byte word for the static elementary types, None for anything that needs eth_abi
+def get_word_decoder(abi_type):
+    match = STATIC_TYPE.fullmatch(abi_type)
+    if match is None:
+        return None
+    if abi_type == 'address':
+        return get_checksum_address
+    if abi_type == 'bool':
+        return lambda word: word[31] == 1
+    if match.group(3) is not None:
+        size = int(match.group(3))
+        return lambda word: word[:size]
+    return partial(int.from_bytes, byteorder='big', signed=match.group(1) == 'int')
+
+
+class EventLog:
+    __slots__ = ('event', 'args', 'address', 'blockNumber', 'blockHash', 'transactionIndex', 'logIndex', 'transactionHash')
+
+    def __init__(self, event, args, address, block_number, block_hash, transaction_index, log_index, transaction_hash):
+        self.event = event
+        self.args = args
+        self.address = address
+        self.blockNumber = block_number
+        self.blockHash = block_hash
+        self.transactionIndex = transaction_index
+        self.logIndex = log_index
+        self.transactionHash = transaction_hash
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __repr__(self):
+        return f'EventLog({", ".join(f"{key}={getattr(self, key)!r}" for key in self.__slots__)})'
+
+
+class EventDecoder:
+    def __init__(self, event_abi):
+        self.name = event_abi['name']
+        indexed = [item for item in event_abi['inputs'] if item['indexed']]
+        data = [item for item in event_abi['inputs'] if not item['indexed']]
+        self.topic_count = 1 + len(indexed)
+
+        # Indexed dynamic types are only there as their hash, which web3 hands out as is too, their decoder is None
+        self.indexed = [(item['name'], get_word_decoder(item['type'])) for item in indexed]
+
+        # Events made of static types are decoded word by word, the rest with the eth_abi decoder of the tuple
+        word_decoders = [get_word_decoder(item['type']) for item in data]
+        if all(decoder is not None for decoder in word_decoders):
+            self.words = [(item['name'], decoder, 32 * i) for i, (item, decoder) in enumerate(zip(data, word_decoders))]
+            self.data_size = 32 * len(data)
+            self.data_decoder = None
+        else:
+            self.data_names = [item['name'] for item in data]
+            self.data_addresses = [item['type'] == 'address' for item in data]
+            self.data_decoder = registry.get_tuple_decoder(*[collapse_if_tuple(item) for item in data])
+
+    def decode(self, raw_log):
+        topics = raw_log['topics']
+        if len(topics) != self.topic_count:
+            raise ValueError(f'{self.name} log has {len(topics)} topics instead of {self.topic_count}')
+
+        args = {}
+        for (name, decode), topic in zip(self.indexed, topics[1:]):
+            word = to_bytes(topic)
+            args[name] = word if decode is None else decode(word)
+
+        data = to_bytes(raw_log['data'])
+        if self.data_decoder is None:
+            if len(data) < self.data_size:
+                raise ValueError(f'{self.name} log has {len(data)} bytes of data instead of {self.data_size}')
+            for name, decode, start in self.words:
+                args[name] = decode(data[start:start + 32])
+        else:
+            values = self.data_decoder(ContextFramesBytesIO(data))
+            for name, is_address, value in zip(self.data_names, self.data_addresses, values):
+                args[name] = to_checksum_address(value) if is_address else value
+
+        return EventLog(
+            self.name,
+            args,
+            get_checksum_address(raw_log['address']),
+            to_int(raw_log['blockNumber']),
+            HexBytes(raw_log['blockHash']),
+            to_int(raw_log['transactionIndex']),
+            to_int(raw_log['logIndex']),
+            HexBytes(raw_log['transactionHash'])
+        )
+
+
+class LogDecoder:
+    # contract_events: (abi, names of the events followed on that contract) pairs
+    def __init__(self, contract_events):
+        self.decoders = {}
+        self.topics = {}
+        for abi, event_names in contract_events:
+            events = {item['name']: item for item in abi if item['type'] == 'event'}
+            for event_name in event_names:
+                topic = event_abi_to_log_topic(events[event_name])
+                decoder = EventDecoder(events[event_name])
+                # Keyed by both, so topic0 is looked up as it comes whether it is a hex string or bytes
+                self.decoders[topic] = decoder
+                self.decoders['0x' + topic.hex()] = decoder
+                self.topics[event_name] = '0x' + topic.hex()
+
+    def get_topics(self, event_names=None):
+        return [self.topics[event_name] for event_name in (event_names or self.topics)]
+
+    def decode(self, raw_logs):
+        decoders = self.decoders
+        for raw_log in raw_logs:
+            yield decoders[raw_log['topics'][0]].decode(raw_log)
@@ -0,0 +1,276 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from wad import WAD, wad_mul, wad_div, mul_div
+
+
+# Whole-book margin evaluation over columnar position arrays, the batch counterpart of is_position_valid
+# and the helpers it calls in Liquidation.py. Every account is evaluated in one pass per market.
+#
+# In exact mode the columns hold Python ints (object arrays) and go through the same fixed-point functions
+# as the scalar helpers, so the results match them bit for bit. The fast mode runs the same formulas in
+# float64, which is much faster but only approximately equal, so accounts close to the threshold need to
+# be confirmed with the scalar check.
+#
+# The same pass can evaluate the book under many sets of index prices at once, see run_scenarios.
+
+CURVE_TRADING_FEE_DECIMALS = 10
+
+# Accounts times scenarios evaluated in one go by run_scenarios, bounds the size of the intermediate arrays
+SCENARIO_BATCH_CELLS = 2**22
+
+TRADER_FIELDS = ['open_notional', 'position_size', 'cumulative_funding_rate']
+LP_FIELDS = [
+    'open_notional',
+    'position_size',
+    'liquidity_balance',
+    'cumulative_funding_rate_per_lp_token',
+    'total_quote_fees_growth',
+    'total_base_fees_growth',
+    'total_trading_fees_growth'
+]
+
+
+def available():
+    return np is not None
+
+
+class MarketColumns:
+    def __init__(self, idx, perp, global_position, traders, lps, account_ids):
+        self.idx = idx
+        self.perp = perp
+        self.global_position = global_position
+
+        self.trader_ids = np.array([account_ids[address] for address in traders], dtype=np.int64)
+        self.traders = {field: np.array([traders[address][field] for address in traders], dtype=object) for field in TRADER_FIELDS}
+
+        self.lp_ids = np.array([account_ids[address] for address in lps], dtype=np.int64)
+        self.lps = {field: np.array([lps[address][field] for address in lps], dtype=object) for field in LP_FIELDS}
+
+
+class MarginBook:
+    def __init__(self, accounts, markets, reserves, parameters):
+        self.accounts = accounts
+        self.markets = markets
+        # asset -> balance column over all accounts
+        self.reserves = reserves
+        self.parameters = parameters
+        self.float_columns = {}
+
+    @classmethod
+    def from_state(cls, state):
+        accounts = []
+        account_ids = {}
+        for idx in state['perps']:
+            for positions in [state['trader_positions'][idx], state['lp_positions'][idx]]:
+                for address in positions:
+                    if address not in account_ids:
+                        account_ids[address] = len(accounts)
+                        accounts.append(address)
+
+        markets = [
+            MarketColumns(
+                idx,
+                state['perps'][idx],
+                state['global_positions'][idx],
+                state['trader_positions'][idx],
+                state['lp_positions'][idx],
+                account_ids
+            )
+            for idx in state['perps']
+        ]
+
+        assets = set()
+        for address in accounts:
+            assets.update(state['reserves'][address])
+        reserves = {
+            asset: np.array([state['reserves'][address].get(asset, 0) for address in accounts], dtype=object)
+            for asset in assets
+        }
+
+        parameters = {
+            'min_margin': state['min_margin'],
+            'reserve_weights': dict(state['reserve_weights']),
+            'ua_address': state['ua_address']
+        }
+        return cls(accounts, markets, reserves, parameters)
+
+    def column(self, values, exact):
+        if exact:
+            return values
+        key = id(values)
+        if key not in self.float_columns:
+            self.float_columns[key] = values.astype(np.float64)
+        return self.float_columns[key]
+
+    # Returns the free collateral of every account in self.accounts, in the same order
+    def free_collateral(self, exact=False):
+        return self.evaluate(exact)[0]
+
+    # Free collateral and the notional of the positions of every account in self.accounts. With `prices`, idx ->
+    # index prices of the market in each scenario, both have a column per scenario instead.
+    def evaluate(self, exact=False, prices=None):
+        if exact:
+            wmul = np.frompyfunc(wad_mul, 2, 1)
+            wdiv = np.frompyfunc(wad_div, 2, 1)
+            muldiv = np.frompyfunc(mul_div, 3, 1)
+            constant = int
+            zeros = lambda shape: np.zeros(shape, dtype=object)
+        else:
+            wmul = lambda a, b: np.trunc(a * b / WAD)
+            wdiv = lambda a, b: np.trunc(a / b * WAD)
+            muldiv = lambda a, b, c: np.trunc(a * b / c)
+            constant = float
+            zeros = lambda shape: np.zeros(shape)
+
+        n = len(self.accounts)
+        # Only the terms that depend on the price get a column per scenario
+        if prices is None:
+            shape = n
+            expand = lambda values: values
+        else:
+            shape = (n, len(next(iter(prices.values()))))
+            expand = lambda values: values[:, None]
+        pnl = zeros(shape)
+        debt = zeros(shape)
+        notional = zeros(shape)
+        funding = zeros(n)
+
+        def add(total, ids, values):
+            if exact:
+                np.add.at(total, ids, values)
+            elif total.ndim == 1:
+                total += np.bincount(ids, weights=values, minlength=n)
+            else:
+                # An account has at most one trader and one LP position per market, so ids has no repeats
+                total[ids] += values
+
+        wad = constant(WAD)
+        for market in self.markets:
+            perp = market.perp
+            global_position = market.global_position
+            if prices is None:
+                oracle_price = constant(perp['index_price'])
+            else:
+                oracle_price = np.array([constant(price) for price in prices[market.idx]], dtype=object if exact else np.float64)
+            risk_weight = constant(perp['risk_weight'])
+            fees_in_wad = constant(perp['market_out_fee'] * 10**(18 - CURVE_TRADING_FEE_DECIMALS))
+
+            if len(market.trader_ids) > 0:
+                open_notional = self.column(market.traders['open_notional'], exact)
+                position_size = self.column(market.traders['position_size'], exact)
+                user_cumulative_funding_rate = self.column(market.traders['cumulative_funding_rate'], exact)
+
+                v_quote_virtual_proceeds = wmul(expand(position_size), oracle_price)
+                trading_fees = wmul(np.abs(v_quote_virtual_proceeds), fees_in_wad)
+                add(pnl, market.trader_ids, expand(open_notional) + v_quote_virtual_proceeds - trading_fees)
+                add(notional, market.trader_ids, np.abs(v_quote_virtual_proceeds))
+
+                quote_debt = expand(np.minimum(open_notional, 0))
+                base_debt = np.minimum(v_quote_virtual_proceeds, 0)
+                add(debt, market.trader_ids, wmul(np.abs(quote_debt + base_debt), risk_weight))
+
+                global_cumulative_funding_rate = constant(global_position['cumulative_funding_rate'])
+                funding_rate = np.where(
+                    position_size > 0,
+                    user_cumulative_funding_rate - global_cumulative_funding_rate,
+                    global_cumulative_funding_rate - user_cumulative_funding_rate
+                )
+                add(funding, market.trader_ids, wmul(funding_rate, np.abs(position_size)))
+
+            if len(market.lp_ids) > 0:
+                lp_open_notional = self.column(market.lps['open_notional'], exact)
+                lp_position_size = self.column(market.lps['position_size'], exact)
+                liquidity_balance = self.column(market.lps['liquidity_balance'], exact)
+
+                total_liquidity_provided = constant(perp['total_liquidity_provided'])
+                if perp['total_liquidity_provided'] == 0:
+                    quote_tokens_ex_fees = zeros(len(market.lp_ids))
+                    base_tokens_ex_fees = zeros(len(market.lp_ids))
+                else:
+                    quote_tokens_ex_fees = wdiv(
+                        muldiv(liquidity_balance - 1, constant(perp['quote_balance']), total_liquidity_provided),
+                        wad + constant(global_position['total_quote_fees_growth']) - self.column(market.lps['total_quote_fees_growth'], exact)
+                    )
+                    base_tokens_ex_fees = wdiv(
+                        muldiv(liquidity_balance - 1, constant(perp['base_balance']), total_liquidity_provided),
+                        wad + constant(global_position['total_base_fees_growth']) - self.column(market.lps['total_base_fees_growth'], exact)
+                    )
+
+                open_notional = lp_open_notional + quote_tokens_ex_fees
+                position_size = lp_position_size + base_tokens_ex_fees
+
+                v_quote_virtual_proceeds = wmul(expand(position_size), oracle_price)
+                trading_fees = wmul(np.abs(v_quote_virtual_proceeds), fees_in_wad)
+                fee_growth_difference = constant(global_position['total_trading_fees_growth']) - self.column(market.lps['total_trading_fees_growth'], exact)
+                lp_trading_fees = wmul(liquidity_balance, fee_growth_difference)
+                add(pnl, market.lp_ids, expand(open_notional + lp_trading_fees) + v_quote_virtual_proceeds - trading_fees)
+                add(notional, market.lp_ids, np.abs(v_quote_virtual_proceeds))
+
+                quote_debt = expand(np.minimum(lp_open_notional, 0))
+                base_debt = np.minimum(wmul(expand(lp_position_size), oracle_price), 0)
+                market_lp_debt = wmul(np.abs(quote_debt + base_debt), constant(perp['lp_debt_coef']))
+                add(debt, market.lp_ids, wmul(market_lp_debt, risk_weight))
+
+                global_cumulative_funding_rate_per_lp_token = constant(global_position['cumulative_funding_rate_per_lp_token'])
+                user_cumulative_funding_rate_per_lp_token = self.column(market.lps['cumulative_funding_rate_per_lp_token'], exact)
+                add(funding, market.lp_ids, wmul(global_cumulative_funding_rate_per_lp_token - user_cumulative_funding_rate_per_lp_token, liquidity_balance))
+
+        reserve_value = zeros(n)
+        for asset, balances in self.reserves.items():
+            # The scalar helper skips zero balances, so assets it can't price are fine as long as nobody holds them
+            if not np.any(balances != 0):
+                continue
+            usd_per_unit = self.get_oracle_price(asset)
+            weighted_balance = wmul(self.column(balances, exact), constant(self.parameters['reserve_weights'][asset]))
+            reserve_value = reserve_value + wmul(weighted_balance, constant(usd_per_unit))
+
+        margin_required = wmul(debt, constant(self.parameters['min_margin']))
+        total_collateral_value = expand(reserve_value + funding)
+        return (np.minimum(total_collateral_value, total_collateral_value + pnl) - margin_required, notional)
+
+    # Same limitation as get_oracle_price in Liquidation.py, only UA can be priced
+    def get_oracle_price(self, asset):
+        if asset == self.parameters['ua_address']:
+            return WAD
+        raise ValueError(f'No oracle price for reserve asset {asset}')
+
+    # Accounts whose free collateral is below min_free_collateral. In fast mode the cut is raised by `band` wei
+    # so float rounding can't hide an unhealthy account, the result then needs confirming with the scalar check.
+    def find_unhealthy(self, min_free_collateral, exact=False, band=10**13):
+        free_collateral = self.free_collateral(exact)
+        if exact:
+            unhealthy = free_collateral < min_free_collateral
+        else:
+            unhealthy = free_collateral < min_free_collateral + band
+        return [self.accounts[i] for i in np.nonzero(unhealthy.astype(bool))[0]]
+
+    # Evaluates the book under each scenario, an idx -> relative index price move dict such as {'0': -0.1}, with
+    # unlisted markets left at their price. Returns, per scenario, the (address, notional) of every account that
+    # would be liquidatable, their total notional and the liquidator's share of the rewards for liquidating them.
+    # Notional is that of the account's positions at the scenario's prices, which is what the reward is paid on.
+    def run_scenarios(self, scenarios, min_free_collateral, liquidation_reward, insurance_share, exact=False):
+        results = []
+        batch_size = max(1, SCENARIO_BATCH_CELLS // max(1, len(self.accounts)))
+        for start in range(0, len(scenarios), batch_size):
+            batch = scenarios[start:start + batch_size]
+            prices = {
+                market.idx: [wad_mul(market.perp['index_price'], WAD + round(scenario.get(market.idx, 0) * WAD)) for scenario in batch]
+                for market in self.markets
+            }
+            free_collateral, notional = self.evaluate(exact, prices)
+            liquidatable = free_collateral < min_free_collateral
+            for i, scenario in enumerate(batch):
+                ids = np.nonzero(liquidatable[:, i].astype(bool))[0]
+                accounts = [(self.accounts[j], notional[j, i] if exact else int(notional[j, i])) for j in ids]
+                total_notional = sum(account_notional for _, account_notional in accounts)
+                reward = wad_mul(total_notional, liquidation_reward)
+                results.append({
+                    'shocks': scenario,
+                    'accounts': accounts,
+                    'notional': total_notional,
+                    'rewards': reward - wad_mul(reward, insurance_share)
+                })
+        return results
@@ -0,0 +1,214 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Minimal Prometheus instrumentation, exposed in the text format on /metrics when METRICS_PORT is set.
+# Every metric can be updated from any thread.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            for labels, value in self.values.items():
+                lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = ([0] * len(self.buckets), [0, 0])
+            counts, totals = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            totals[0] += value
+            totals[1] += 1
+
+    # Observes the time spent in the with block, also when it raises
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    # Awaits `awaitable` and observes how long it took, for timing each of the awaitables given to gather()
+    async def time_awaitable(self, awaitable, **labels):
+        with self.time(**labels):
+            return await awaitable
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            for labels, (counts, (total, count)) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{format_labels(self.labelnames, labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames, labels, [("le", "+Inf")])} {count}')
+                lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {total}')
+                lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.server = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    # Serves /metrics from a daemon thread, calling it again is a no-op
+    def serve(self, port, host='0.0.0.0'):
+        if self.server is not None:
+            return
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f'Serving metrics on port {port}')
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.register(Histogram(
+    'liquidation_bot_stage_seconds',
+    'Time spent in each stage of processing a block',
+    ['stage']
+))
+BLOCK_TO_LIQUIDATION_SENT_SECONDS = registry.register(Histogram(
+    'liquidation_bot_block_to_liquidation_sent_seconds',
+    'Time from receiving a new head to the liquidation transaction being sent'
+))
+RPC_CALLS = registry.register(Counter('liquidation_bot_rpc_calls_total', 'RPC requests by method', ['method']))
+RPC_ERRORS = registry.register(Counter('liquidation_bot_rpc_errors_total', 'RPC requests that failed, by method', ['method']))
+RPC_REQUEST_BYTES = registry.register(Counter('liquidation_bot_rpc_request_bytes_total', 'Size of the RPC request messages sent to all endpoints, by method', ['method']))
+RPC_RESPONSE_BYTES = registry.register(Counter('liquidation_bot_rpc_response_bytes_total', 'Size of the RPC response and subscription messages received from all endpoints, by method', ['method']))
+RPC_ENDPOINT_SECONDS = registry.register(Histogram('liquidation_bot_rpc_endpoint_seconds', 'Latency of successful requests by RPC endpoint, numbered in the order of RPC', ['endpoint']))
+RPC_ENDPOINT_ERRORS = registry.register(Counter('liquidation_bot_rpc_endpoint_errors_total', 'Failed connections and requests by RPC endpoint', ['endpoint']))
+RPC_ENDPOINT_UP = registry.register(Gauge('liquidation_bot_rpc_endpoint_up', 'Whether the RPC endpoint is in use, 0 while evicted', ['endpoint']))
+RPC_HEDGED_REQUESTS = registry.register(Counter('liquidation_bot_rpc_hedged_requests_total', 'Requests also sent to a second endpoint because the first was slow or failed', ['method']))
+REORGS = registry.register(Counter('liquidation_bot_reorgs_total', 'Chain reorganizations rolled back'))
+REORGED_BLOCKS = registry.register(Counter('liquidation_bot_reorged_blocks_total', 'Synced blocks rolled back because of reorganizations'))
+ACCOUNTS_EVALUATED = registry.register(Gauge('liquidation_bot_accounts_evaluated', 'Accounts health checked for the last block'))
+ACCOUNTS_EVALUATED_TOTAL = registry.register(Counter('liquidation_bot_accounts_evaluated_total', 'Accounts health checked'))
+ACCOUNTS_DEFERRED = registry.register(Counter('liquidation_bot_accounts_deferred_total', 'Accounts left for the next block because the health check budget was used up'))
+WATCHLIST_SIZE = registry.register(Gauge('liquidation_bot_watchlist_size', 'Accounts close to liquidation, checked every block'))
+ACCOUNTS_EVICTED = registry.register(Counter('liquidation_bot_accounts_evicted_total', 'Accounts removed from the state because they no longer hold a position or balance'))
+STATE_ENTRIES = registry.register(Gauge('liquidation_bot_state_entries', 'Entries in each section of the in-memory state', ['section']))
+CANDIDATES = registry.register(Gauge('liquidation_bot_liquidation_candidates', 'Positions found liquidatable in the last block'))
+QUEUE_SIZE = registry.register(Gauge('liquidation_bot_queue_size', 'Liquidations waiting for pre-flight or a receipt', ['queue']))
+HEAD_BLOCK = registry.register(Gauge('liquidation_bot_head_block', 'Latest block announced by the node'))
+SYNCED_BLOCK = registry.register(Gauge('liquidation_bot_synced_block', 'Block the state is synced to'))
+SYNC_LAG = registry.register(Gauge('liquidation_bot_sync_lag_blocks', 'Blocks between the latest head and the synced state'))
+STARTUP_SECONDS = registry.register(Gauge('liquidation_bot_startup_seconds', 'Seconds from the start of the main loop to its first health check'))
+LIQUIDATION_REWARDS = registry.register(Gauge('liquidation_bot_liquidation_rewards', 'Total liquidation rewards earned, in UA'))
+
+
+# Bytes are counted by the RPC endpoints, on the messages as sent and received
+def record_rpc(method, response):
+    RPC_CALLS.inc(method=method)
+    if 'error' in response:
+        RPC_ERRORS.inc(method=method)
+
+
+def rpc_middleware(make_request, w3):
+    def middleware(method, params):
+        try:
+            response = make_request(method, params)
+        except Exception:
+            RPC_CALLS.inc(method=method)
+            RPC_ERRORS.inc(method=method)
+            raise
+        record_rpc(method, response)
+        return response
+    return middleware
+
+
+async def async_rpc_middleware(make_request, async_w3):
+    async def middleware(method, params):
+        try:
+            response = await make_request(method, params)
+        except Exception:
+            RPC_CALLS.inc(method=method)
+            RPC_ERRORS.inc(method=method)
+            raise
+        record_rpc(method, response)
+        return response
+    return middleware
@@ -0,0 +1,99 @@
+from eth_utils import function_abi_to_4byte_selector
+from eth_utils.abi import collapse_if_tuple
+
+
+# Multicall3 is deployed at the same address on zkSync Era mainnet and testnet
+MULTICALL3_ADDRESS = '0xF9cda624FBC7e059355ce98a31693d299FACd963'
+
+MULTICALL3_ABI = [
+    {
+        'inputs': [
+            {
+                'components': [
+                    {'internalType': 'address', 'name': 'target', 'type': 'address'},
+                    {'internalType': 'bool', 'name': 'allowFailure', 'type': 'bool'},
+                    {'internalType': 'bytes', 'name': 'callData', 'type': 'bytes'}
+                ],
+                'internalType': 'struct Multicall3.Call3[]',
+                'name': 'calls',
+                'type': 'tuple[]'
+            }
+        ],
+        'name': 'aggregate3',
+        'outputs': [
+            {
+                'components': [
+                    {'internalType': 'bool', 'name': 'success', 'type': 'bool'},
+                    {'internalType': 'bytes', 'name': 'returnData', 'type': 'bytes'}
+                ],
+                'internalType': 'struct Multicall3.Result[]',
+                'name': 'returnData',
+                'type': 'tuple[]'
+            }
+        ],
+        'stateMutability': 'payable',
+        'type': 'function'
+    }
+]
+
+# aggregate3 is encoded and decoded with the codec directly, web3's contract functions run their normalizers
+# over every element of the call list and take longer than the eth_call itself
+AGGREGATE3_SELECTOR = function_abi_to_4byte_selector(MULTICALL3_ABI[0])
+AGGREGATE3_INPUT = '(address,bool,bytes)[]'
+AGGREGATE3_OUTPUT = '(bool,bytes)[]'
+
+# Keeps each eth_call well below node gas and response size limits
+MAX_CALLS_PER_BATCH = 500
+
+
+class Multicall:
+    def __init__(self, w3, address=MULTICALL3_ADDRESS):
+        self.w3 = w3
+        self.contract = w3.eth.contract(address=address, abi=MULTICALL3_ABI)
+
+    # Takes prepared contract function calls, e.g. contract.functions.balances(0), and returns their
+    # decoded results in order, all read at block_identifier. With allow_failure a reverted call gives None.
+    def call(self, calls, block_identifier='latest', allow_failure=False):
+        results = []
+        for batch in self.batches(calls):
+            responses = self.decode_aggregate(self.w3.eth.call(self.get_transaction(batch, allow_failure), block_identifier))
+            results.extend(self.decode_responses(batch, responses))
+        return results
+
+    # Same as call() when the multicall was created with an AsyncWeb3 instance
+    async def call_async(self, calls, block_identifier='latest', allow_failure=False):
+        results = []
+        for batch in self.batches(calls):
+            responses = self.decode_aggregate(await self.w3.eth.call(self.get_transaction(batch, allow_failure), block_identifier))
+            results.extend(self.decode_responses(batch, responses))
+        return results
+
+    def batches(self, calls):
+        return [calls[start:start + MAX_CALLS_PER_BATCH] for start in range(0, len(calls), MAX_CALLS_PER_BATCH)]
+
+    def get_transaction(self, calls, allow_failure):
+        return {'to': self.contract.address, 'data': AGGREGATE3_SELECTOR + self.w3.codec.encode([AGGREGATE3_INPUT], [self.encode(calls, allow_failure)])}
+
+    def encode(self, calls, allow_failure):
+        return [(function.address, allow_failure, self.encode_call(function)) for function in calls]
+
+    # Same as function._encode_transaction_data(), for calls with positional arguments
+    def encode_call(self, function):
+        if len(function.kwargs) > 0:
+            return function._encode_transaction_data()
+        input_types = [collapse_if_tuple(item) for item in function.abi['inputs']]
+        return bytes.fromhex(function.selector[2:]) + self.w3.codec.encode(input_types, function.args)
+
+    def decode_aggregate(self, result):
+        return self.w3.codec.decode([AGGREGATE3_OUTPUT], result)[0]
+
+    def decode_responses(self, calls, responses):
+        return [self.decode(function, return_data) if success else None for function, (success, return_data) in zip(calls, responses)]
+
+    def decode(self, function, return_data):
+        output_types = [collapse_if_tuple(output) for output in function.abi['outputs']]
+        values = self.w3.codec.decode(output_types, return_data)
+        # Same shape as ContractFunction.call(), single return values are unwrapped
+        if len(values) == 1:
+            return values[0]
+        return values
@@ -0,0 +1,58 @@
+from bisect import bisect_left, bisect_right, insort
+
+
+# Per market index of the index prices at which accounts stop being healthy, holding every other
+# market constant. A price move then only needs to look at the accounts whose threshold it crossed,
+# instead of recomputing the margin of every account in the market.
+class LiquidationPriceIndex:
+    def __init__(self):
+        # Sorted lists of (price, account), only finite bounds are stored
+        self.lower = []
+        self.upper = []
+        self.bounds = {}
+
+        # Accounts with positions in other markets too, their bounds go stale whenever this market moves
+        self.shared = set()
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def __contains__(self, account):
+        return account in self.bounds
+
+    def update(self, account, lower_price, upper_price, shared=False):
+        self.remove(account)
+
+        self.bounds[account] = (lower_price, upper_price)
+        if lower_price != float('-inf'):
+            insort(self.lower, (lower_price, account))
+        if upper_price != float('inf'):
+            insort(self.upper, (upper_price, account))
+        if shared:
+            self.shared.add(account)
+
+    def remove(self, account):
+        if account not in self.bounds:
+            return
+
+        lower_price, upper_price = self.bounds.pop(account)
+        if lower_price != float('-inf'):
+            del self.lower[bisect_left(self.lower, (lower_price, account))]
+        if upper_price != float('inf'):
+            del self.upper[bisect_left(self.upper, (upper_price, account))]
+        self.shared.discard(account)
+
+    # Accounts that may be unhealthy at `price`: those with the price outside their bounds, plus all
+    # accounts whose bounds depend on this market through their other positions
+    def get_candidates(self, price):
+        candidates = set(self.shared)
+
+        # Lower bounds above the price
+        for i in range(bisect_right(self.lower, price, key=lambda item: item[0]), len(self.lower)):
+            candidates.add(self.lower[i][1])
+
+        # Upper bounds below the price
+        for i in range(bisect_left(self.upper, price, key=lambda item: item[0])):
+            candidates.add(self.upper[i][1])
+
+        return candidates
@@ -0,0 +1,444 @@
+import asyncio
+import itertools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import websockets
+from web3._utils.encoding import FriendlyJsonSerde, Web3JsonEncoder
+from web3.providers import JSONBaseProvider
+from web3.providers.async_base import AsyncJSONBaseProvider
+
+import metrics
+
+
+# Reads sent to the fastest endpoint and, if it hasn't answered within a multiple of its usual latency,
+# also to the second fastest, whichever answers first is used. Other reads fail over down the ranking,
+# and transactions are broadcast to every endpoint.
+HEDGED_METHODS = ['eth_blockNumber', 'eth_getLogs']
+BROADCAST_METHODS = ['eth_sendRawTransaction']
+# Position of the block parameter of reads pinned to a block. Those, and eth_getLogs up to a block, only go to
+# endpoints whose head has reached it when there are any, as the others answer as if the block were empty.
+BLOCK_PARAMS = {
+    'eth_call': 1,
+    'eth_getBalance': 1,
+    'eth_getCode': 1,
+    'eth_getStorageAt': 2,
+    'eth_getTransactionCount': 1,
+    'eth_getBlockByNumber': 0
+}
+
+REQUEST_TIMEOUT = 10
+CONNECT_TIMEOUT = 10
+HEDGE_LATENCY_MULTIPLE = 2
+HEDGE_MIN_DELAY = 0.02
+HEDGE_MAX_DELAY = 0.5
+# Weight of the newest sample in the smoothed latency of an endpoint
+LATENCY_SMOOTHING = 0.2
+
+# Endpoints failing this many requests in a row are left out for EVICTION_INITIAL seconds, doubling
+# up to EVICTION_MAX while they keep failing the probe that lets them back in
+MAX_CONSECUTIVE_FAILURES = 3
+EVICTION_INITIAL = 5
+EVICTION_MAX = 300
+PROBE_INTERVAL = 1
+
+# Set while requests made in the with block of hedged() should be hedged whatever their method
+hedge_requests = ContextVar('hedge_requests', default=False)
+
+
+@contextmanager
+def hedged():
+    token = hedge_requests.set(True)
+    try:
+        yield
+    finally:
+        hedge_requests.reset(token)
+
+
+# A websocket with any number of requests in flight, responses are matched to requests by id
+class Endpoint:
+    def __init__(self, url, label):
+        self.url = url
+        self.label = label
+        self.websocket = None
+        self.reader = None
+        self.connect_lock = asyncio.Lock()
+        self.request_ids = itertools.count(1)
+        # request id -> (method, future of the response)
+        self.responses = {}
+        # subscription id -> callback(endpoint, result)
+        self.subscriptions = {}
+
+        # method -> smoothed latency in seconds
+        self.latency = {}
+        self.failures = 0
+        self.evictions = 0
+        self.evicted_until = None
+        self.reinstated_at = 0
+        self.head = 0
+
+    def __str__(self):
+        return f'RPC endpoint {self.label}'
+
+    def get_latency(self, method):
+        # Endpoints not yet measured for a method are tried first
+        return self.latency.get(method, 0)
+
+    def observe(self, method, seconds):
+        previous = self.latency.get(method)
+        self.latency[method] = seconds if previous is None else previous + LATENCY_SMOOTHING * (seconds - previous)
+
+    async def connect(self):
+        async with self.connect_lock:
+            if self.websocket is not None:
+                return
+            self.websocket = await asyncio.wait_for(websockets.connect(self.url, max_size=None), CONNECT_TIMEOUT)
+            self.reader = asyncio.create_task(self.read(self.websocket))
+
+    async def close(self):
+        websocket = self.websocket
+        self.websocket = None
+        if websocket is not None:
+            await websocket.close()
+
+    async def read(self, websocket):
+        try:
+            async for message in websocket:
+                response = json.loads(message)
+                if response.get('method') == 'eth_subscription':
+                    metrics.RPC_RESPONSE_BYTES.inc(len(message), method='eth_subscription')
+                    callback = self.subscriptions.get(response['params']['subscription'])
+                    if callback is not None:
+                        callback(self, response['params']['result'])
+                    continue
+                method, future = self.responses.pop(response.get('id'), (None, None))
+                if future is None:
+                    continue
+                # Counted on the raw message, encoding a large eth_getLogs result again just to measure it is slow
+                metrics.RPC_RESPONSE_BYTES.inc(len(message), method=method)
+                if not future.done():
+                    future.set_result(response)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if self.websocket is websocket:
+                self.websocket = None
+            self.subscriptions.clear()
+            for _, future in self.responses.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f'Connection to {self} closed'))
+            self.responses.clear()
+
+    # params_json is the already encoded parameters, so hedged and broadcast requests are only encoded once
+    async def request(self, method, params_json, timeout=REQUEST_TIMEOUT):
+        if self.websocket is None:
+            raise ConnectionError(f'Not connected to {self}')
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.responses[request_id] = (method, future)
+        try:
+            message = f'{{"jsonrpc":"2.0","id":{request_id},"method":{json.dumps(method)},"params":{params_json}}}'
+            await self.websocket.send(message)
+            metrics.RPC_REQUEST_BYTES.inc(len(message), method=method)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.responses.pop(request_id, None)
+
+
+# Spreads requests over several RPC endpoints, keeping track of the latency and failures of each. All
+# connections live on an event loop in a background thread, so they are shared by every thread and
+# event loop of the bot through RpcPoolProvider and AsyncRpcPoolProvider.
+class RpcPool:
+    def __init__(self, urls, timeout=REQUEST_TIMEOUT):
+        self.endpoints = [Endpoint(url, str(i)) for i, url in enumerate(urls)]
+        self.timeout = timeout
+        self.head_callbacks = []
+        self.best_head = 0
+        # Requests still running after their result was taken from another endpoint
+        self.background = set()
+
+        self.loop = None
+        self.open_lock = threading.Lock()
+
+    # Nothing is started until the first request, which opens the pool. Endpoints are connected in the background
+    # from then on, the first request doesn't wait for them all, only for the one it is sent to.
+    def open(self):
+        with self.open_lock:
+            if self.loop is not None:
+                return
+            if len(self.endpoints) == 0:
+                raise ConnectionError('No RPC endpoints')
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self.start(), loop)
+            self.loop = loop
+
+    def run(self, coroutine):
+        self.open()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def start(self):
+        await asyncio.gather(*[self.reconnect(endpoint) for endpoint in self.endpoints])
+        self.prober = asyncio.create_task(self.probe_endpoints())
+
+    # Endpoints that can't be connected to are evicted straight away
+    async def connect(self, endpoint):
+        try:
+            await endpoint.connect()
+            if len(self.head_callbacks) > 0 and len(endpoint.subscriptions) == 0:
+                await self.subscribe(endpoint)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.RPC_ENDPOINT_ERRORS.inc(endpoint=endpoint.label)
+            if endpoint.evicted_until is None:
+                self.evict(endpoint, e)
+            raise
+        if endpoint.evicted_until is None:
+            metrics.RPC_ENDPOINT_UP.set(1, endpoint=endpoint.label)
+
+    async def reconnect(self, endpoint):
+        try:
+            await self.connect(endpoint)
+            return True
+        except Exception:
+            return False
+
+    def ranked(self, method, block=None):
+        endpoints = [endpoint for endpoint in self.endpoints if endpoint.evicted_until is None]
+        if len(endpoints) == 0:
+            # Nothing better to try
+            endpoints = list(self.endpoints)
+        if block is not None:
+            synced = [endpoint for endpoint in endpoints if endpoint.head >= block]
+            # Heads are only known from subscriptions and eth_blockNumber, if none has the block all are tried
+            if len(synced) > 0:
+                endpoints = synced
+        return sorted(endpoints, key=lambda endpoint: endpoint.get_latency(method))
+
+    def record_success(self, endpoint, method, seconds):
+        endpoint.failures = 0
+        endpoint.observe(method, seconds)
+        metrics.RPC_ENDPOINT_SECONDS.observe(seconds, endpoint=endpoint.label)
+
+    def record_failure(self, endpoint, error):
+        endpoint.failures += 1
+        metrics.RPC_ENDPOINT_ERRORS.inc(endpoint=endpoint.label)
+        if endpoint.evicted_until is None and endpoint.failures >= MAX_CONSECUTIVE_FAILURES:
+            self.evict(endpoint, error)
+
+    def evict(self, endpoint, error):
+        now = time.time()
+        # Long healthy spells start the backoff over
+        if now - endpoint.reinstated_at > EVICTION_MAX:
+            endpoint.evictions = 0
+        endpoint.evicted_until = now + min(EVICTION_MAX, EVICTION_INITIAL * 2**endpoint.evictions)
+        endpoint.evictions += 1
+        metrics.RPC_ENDPOINT_UP.set(0, endpoint=endpoint.label)
+        print(f'Evicted {endpoint} until {time.ctime(endpoint.evicted_until)}: {error!r}\n')
+        asyncio.create_task(endpoint.close())
+
+    # Evicted endpoints are let back in once they connect and answer eth_blockNumber again. Dropped
+    # connections of the others are reopened, so they keep delivering heads even when no requests go to them.
+    async def probe_endpoints(self):
+        while True:
+            await asyncio.sleep(PROBE_INTERVAL)
+            now = time.time()
+            for endpoint in self.endpoints:
+                if endpoint.evicted_until is None:
+                    if endpoint.websocket is None:
+                        await self.reconnect(endpoint)
+                    continue
+                if endpoint.evicted_until > now:
+                    continue
+                try:
+                    await endpoint.connect()
+                    response = await endpoint.request('eth_blockNumber', '[]', self.timeout)
+                    if 'result' not in response:
+                        raise ConnectionError(response.get('error'))
+                except Exception as e:
+                    endpoint.evicted_until = None
+                    await endpoint.close()
+                    self.evict(endpoint, e)
+                    continue
+
+                endpoint.evicted_until = None
+                endpoint.failures = 0
+                endpoint.reinstated_at = now
+                print(f'{endpoint} is back\n')
+                await self.reconnect(endpoint)
+
+    async def send(self, endpoint, method, params_json):
+        if endpoint.websocket is None:
+            await self.connect(endpoint)
+        start = time.perf_counter()
+        try:
+            response = await endpoint.request(method, params_json, self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.record_failure(endpoint, e)
+            raise
+        self.record_success(endpoint, method, time.perf_counter() - start)
+        if method == 'eth_blockNumber' and 'result' in response:
+            endpoint.head = max(endpoint.head, int(response['result'], 16))
+        return response
+
+    def keep_running(self, tasks):
+        for task in tasks:
+            if not task.done():
+                self.background.add(task)
+                task.add_done_callback(self.background.discard)
+            # Failures were already recorded, the exception is only retrieved so it isn't reported as lost
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    # block is the block the request needs the endpoint to have, see get_block
+    async def request(self, method, params_json, hedge=False, block=None):
+        if method in BROADCAST_METHODS:
+            return await self.broadcast(method, params_json)
+
+        endpoints = self.ranked(method, block)
+        if hedge and len(endpoints) > 1:
+            try:
+                return await self.hedged_request(endpoints[0], endpoints[1], method, params_json)
+            except Exception:
+                if len(endpoints) == 2:
+                    raise
+                endpoints = endpoints[2:]
+        return await self.failover_request(endpoints, method, params_json)
+
+    async def failover_request(self, endpoints, method, params_json):
+        error = None
+        for endpoint in endpoints:
+            try:
+                return await self.send(endpoint, method, params_json)
+            except Exception as e:
+                error = e
+        raise error
+
+    def get_hedge_delay(self, endpoint, method):
+        latency = endpoint.latency.get(method)
+        if latency is None:
+            return HEDGE_MIN_DELAY
+        return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, HEDGE_LATENCY_MULTIPLE * latency))
+
+    # The first result wins, error responses only win if no endpoint has anything better
+    async def first_result(self, tasks):
+        response = None
+        error = None
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                next_response = await next_done
+            except Exception as e:
+                error = e
+                continue
+            if 'error' not in next_response:
+                return next_response
+            if response is None:
+                response = next_response
+        if response is not None:
+            return response
+        raise error
+
+    async def hedged_request(self, primary, secondary, method, params_json):
+        tasks = [asyncio.create_task(self.send(primary, method, params_json))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.get_hedge_delay(primary, method))
+            if len(done) == 0 or tasks[0].exception() is not None or 'error' in tasks[0].result():
+                metrics.RPC_HEDGED_REQUESTS.inc(method=method)
+                tasks.append(asyncio.create_task(self.send(secondary, method, params_json)))
+            return await self.first_result(tasks)
+        finally:
+            # Losers run to completion so their latency and failures are still recorded
+            self.keep_running(tasks)
+
+    async def broadcast(self, method, params_json):
+        tasks = [asyncio.create_task(self.send(endpoint, method, params_json)) for endpoint in self.ranked(method)]
+        try:
+            return await self.first_result(tasks)
+        finally:
+            self.keep_running(tasks)
+
+    # callback(number) is called from the pool's thread once for every new block, as soon as the first
+    # endpoint announces it
+    def subscribe_heads(self, callback):
+        self.head_callbacks.append(callback)
+        self.run(self.subscribe_all())
+
+    def unsubscribe_heads(self, callback):
+        self.head_callbacks.remove(callback)
+
+    # gather() needs the pool's loop, subscribe_heads is called from other threads
+    async def subscribe_all(self):
+        await asyncio.gather(*[self.reconnect(endpoint) for endpoint in self.endpoints if endpoint.evicted_until is None])
+
+    async def subscribe(self, endpoint):
+        response = await self.send(endpoint, 'eth_subscribe', '["newHeads"]')
+        if 'result' not in response:
+            raise ConnectionError(f'{endpoint} refused the newHeads subscription: {response.get("error")}')
+        endpoint.subscriptions[response['result']] = self.handle_head
+
+    def handle_head(self, endpoint, head):
+        number = head['number']
+        number = int(number, 16) if isinstance(number, str) else number
+        endpoint.head = number
+        if number <= self.best_head:
+            return
+        self.best_head = number
+        for callback in list(self.head_callbacks):
+            callback(number)
+
+
+def encode_params(params):
+    return FriendlyJsonSerde().json_encode(params, cls=Web3JsonEncoder)
+
+
+# The block number a request reads at or up to, None for tags such as 'latest' and requests for no block
+def get_block(method, params):
+    if method == 'eth_getLogs':
+        block = params[0].get('toBlock') if len(params) > 0 and isinstance(params[0], dict) else None
+    elif method in BLOCK_PARAMS and len(params) > BLOCK_PARAMS[method]:
+        block = params[BLOCK_PARAMS[method]]
+    else:
+        return None
+    if isinstance(block, int):
+        return block
+    if isinstance(block, str) and block.startswith('0x'):
+        return int(block, 16)
+    return None
+
+
+# Web3 provider sending requests through an RpcPool, from any thread. Methods in hedged_methods, and all
+# requests made within hedged(), are hedged.
+class RpcPoolProvider(JSONBaseProvider):
+    def __init__(self, pool, hedged_methods=HEDGED_METHODS):
+        super().__init__()
+        self.pool = pool
+        self.hedged_methods = set(hedged_methods)
+
+    def make_request(self, method, params):
+        hedge = method in self.hedged_methods or hedge_requests.get()
+        return self.pool.run(self.pool.request(method, encode_params(params), hedge, get_block(method, params)))
+
+    def is_connected(self, show_traceback=False):
+        return any(endpoint.websocket is not None for endpoint in self.pool.endpoints)
+
+
+# Same as RpcPoolProvider for AsyncWeb3, usable from any event loop
+class AsyncRpcPoolProvider(AsyncJSONBaseProvider):
+    def __init__(self, pool, hedged_methods=HEDGED_METHODS):
+        super().__init__()
+        self.pool = pool
+        self.hedged_methods = set(hedged_methods)
+
+    async def make_request(self, method, params):
+        hedge = method in self.hedged_methods or hedge_requests.get()
+        self.pool.open()
+        future = asyncio.run_coroutine_threadsafe(self.pool.request(method, encode_params(params), hedge, get_block(method, params)), self.pool.loop)
+        return await asyncio.wrap_future(future)
+
+    async def is_connected(self, show_traceback=False):
+        return any(endpoint.websocket is not None for endpoint in self.pool.endpoints)
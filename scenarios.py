@@ -0,0 +1,47 @@
+import argparse
+import json
+
+
+# Lists who would be liquidatable if prices moved, evaluated on the state synced up to the latest block:
+#   python3 scenarios.py --min -30 --max 30 --step 1
+# Every perpetual moves by the same percentage in each scenario, or only those given with --markets.
+# Syncing writes state.json and state.journal like the bot does, so next to a running bot use --no-sync,
+# which evaluates the state last written by it instead.
+
+def get_shocks(minimum, maximum, step):
+    count = int(round((maximum - minimum) / step)) + 1
+    return [round(minimum + i * step, 6) / 100 for i in range(count)]
+
+def main(args):
+    # Reads .env and the deployment files on import, the node is only needed to sync
+    import Liquidation
+
+    if args.no_sync:
+        Liquidation.load_state()
+    else:
+        Liquidation.sync(Liquidation.web3.eth.block_number)
+    print(f"State at block {Liquidation.state['synced_block']}, {len(Liquidation.state['reserves'])} accounts\n")
+
+    shocks = get_shocks(args.min, args.max, args.step)
+    results = Liquidation.get_price_shock_scenarios(shocks, args.markets, args.exact)
+
+    print(f"{'shock':>8} {'accounts':>9} {'notional':>16} {'rewards':>12}")
+    for shock, result in zip(shocks, results):
+        print(f"{round(100 * shock, 2):>7}% {len(result['accounts']):>9} {round(result['notional'] / 10**18, 2):>16} {round(result['rewards'] / 10**18, 2):>12}")
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump([{**result, 'notional': str(result['notional']), 'rewards': str(result['rewards']), 'accounts': [[address, str(notional)] for address, notional in result['accounts']]} for result in results], f, indent=2)
+        print(f'\nSaved to {args.json}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--min', type=float, default=-30, help='smallest price move, in percent')
+    parser.add_argument('--max', type=float, default=30, help='largest price move, in percent')
+    parser.add_argument('--step', type=float, default=1, help='percent between scenarios')
+    parser.add_argument('--markets', nargs='+', help='market indices to move, all by default')
+    parser.add_argument('--exact', action='store_true', help='use the exact fixed-point mode of the margin engine')
+    parser.add_argument('--no-sync', action='store_true', help='use state.json as it is instead of syncing first')
+    parser.add_argument('--json', help='file to save every scenario with its accounts to')
+    main(parser.parse_args())
@@ -0,0 +1,82 @@
+import multiprocessing
+import pickle
+import traceback
+
+
+# Health checks spread over worker processes, each owning the accounts of one hash partition. Workers are forked
+# from the syncing process once its state is loaded, so they start out with a copy of it, and every message after
+# that carries the state changes since the last one along with what to check. The message is pickled once and
+# written to every worker's pipe, and the replies come back in shard order.
+
+
+class ShardError(Exception):
+    pass
+
+
+# Addresses are hashes already, their last bytes spread accounts evenly and the same way in every process
+def get_shard(address, count):
+    return int(address[-8:], 16) % count
+
+
+def serve(connection, shard, count, handler):
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        try:
+            reply = (True, handler(shard, count, message))
+        except Exception:
+            reply = (False, traceback.format_exc())
+        connection.send(reply)
+
+
+class ShardPool:
+    # handler(shard, count, message) runs in the worker of each shard, what it returns is that shard's reply
+    def __init__(self, count, handler):
+        self.count = count
+        context = multiprocessing.get_context('fork')
+        self.connections = []
+        self.processes = []
+        for shard in range(count):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=serve, args=(worker_connection, shard, count, handler), name=f'shard-{shard}', daemon=True)
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    # A worker that failed may have applied only part of a message, so the pool can't be used after a ShardError
+    def run(self, message):
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        for connection in self.connections:
+            connection.send_bytes(data)
+
+        replies = []
+        errors = []
+        for shard, connection in enumerate(self.connections):
+            try:
+                ok, reply = connection.recv()
+            except EOFError:
+                ok, reply = False, 'worker exited'
+            if ok:
+                replies.append(reply)
+            else:
+                errors.append(f'Shard {shard}: {reply}')
+        if len(errors) > 0:
+            raise ShardError('\n'.join(errors))
+        return replies
+
+    def stop(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.kill()
@@ -0,0 +1,302 @@
+import json
+import os
+from collections import deque
+from collections.abc import Mapping
+
+
+# Persists the bot state as a full snapshot (state.json, same layout as before) plus an
+# append-only journal of per-block deltas. Every block only writes the entries that changed,
+# and the journal is folded back into the snapshot periodically.
+#
+# Journal lines look like {"block": N, "changes": [[path, value], [path], ...]} where a path is a
+# list of keys into the state dict and a change without a value is a deletion. Values are absolute,
+# so replaying a line is idempotent. Any mapping in the state is written out as a plain dict.
+#
+# The deltas of the last history_depth commits are also kept in memory with the hash of their block, so
+# they can be undone after a reorg. Journal lines are only written once their block is confirmation_depth
+# blocks deep, until then the in-memory state is ahead of the files.
+#
+# Compaction is only flagged by commits, whoever drives the store runs it with compact_if_due when it has time.
+#
+# With track_changes, the paths changed by commits and reverts are also collected for drain_changes, which
+# hands out their current values in the journal's format so another copy of the state can follow this one.
+
+_MISSING = object()
+_UNSET = object()
+
+
+def _copy(value):
+    if isinstance(value, Mapping):
+        return {key: _copy(item) for key, item in value.items()}
+    return value
+
+
+def _to_json(value):
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def _get_path(state, path):
+    node = state
+    for key in path:
+        if not isinstance(node, Mapping) or key not in node:
+            return _MISSING
+        node = node[key]
+    return node
+
+
+def _set_path(state, path, value):
+    node = state
+    for key in path[:-1]:
+        node = node.setdefault(key, {})
+    node[path[-1]] = value
+
+
+def _del_path(state, path):
+    node = _get_path(state, path[:-1])
+    if isinstance(node, Mapping):
+        node.pop(path[-1], None)
+
+
+# Applies [path, value] and [path] changes such as those of a journal line
+def apply_changes(state, changes):
+    for change in changes:
+        if len(change) == 2:
+            _set_path(state, change[0], change[1])
+        else:
+            _del_path(state, change[0])
+
+
+def _restore(state, originals):
+    for path, value in reversed(list(originals.items())):
+        if value is _MISSING:
+            _del_path(state, path)
+        else:
+            _set_path(state, path, value)
+
+
+# Undoes `deltas`, newest first, as a tree of [value, children] patches where each node is a key of the state
+def _patch_tree(deltas):
+    root = [_UNSET, {}]
+    for delta in reversed(deltas):
+        for path, value in reversed(list(delta.originals.items())):
+            node = root
+            for key in path:
+                node = node[1].setdefault(key, [_UNSET, {}])
+            # Restoring a path replaces everything below it
+            node[0] = value
+            node[1] = {}
+    return root
+
+
+# `value` with the patches applied. Only the mappings on the way to a patch are copied, and only shallowly.
+def _overlay(value, node):
+    if node[0] is not _UNSET:
+        value = node[0]
+    if len(node[1]) == 0:
+        return value
+    result = dict(value) if isinstance(value, Mapping) else {}
+    for key, child in node[1].items():
+        patched = _overlay(result.get(key, _MISSING), child)
+        if patched is _MISSING:
+            result.pop(key, None)
+        else:
+            result[key] = patched
+    if value is _MISSING and len(result) == 0:
+        return _MISSING
+    return result
+
+
+# One commit: the values its paths had before it, and its journal line until that is written
+class Delta:
+    __slots__ = ('block', 'block_hash', 'originals', 'line')
+
+    def __init__(self, block, block_hash, originals, line):
+        self.block = block
+        self.block_hash = block_hash
+        self.originals = originals
+        self.line = line
+
+
+class StateStore:
+    def __init__(self, snapshot_path='state.json', journal_path='state.journal', compaction_interval=1000, confirmation_depth=0, history_depth=0):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compaction_interval = compaction_interval
+        self.confirmation_depth = confirmation_depth
+        self.history_depth = history_depth
+
+        # path -> value before the first change in the current (uncommitted) block range
+        self.originals = {}
+        # Deltas of the last commits, oldest first
+        self.deltas = deque()
+        self.journal_entries = 0
+        self.journal_bytes = 0
+        self.snapshot_bytes = 0
+        # path -> None for every path changed since the last drain_changes, only kept once track_changes is called
+        self.changed_paths = None
+        self.compaction_due = False
+
+    def load(self):
+        with open(self.snapshot_path, 'r') as f:
+            raw = f.read()
+        state = json.loads(raw)
+        self.snapshot_bytes = len(raw)
+        self.originals = {}
+        self.deltas = deque()
+        self.journal_entries = 0
+        self.journal_bytes = 0
+
+        if not os.path.isfile(self.journal_path):
+            return state
+
+        valid_bytes = 0
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write, everything after it is discarded
+                    break
+                if not line.endswith(b'\n'):
+                    break
+
+                valid_bytes += len(line)
+                self.journal_entries += 1
+
+                # Entries already folded into the snapshot by a compaction that crashed before truncating
+                if entry['block'] <= state['synced_block']:
+                    continue
+
+                apply_changes(state, entry['changes'])
+
+        if valid_bytes != os.path.getsize(self.journal_path):
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(valid_bytes)
+        self.journal_bytes = valid_bytes
+
+        return state
+
+    # Must be called before mutating the entry at `path` so it can be journaled and rolled back
+    def touch(self, state, *path):
+        if path not in self.originals:
+            self.originals[path] = _copy(_get_path(state, path))
+
+    # (path, value before the first change) of every path touched since the last commit
+    def get_touched(self):
+        return list(self.originals.items())
+
+    def rollback(self, state):
+        _restore(state, self.originals)
+        self.originals = {}
+
+    # block_hash is the hash of state['synced_block'], used to notice when that block is reorged out
+    def commit(self, state, block_hash=None):
+        changes = []
+        for path in self.originals:
+            value = _get_path(state, path)
+            if value is _MISSING:
+                changes.append([list(path)])
+            else:
+                changes.append([list(path), value])
+
+        line = json.dumps({'block': state['synced_block'], 'changes': changes}, default=_to_json) + '\n'
+        self.deltas.append(Delta(state['synced_block'], block_hash, self.originals, line))
+        if self.changed_paths is not None:
+            self.changed_paths.update(dict.fromkeys(self.originals))
+        self.originals = {}
+        self.flush(state, state['synced_block'] - self.confirmation_depth)
+
+    # Writes the journal lines of every delta up to confirmed_block. Deltas past history_depth are dropped,
+    # unconfirmed ones are written first if need be.
+    def flush(self, state, confirmed_block):
+        lines = []
+        for i, delta in enumerate(self.deltas):
+            if delta.block > confirmed_block and len(self.deltas) - i <= self.history_depth:
+                break
+            if delta.line is not None:
+                lines.append(delta.line)
+                delta.line = None
+        while len(self.deltas) > self.history_depth:
+            self.deltas.popleft()
+        if len(lines) == 0:
+            return
+
+        with open(self.journal_path, 'a') as f:
+            f.write(''.join(lines))
+        self.journal_entries += len(lines)
+        self.journal_bytes += sum(len(line) for line in lines)
+
+        if self.journal_entries >= self.compaction_interval or self.journal_bytes > self.snapshot_bytes:
+            self.compaction_due = True
+
+    def compact_if_due(self, state):
+        if self.compaction_due:
+            self.compact(state)
+
+    def track_changes(self):
+        if self.changed_paths is None:
+            self.changed_paths = {}
+
+    # The current value of every path changed by a commit or revert since the last call, as [path, value], or
+    # [path] if it was deleted. Values are copied into plain dicts, they can be pickled or sent as JSON.
+    def drain_changes(self, state):
+        changes = []
+        for path in self.changed_paths or ():
+            value = _get_path(state, path)
+            if value is _MISSING:
+                changes.append([list(path)])
+            else:
+                changes.append([list(path), _copy(value)])
+        if self.changed_paths is not None:
+            self.changed_paths = {}
+        return changes
+
+    # (block, block hash) of the kept deltas, newest first
+    def get_block_hashes(self):
+        return [(delta.block, delta.block_hash) for delta in reversed(self.deltas)]
+
+    def get_block_hash(self, block):
+        for delta in reversed(self.deltas):
+            if delta.block == block:
+                return delta.block_hash
+            if delta.block < block:
+                break
+        return None
+
+    # Undoes every commit after `block`, which must be the block of a kept delta. Any uncommitted changes
+    # have to be rolled back first.
+    def revert(self, state, block):
+        rewritten = False
+        while len(self.deltas) > 0 and self.deltas[-1].block > block:
+            delta = self.deltas.pop()
+            _restore(state, delta.originals)
+            if self.changed_paths is not None:
+                self.changed_paths.update(dict.fromkeys(delta.originals))
+            rewritten = rewritten or delta.line is None
+        # The files hold blocks that are no longer on the chain
+        if rewritten:
+            self.compact(state)
+
+    # Only the confirmed part of the state is written, the values from before the unconfirmed deltas are
+    # patched in while it is encoded instead of undoing them on a copy of the whole state
+    def compact(self, state):
+        unconfirmed = [delta for delta in self.deltas if delta.line is not None]
+        snapshot = _overlay(state, _patch_tree(unconfirmed))
+
+        raw = json.dumps(snapshot, default=_to_json)
+        tmp_path = f'{self.snapshot_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        # Safe to crash before this point, journal entries at or below synced_block are skipped on load
+        with open(self.journal_path, 'w'):
+            pass
+        self.snapshot_bytes = len(raw)
+        self.journal_entries = 0
+        self.journal_bytes = 0
+        self.compaction_due = False
@@ -0,0 +1,306 @@
+import asyncio
+import heapq
+import time
+
+from web3.exceptions import TransactionNotFound
+
+import metrics
+
+
+RECEIPT_POLL_INTERVAL = 1
+# Transactions without a receipt after this long are checked against the account nonce on chain
+RECEIPT_TIMEOUT = 120
+# Positions still pending after this long without a transaction in flight are given up on, so one lost
+# pre-flight or send can't block a position for good
+PENDING_TIMEOUT = 60
+BACKOFF_INITIAL = 15
+BACKOFF_MAX = 600
+
+
+# Hands out nonces locally so many transactions can be in flight at once. Nonces of transactions that
+# never made it to the node are reused first, and the counter is realigned with the chain when a send
+# reports a nonce problem or a transaction disappears.
+class NonceManager:
+    def __init__(self, async_web3, address):
+        self.async_web3 = async_web3
+        self.address = address
+        self.next_nonce = None
+        self.free_nonces = []
+
+    async def reconcile(self):
+        chain_nonce = await self.async_web3.eth.get_transaction_count(self.address, 'pending')
+        self.free_nonces = [nonce for nonce in self.free_nonces if nonce >= chain_nonce]
+        heapq.heapify(self.free_nonces)
+        if self.next_nonce is None or chain_nonce > self.next_nonce:
+            self.next_nonce = chain_nonce
+
+    def allocate(self):
+        if len(self.free_nonces) > 0:
+            return heapq.heappop(self.free_nonces)
+        nonce = self.next_nonce
+        self.next_nonce += 1
+        return nonce
+
+    # For nonces whose transaction was never accepted by the node
+    def release(self, nonce):
+        if nonce not in self.free_nonces:
+            heapq.heappush(self.free_nonces, nonce)
+
+
+# A liquidation that passed pre-flight and only needs a nonce and a signature. key is (address, idx, is_trader).
+class LiquidationPayload:
+    __slots__ = ('key', 'proposed_amount', 'received_at')
+
+    def __init__(self, key, proposed_amount, received_at=None):
+        self.key = key
+        self.proposed_amount = proposed_amount
+        # When the head the liquidation was found in arrived
+        self.received_at = received_at
+
+
+class PendingTransaction:
+    __slots__ = ('key', 'nonce', 'sent_at')
+
+    def __init__(self, key, nonce, sent_at):
+        self.key = key
+        self.nonce = nonce
+        self.sent_at = sent_at
+
+
+# Sends liquidations without waiting for them to be mined. Receipts are collected by a background task,
+# a position is never sent twice while a transaction for it is pending, and failures only back off the
+# position that failed. Positions are keyed by (address, idx, is_trader), as an account can be both a trader
+# and an LP in the same market. Proposed amounts for all candidates of a block are read in one multicall,
+# and with `simulate` each liquidation is also eth_call'ed so the ones that would revert are never sent.
+class LiquidationSubmitter:
+    def __init__(self, async_web3, async_multicall, account, clearinghouse_contract, clearinghouse_viewer_contract, transaction_template, simulate=False):
+        self.async_web3 = async_web3
+        self.async_multicall = async_multicall
+        self.account = account
+        self.clearinghouse_contract = clearinghouse_contract
+        self.clearinghouse_viewer_contract = clearinghouse_viewer_contract
+        self.transaction_template = transaction_template
+        self.simulate = simulate
+        self.nonces = NonceManager(async_web3, account.address)
+
+        # (address, idx, is_trader) -> time the liquidation was queued, for everything not yet resolved
+        self.pending = {}
+        # tx hash -> PendingTransaction
+        self.in_flight = {}
+        # (address, idx, is_trader) -> (failure count, retry not before)
+        self.backoff = {}
+        self.receipt_task = None
+        # Pre-flight and send tasks, the event loop only keeps weak references to them
+        self.tasks = set()
+
+    async def start(self):
+        await self.nonces.reconcile()
+        self.receipt_task = asyncio.create_task(self.track_receipts())
+
+    def stop(self):
+        if self.receipt_task is not None:
+            self.receipt_task.cancel()
+        for task in self.tasks:
+            task.cancel()
+
+    def start_task(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # Must be called from the event loop thread, returns straight away.
+    # candidates is a list of (address, idx, is_trader, priority), sent highest priority first
+    def submit_batch(self, candidates, received_at=None):
+        self.expire_pending()
+        accepted = []
+        for address, idx, is_trader, _ in sorted(candidates, key=lambda candidate: candidate[3], reverse=True):
+            key = (address, idx, is_trader)
+            if key in self.pending:
+                continue
+
+            failures, retry_at = self.backoff.get(key, (0, 0))
+            if time.time() < retry_at:
+                continue
+
+            self.pending[key] = time.time()
+            accepted.append(key)
+
+        if len(accepted) > 0:
+            self.start_task(self.preflight_and_send(accepted, received_at))
+        self.update_queue_metrics()
+        return len(accepted)
+
+    def get_proposed_amount_call(self, address, idx, is_trader):
+        if is_trader:
+            return self.clearinghouse_viewer_contract.functions.getTraderProposedAmount(idx, address, int(1e18), 100, 0)
+        return self.clearinghouse_viewer_contract.functions.getLpProposedAmount(idx, address, int(1e18), 100, [0,0], 0)
+
+    def get_liquidation_call(self, address, idx, is_trader, proposed_amount):
+        if is_trader:
+            return self.clearinghouse_contract.functions.liquidateTrader(idx, address, proposed_amount, 0)
+        return self.clearinghouse_contract.functions.liquidateLp(idx, address, [0,0], proposed_amount, 0)
+
+    async def preflight_and_send(self, accepted, received_at=None):
+        try:
+            with metrics.STAGE_SECONDS.time(stage='preflight'):
+                payloads = await self.preflight(accepted, received_at)
+        except Exception as e:
+            print(f'Liquidation pre-flight failed: {e}\n')
+            for key in accepted:
+                self.fail(key)
+            return
+
+        # Tasks start in the order they are created, so nonces go out in priority order too
+        for payload in payloads:
+            self.start_task(self.send(payload))
+
+    async def preflight(self, accepted, received_at=None):
+        calls = [self.get_proposed_amount_call(address, int(idx), is_trader) for address, idx, is_trader in accepted]
+        proposed_amounts = await self.async_multicall.call_async(calls, allow_failure=True)
+
+        payloads = []
+        for key, proposed_amount in zip(accepted, proposed_amounts):
+            if proposed_amount is None:
+                print(f'Could not get proposed amount to liquidate {key[0]} on market {key[1]}\n')
+                self.fail(key)
+            else:
+                payloads.append(LiquidationPayload(key, proposed_amount, received_at))
+
+        if not self.simulate or len(payloads) == 0:
+            return payloads
+
+        simulations = await asyncio.gather(*[
+            self.async_web3.eth.call({
+                'from': self.account.address,
+                'to': self.clearinghouse_contract.address,
+                'data': self.get_liquidation_call(payload.key[0], int(payload.key[1]), payload.key[2], payload.proposed_amount)._encode_transaction_data()
+            })
+            for payload in payloads
+        ], return_exceptions=True)
+
+        passed = []
+        for payload, simulation in zip(payloads, simulations):
+            if isinstance(simulation, Exception):
+                print(f'Liquidation of {payload.key[0]} on market {payload.key[1]} would revert: {simulation}\n')
+                self.fail(payload.key)
+            else:
+                passed.append(payload)
+        return passed
+
+    def build_transaction(self, payload, nonce):
+        address, idx, is_trader = payload.key
+        transaction = {**self.transaction_template, 'nonce': nonce}
+        unsigned_tx = self.get_liquidation_call(address, int(idx), is_trader, payload.proposed_amount).build_transaction(transaction)
+        return self.account.sign_transaction(unsigned_tx)
+
+    async def send(self, payload):
+        key = payload.key
+        address, idx, _ = key
+
+        # Nothing is awaited between taking the nonce and sending, so concurrent sends never share one
+        nonce = self.nonces.allocate()
+        try:
+            signed_tx = self.build_transaction(payload, nonce)
+            with metrics.STAGE_SECONDS.time(stage='submit'):
+                tx_hash = await self.async_web3.eth.send_raw_transaction(signed_tx.rawTransaction)
+        except ValueError as e:
+            self.nonces.release(nonce)
+            print(f'Attempted liquidation of {address} on market {idx} but it was rejected: {e}. Will retry soon.\n')
+            self.fail(key)
+            try:
+                await self.nonces.reconcile()
+            except Exception as e:
+                print(f'Could not realign the nonce with the chain: {e!r}\n')
+            return
+        # Sends run as tasks nobody awaits, an exception raised here would never be seen
+        except Exception as e:
+            self.nonces.release(nonce)
+            print(f'Could not send the liquidation of {address} on market {idx}: {e!r}. Will retry soon.\n')
+            self.fail(key)
+            return
+
+        self.in_flight[tx_hash] = PendingTransaction(key, nonce, time.time())
+        if payload.received_at is not None:
+            metrics.BLOCK_TO_LIQUIDATION_SENT_SECONDS.observe(time.time() - payload.received_at)
+        self.update_queue_metrics()
+
+    # Every pending position waits on this task to be resolved, so errors are logged and the next poll tries again
+    async def track_receipts(self):
+        while True:
+            await asyncio.sleep(RECEIPT_POLL_INTERVAL)
+            if len(self.in_flight) == 0:
+                continue
+            try:
+                await self.collect_receipts()
+            except Exception as e:
+                print(f'Checking liquidation receipts failed: {e!r}\n')
+
+    async def collect_receipts(self):
+        tx_hashes = list(self.in_flight)
+        receipts = await asyncio.gather(*[self.async_web3.eth.get_transaction_receipt(tx_hash) for tx_hash in tx_hashes], return_exceptions=True)
+
+        timed_out = []
+        for tx_hash, receipt in zip(tx_hashes, receipts):
+            transaction = self.in_flight[tx_hash]
+            if isinstance(receipt, TransactionNotFound):
+                if time.time() - transaction.sent_at > RECEIPT_TIMEOUT:
+                    timed_out.append(tx_hash)
+                continue
+            if isinstance(receipt, Exception):
+                continue
+
+            del self.in_flight[tx_hash]
+            metrics.STAGE_SECONDS.observe(time.time() - transaction.sent_at, stage='receipt')
+            address, idx, _ = transaction.key
+            print(f'Liquidation of {address} on market {idx} mined. Liquidation status: {receipt["status"]}.')
+            if receipt['status'] == 1:
+                self.succeed(transaction.key)
+            else:
+                self.fail(transaction.key)
+
+        if len(timed_out) > 0:
+            await self.resolve_timed_out(timed_out)
+
+    # A transaction with no receipt whose nonce has been mined was replaced. One whose nonce the node
+    # doesn't even count as pending was dropped, and its nonce is a gap the next liquidation has to fill.
+    async def resolve_timed_out(self, tx_hashes):
+        mined_nonce, pending_nonce = await asyncio.gather(
+            self.async_web3.eth.get_transaction_count(self.account.address, 'latest'),
+            self.async_web3.eth.get_transaction_count(self.account.address, 'pending')
+        )
+        for tx_hash in tx_hashes:
+            transaction = self.in_flight[tx_hash]
+            if transaction.nonce < mined_nonce:
+                print(f'Liquidation transaction {tx_hash.hex()} was replaced, will retry\n')
+            elif transaction.nonce >= pending_nonce:
+                print(f'Liquidation transaction {tx_hash.hex()} was dropped, will retry\n')
+                self.nonces.release(transaction.nonce)
+            else:
+                continue
+
+            del self.in_flight[tx_hash]
+            self.fail(transaction.key)
+
+    def expire_pending(self):
+        in_flight = set(transaction.key for transaction in self.in_flight.values())
+        now = time.time()
+        for key, queued_at in list(self.pending.items()):
+            if now - queued_at > PENDING_TIMEOUT and key not in in_flight:
+                print(f'Liquidation of {key[0]} on market {key[1]} was never sent, will retry\n')
+                self.fail(key)
+
+    def succeed(self, key):
+        self.pending.pop(key, None)
+        self.backoff.pop(key, None)
+        self.update_queue_metrics()
+
+    def fail(self, key):
+        self.pending.pop(key, None)
+        failures, _ = self.backoff.get(key, (0, 0))
+        delay = min(BACKOFF_MAX, BACKOFF_INITIAL * 2**failures)
+        self.backoff[key] = (failures + 1, time.time() + delay)
+        self.update_queue_metrics()
+
+    def update_queue_metrics(self):
+        metrics.QUEUE_SIZE.set(len(self.pending), queue='pending')
+        metrics.QUEUE_SIZE.set(len(self.in_flight), queue='in_flight')
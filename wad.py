@@ -0,0 +1,32 @@
+# Fixed-point math on 18 decimal integers, rounded like the contracts do it. Solidity's signed division
+# truncates towards zero, unlike Python's //, so negative results are rounded up instead of down.
+
+WAD = 10**18
+
+
+def div(a, b):
+    if (a >= 0) == (b > 0):
+        return a // b
+    return -(-a // b)
+
+
+def wad_mul(a, b):
+    product = a * b
+    if product >= 0:
+        return product // WAD
+    return -(-product // WAD)
+
+
+# Divisors are nearly always positive, those skip the sign checks of div()
+def wad_div(a, b):
+    numerator = a * WAD
+    if b > 0:
+        return numerator // b if numerator >= 0 else -(-numerator // b)
+    return div(numerator, b)
+
+
+def mul_div(a, b, c):
+    product = a * b
+    if c > 0:
+        return product // c if product >= 0 else -(-product // c)
+    return div(product, c)